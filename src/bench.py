@@ -0,0 +1,680 @@
+"""
+Offline benchmarks for the TNS compare.
+
+Runs `apply_compare` on local files, the same way `test_units.test_compare`
+does, and prints timings for the different subscription layouts, or for
+generated tiles and AOIs across a matrix of sizes.
+
+    python src/bench.py index --aois data/state_aois.parquet \
+        --tiles data/big_state_tiles.parquet
+    python src/bench.py sorted --aois data/state_aois.parquet \
+        --tiles data/one_tile.parquet
+    python src/bench.py scale --tile-counts 1000 10000 --aoi-counts 50 1000 \
+        --vertices 8 256 --skews 0 0.9 --json results.json
+    python src/bench.py generate /tmp/synthetic --tiles 10000 --aois 500
+    python src/bench.py handler --invocations 20 --batch-size 2
+    python src/bench.py startup --runs 5
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+import duckdb
+
+import intersects_lambda
+from intersects_lambda import (
+    CONFIG_CACHE,
+    CloudConfig,
+    apply_compare,
+    build_subscription_index,
+    get_tiles_extent,
+)
+from local_aws import LocalAWS, s3_event_body, sqs_event
+from publish import float_bbox_sql, write_sorted_subscriptions
+
+DATA_DIR = Path(os.path.dirname(os.path.abspath(__file__))) / "data"
+# extent generated data is spread over, about the contiguous US
+SYNTHETIC_EXTENT = (-125.0, 25.0, -67.0, 49.0)
+# share of the extent's width and height the skewed features crowd into
+HOTSPOT_SHARE = 0.05
+# one cold start of the handler, run in a fresh interpreter by
+# `bench_startup` with the local stand-in root and subscriptions path
+STARTUP_SCRIPT = """
+import json, os, sys, time
+start = time.perf_counter()
+import duckdb
+duckdb_done = time.perf_counter()
+import boto3
+boto3_done = time.perf_counter()
+import intersects_lambda
+imported = time.perf_counter()
+
+from local_aws import LocalAWS
+root, aois_path = sys.argv[1:]
+with LocalAWS(root) as aws:
+    key = os.environ["DEPLOY_PREFIX"] + "/subs/subscriptions.parquet"
+    aws.s3.upload_file(aois_path, os.environ["S3_BUCKET"], key)
+    os.environ["AWS_S3_ENDPOINT"] = aws.endpoint
+    intersects_lambda.METRICS.enabled = True
+    init_start = time.perf_counter()
+    intersects_lambda.init()
+    init_done = time.perf_counter()
+    config = intersects_lambda.CONFIG_CACHE.config
+    with config:
+        config.con.execute(
+            f"SELECT count(*) FROM read_parquet('{config.aois_path}')"
+        ).fetchone()
+    queried = time.perf_counter()
+print(json.dumps({
+    "import_duckdb": duckdb_done - start,
+    "import_boto3": boto3_done - duckdb_done,
+    "import_module": imported - boto3_done,
+    "init": init_done - init_start,
+    "first_query": queried - init_done,
+    "first_query_total": (imported - start) + (queried - init_start),
+    "init_stages": intersects_lambda.METRICS.stages,
+}))
+"""
+
+
+def make_config(aois_path: str, mem_limit: int = 5 * 2**10) -> CloudConfig:
+    """CloudConfig with fake AWS values reading subscriptions from a local
+    path."""
+    config = CloudConfig(
+        "us-west-2", "fake-sns-arn", "tns-fake-bucket", "bench", mem_limit
+    )
+    config.aois_path = aois_path
+    return config
+
+
+def time_compare(
+    config: CloudConfig, tile_paths: list[str], outdir: str, repeat: int
+) -> list[float]:
+    """Wall times in seconds of `repeat` compare runs."""
+    times = []
+    with config:
+        for n in range(repeat):
+            outpath = os.path.join(outdir, f"out_{n}.parquet")
+            start = time.perf_counter()
+            apply_compare(tile_paths, config, outpath)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name: str, times: list[float]):
+    print(
+        f"{name:<24} median {median(times):8.3f}s  "
+        f"min {min(times):8.3f}s  max {max(times):8.3f}s"
+    )
+
+
+def row_group_bytes(con, aois_path: str, extent) -> dict:
+    """Row groups and compressed bytes of `aois_path` that the compare's
+    bbox filter has to read for tiles within `extent`, according to the
+    parquet bbox statistics, against the totals for the file."""
+    xmin, ymin, xmax, ymax = extent
+
+    def stat(kind, field):
+        return f"""max(CASE WHEN path_in_schema = 'geometry_bbox, {field}'
+            THEN stats_{kind}_value::DOUBLE END)"""
+
+    groups = con.execute(f"""
+        SELECT
+            sum(total_compressed_size),
+            {stat("min", "xmin")}, {stat("min", "ymin")},
+            {stat("max", "xmax")}, {stat("max", "ymax")}
+        FROM parquet_metadata('{aois_path}')
+        GROUP BY row_group_id
+    """).fetchall()
+    read = [
+        g for g in groups
+        if g[3] >= xmin and g[1] <= xmax and g[4] >= ymin and g[2] <= ymax
+    ]
+    return {
+        "row_groups_read": len(read),
+        "row_groups": len(groups),
+        "bytes_read": sum(g[0] for g in read),
+        "bytes": sum(g[0] for g in groups),
+    }
+
+
+def report_reads(name: str, reads: dict):
+    print(
+        f"{name:<24} row groups {reads['row_groups_read']}/"
+        f"{reads['row_groups']}  bytes {reads['bytes_read']}/{reads['bytes']}"
+    )
+
+
+def bench_sorted(aois_path: str, tile_paths: list[str], repeat: int = 3):
+    """Compare the subscriptions as given against a Hilbert sorted copy,
+    in latency and in bytes the bbox filter leaves to be read."""
+    with TemporaryDirectory() as td:
+        sorted_path = os.path.join(td, "sorted.parquet")
+        config = make_config(aois_path)
+        with config:
+            row_group_size = write_sorted_subscriptions(
+                config.con, aois_path, sorted_path
+            )
+            extent = get_tiles_extent(config.con, tile_paths)
+            original_reads = row_group_bytes(config.con, aois_path, extent)
+            sorted_reads = row_group_bytes(config.con, sorted_path, extent)
+        print(f"sorted row group size {row_group_size}")
+
+        report("original", time_compare(config, tile_paths, td, repeat))
+        report_reads("original", original_reads)
+        config.aois_path = sorted_path
+        report("hilbert sorted", time_compare(config, tile_paths, td, repeat))
+        report_reads("hilbert sorted", sorted_reads)
+
+
+def uniform_sql(seed: int, *stream: str) -> str:
+    """SQL for a uniform value in [0, 1) that is the same for the same row
+    `i`, `seed` and `stream` expressions, on any run and any thread count,
+    unlike random()."""
+    args = ", ".join(("i", str(seed), *stream))
+    return f"(hash({args}) >> 11)::DOUBLE / 9007199254740992"
+
+
+def write_synthetic(
+    con,
+    path: str,
+    count: int,
+    size: float,
+    vertices: int = 4,
+    skew: float = 0.0,
+    seed: int = 0,
+    prefix: str = "tile",
+):
+    """Write `count` polygons to `path` in the tiles and subscriptions
+    schema, keyed `{prefix}_{n}`, deterministically for a `seed`.
+
+    Each polygon has `vertices` corners around its center at a distance
+    between a quarter and half of `size` degrees, so more vertices make a
+    more detailed, not a bigger, geometry. Centers are uniform over
+    `SYNTHETIC_EXTENT` except for a `skew` share of them, crowded into a
+    hotspot in its middle."""
+    xmin, ymin, xmax, ymax = SYNTHETIC_EXTENT
+    width, height = xmax - xmin, ymax - ymin
+
+    def center(low, span, stream):
+        u = uniform_sql(seed, stream)
+        return f"""CASE WHEN {uniform_sql(seed, "'hot'")} < {skew}
+            THEN {low} + {span} * (0.5 + {HOTSPOT_SHARE} * ({u} - 0.5))
+            ELSE {low} + {span} * {u} END"""
+
+    corner = f"k % {vertices}"
+    radius = f"{size} * (0.25 + 0.25 * {uniform_sql(seed, corner)})"
+    angle = f"2 * pi() * ({corner}) / {vertices}"
+    con.execute(f"""
+        COPY (
+            SELECT '{prefix}_' || i AS pk_and_model, geometry,
+                {float_bbox_sql("geometry")} AS geometry_bbox
+            FROM (
+                SELECT i, ST_MakePolygon(ST_MakeLine(list_transform(
+                    range({vertices} + 1),
+                    lambda k: ST_Point(
+                        cx + {radius} * cos({angle}),
+                        cy + {radius} * sin({angle})
+                    )
+                ))) AS geometry
+                FROM (
+                    SELECT i,
+                        {center(xmin, width, "'x'")} AS cx,
+                        {center(ymin, height, "'y'")} AS cy
+                    FROM range({count}) AS t(i)
+                )
+            )
+            ORDER BY i
+        )
+        TO '{path}'
+        (FORMAT parquet, COMPRESSION zstd)
+    """)
+
+
+def peak_compare(aois_path: str, tile_paths: list[str], repeat: int):
+    """Compare times of `time_compare` and the peak resident memory, in
+    bytes, of the process running them, see `bench_scale`."""
+    with TemporaryDirectory() as td:
+        times = time_compare(make_config(aois_path), tile_paths, td, repeat)
+    # ru_maxrss is in KiB on Linux
+    return times, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2**10
+
+
+def bench_case(case: dict, repeat: int = 3) -> dict:
+    """Generate the tiles and AOIs described by `case` and time the compare
+    on them, in a fresh process so the peak memory is that of the compare
+    alone, as it would be for a Lambda invocation. Bytes read are those of
+    the tiles and of the AOI row groups the bbox filter keeps."""
+    with TemporaryDirectory() as td:
+        tiles_path = os.path.join(td, "tiles.parquet")
+        aois_path = os.path.join(td, "aois.parquet")
+        con = duckdb.connect()
+        con.execute("LOAD spatial")
+        write_synthetic(
+            con, tiles_path, case["tiles"], case["tile_size"],
+            skew=case["skew"], seed=case["seed"], prefix="tile",
+        )
+        write_synthetic(
+            con, aois_path, case["aois"], case["aoi_size"], case["vertices"],
+            case["skew"], case["seed"] + 1, prefix="aoi",
+        )
+        extent = get_tiles_extent(con, [tiles_path])
+        reads = row_group_bytes(con, aois_path, extent)
+        con.close()
+
+        spawn = multiprocessing.get_context("spawn")
+        with spawn.Pool(1) as pool:
+            times, peak = pool.apply(
+                peak_compare, (aois_path, [tiles_path], repeat)
+            )
+        return case | {
+            "median_seconds": median(times),
+            "min_seconds": min(times),
+            "peak_bytes": peak,
+            "bytes_read": os.path.getsize(tiles_path) + reads["bytes_read"],
+        }
+
+
+def case_name(case: dict) -> str:
+    return (
+        f"t{case['tiles']} a{case['aois']} v{case['vertices']} "
+        f"s{case['skew']:g}"
+    )
+
+
+def bench_scale(
+    tile_counts: list[int],
+    aoi_counts: list[int],
+    vertices: list[int],
+    skews: list[float],
+    tile_size: float = 0.05,
+    aoi_size: float = 1.0,
+    seed: int = 0,
+    repeat: int = 3,
+    json_path: str | None = None,
+    baseline_path: str | None = None,
+) -> list[dict]:
+    """Time the compare over every combination of tile and AOI counts, AOI
+    vertices and skew, and report the wall time, peak memory and bytes
+    read of each. Results are written to `json_path` if given, and each
+    median is compared to the same case in `baseline_path`, a previous
+    `json_path`, to catch regressions."""
+    baseline = {}
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = {case_name(r): r for r in json.load(f)}
+
+    results = []
+    for tiles, aois, verts, skew in itertools.product(
+        tile_counts, aoi_counts, vertices, skews
+    ):
+        case = {
+            "tiles": tiles, "aois": aois, "vertices": verts, "skew": skew,
+            "tile_size": tile_size, "aoi_size": aoi_size, "seed": seed,
+        }
+        result = bench_case(case, repeat)
+        results.append(result)
+        name = case_name(case)
+        line = (
+            f"{name:<28} median {result['median_seconds']:8.3f}s  "
+            f"peak {result['peak_bytes'] / 2**20:8.1f}MiB  "
+            f"read {result['bytes_read'] / 2**20:8.2f}MiB"
+        )
+        if name in baseline:
+            change = result["median_seconds"] / baseline[name]["median_seconds"]
+            line += f"  {change - 1:+.0%} against baseline"
+        print(line)
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def bench_handler(
+    aois_path: str,
+    tile_paths: list[str],
+    invocations: int = 20,
+    batch_size: int = 1,
+    quiet: bool = True,
+) -> dict:
+    """Run `invocations` of the Lambda handler, each on a batch of
+    `batch_size` SQS records of the tile files in turn, against the local
+    stand-ins of `local_aws`, and report invocations per second and the
+    mean time per invocation of each stage of the handler's metrics
+    record, see `intersects_lambda.Metrics`. The first invocation is cold,
+    it builds the config and DuckDB connection, and is reported on its
+    own.
+
+    The handler reads its configuration from the environment as deployed,
+    so modes such as INLINE_MESSAGES or OUTPUT_LAYOUT can be set there, and
+    work units a fan out enqueues are fed back as invocations of their
+    own. Handler logs are dropped unless `quiet` is False."""
+    region = "us-west-2"
+    bucket = "tns-bench-bucket"
+    prefix = "bench"
+    queue_arn = f"arn:aws:sqs:{region}:000000000000:tns-bench-in"
+    with TemporaryDirectory() as td, LocalAWS(td) as aws:
+        aws.s3.upload_file(
+            aois_path, bucket, f"{prefix}/subs/subscriptions.parquet"
+        )
+        bodies = []
+        for n, path in enumerate(tile_paths):
+            key = f"tiles/{n}/{os.path.basename(path)}"
+            aws.s3.upload_file(path, bucket, key)
+            head = aws.s3.head_object(Bucket=bucket, Key=key)
+            bodies.append(
+                s3_event_body(bucket, key, head["ContentLength"], head["ETag"])
+            )
+        queue_url = aws.sqs.get_queue_url(
+            QueueName=queue_arn.split(":")[-1]
+        )["QueueUrl"]
+
+        env = {
+            "SNS_OUT_ARN": f"arn:aws:sns:{region}:000000000000:tns-bench-out",
+            "AWS_REGION": region,
+            "S3_BUCKET": bucket,
+            "DEPLOY_PREFIX": prefix,
+            "AWS_S3_ENDPOINT": aws.endpoint,
+            "SUBS_CACHE_DIR": os.path.join(td, "subs_cache"),
+            "EMIT_METRICS": "true",
+        }
+        defaults = {
+            "MEMORY_LIMIT": "2048",
+            # DuckDB's credential chain wants credentials, they aren't used
+            "AWS_ACCESS_KEY_ID": "bench",
+            "AWS_SECRET_ACCESS_KEY": "bench",
+        }
+        defaults = {k: v for k, v in defaults.items() if k not in os.environ}
+
+        def invoke(messages):
+            event = sqs_event(messages, queue_arn, region)
+            logs = io.StringIO() if quiet else None
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(logs or sys.stdout):
+                intersects_lambda.handler(event, None)
+            times.append(time.perf_counter() - start)
+            metrics.append(intersects_lambda.METRICS.last)
+
+        CONFIG_CACHE.clear()
+        times = []
+        metrics = []
+        records = 0
+        with mock.patch.dict(os.environ, env | defaults):
+            for n in range(invocations):
+                entries = [
+                    {"Id": str(i), "MessageBody": bodies[(n + i) % len(bodies)]}
+                    for i in range(batch_size)
+                ]
+                aws.sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+                # drain the batch and any work units it enqueued
+                while True:
+                    res = aws.sqs.receive_message(
+                        QueueUrl=queue_url, MaxNumberOfMessages=batch_size
+                    )
+                    if "Messages" not in res:
+                        break
+                    invoke(res["Messages"])
+                    records += len(res["Messages"])
+        CONFIG_CACHE.clear()
+        intersects_lambda.METRICS.enabled = False
+
+    def stages(record):
+        return {
+            name.removesuffix("_ms"): value
+            for name, value in record.items()
+            if name.endswith("_ms")
+        }
+
+    warm = times[1:] or times
+    warm_metrics = metrics[1:] or metrics
+    cold = stages(metrics[0])
+    names = list(cold)
+    for record in warm_metrics:
+        names += [name for name in stages(record) if name not in names]
+    results = {
+        "cold_seconds": times[0],
+        "invocations": len(times),
+        "records": records,
+        "invocations_per_second": len(warm) / sum(warm),
+        "median_seconds": median(warm),
+        "p95_seconds": sorted(warm)[int(0.95 * (len(warm) - 1))],
+        "cold_stages": cold,
+        "stages": {
+            name: sum(stages(r).get(name, 0.0) for r in warm_metrics)
+            / len(warm_metrics)
+            for name in names
+        },
+        "peak_rss_bytes": metrics[-1]["peak_rss_bytes"],
+        "duckdb_memory_bytes": max(r["duckdb_memory_bytes"] for r in metrics),
+        "published": len(aws.sns.messages),
+    }
+    print(
+        f"{results['invocations']} invocations of {results['records']} "
+        f"records, {results['published']} messages published"
+    )
+    print(
+        f"cold {results['cold_seconds']:.3f}s  warm "
+        f"{results['invocations_per_second']:.1f} invocations/s  median "
+        f"{results['median_seconds']:.3f}s  p95 {results['p95_seconds']:.3f}s"
+    )
+    print(
+        f"peak rss {results['peak_rss_bytes'] / 2**20:.1f}MiB  duckdb "
+        f"memory {results['duckdb_memory_bytes'] / 2**20:.1f}MiB"
+    )
+    for stage, ms in results["stages"].items():
+        print(
+            f"{stage:<14} cold {cold.get(stage, 0.0):9.1f}ms  "
+            f"warm mean {ms:9.1f}ms"
+        )
+    return results
+
+
+def bench_startup(aois_path: str, runs: int = 5) -> dict:
+    """Cold start the handler `runs` times, each in a fresh interpreter,
+    against the local stand-ins of `local_aws`, and report the median
+    time to import duckdb, boto3 and the handler module, to run
+    `intersects_lambda.init` and its stages, and to answer a first query
+    over the subscriptions. The time to first query adds them up, the
+    stand-ins' setup aside. Later runs find the extensions in the page
+    cache, like warm Lambda hosts do."""
+    env = {
+        "SNS_OUT_ARN": "arn:aws:sns:us-west-2:000000000000:tns-bench-out",
+        "AWS_REGION": "us-west-2",
+        "S3_BUCKET": "tns-bench-bucket",
+        "DEPLOY_PREFIX": "bench",
+        "MEMORY_LIMIT": "2048",
+        # DuckDB's credential chain wants credentials, they aren't used
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+    }
+    samples = []
+    for _ in range(runs):
+        with TemporaryDirectory() as td:
+            run_env = os.environ | env | {
+                "SUBS_CACHE_DIR": os.path.join(td, "subs_cache"),
+            }
+            # the child calls init itself, after the stand-ins are up
+            run_env.pop("AWS_LAMBDA_FUNCTION_NAME", None)
+            out = subprocess.run(
+                [sys.executable, "-c", STARTUP_SCRIPT, td, aois_path],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=run_env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            samples.append(json.loads(out.splitlines()[-1]))
+
+    names = [name for name in samples[0] if name != "init_stages"]
+    results = {name: median(s[name] for s in samples) for name in names}
+    results["init_stages"] = {
+        name: median(s["init_stages"].get(name, 0.0) for s in samples)
+        for name in samples[0]["init_stages"]
+    }
+    results["runs"] = runs
+    print(f"median of {runs} cold starts")
+    for name in names:
+        print(f"{name:<18} {results[name] * 1000:9.1f}ms")
+    for name, seconds in results["init_stages"].items():
+        print(f"  init {name:<12} {seconds * 1000:9.1f}ms")
+    return results
+
+
+def bench_index(aois_path: str, tile_paths: list[str], repeat: int = 3):
+    """Compare reading subscriptions from parquet against reading those
+    within the tiles' extent from the R-tree indexed database."""
+    with TemporaryDirectory() as td:
+        parquet_times = time_compare(
+            make_config(aois_path), tile_paths, td, repeat
+        )
+        report("parquet", parquet_times)
+
+        db_path = os.path.join(td, "subscriptions.duckdb")
+        config = make_config(db_path)
+        with config:
+            start = time.perf_counter()
+            build_subscription_index(config.con, aois_path, db_path)
+            report("index build", [time.perf_counter() - start])
+        index_times = time_compare(config, tile_paths, td, repeat)
+        report("rtree index", index_times)
+
+
+def add_scale_commands(commands):
+    """The `scale` and `generate` commands, which take generated data
+    sizes rather than files."""
+    scale = commands.add_parser(
+        "scale", help="Generated tiles and AOIs across a matrix of sizes."
+    )
+    scale.add_argument("--tile-counts", type=int, nargs="+", default=[1000])
+    scale.add_argument("--aoi-counts", type=int, nargs="+", default=[50])
+    scale.add_argument("--vertices", type=int, nargs="+", default=[16])
+    scale.add_argument("--skews", type=float, nargs="+", default=[0.0])
+    scale.add_argument("--tile-size", type=float, default=0.05)
+    scale.add_argument("--aoi-size", type=float, default=1.0)
+    scale.add_argument("--seed", type=int, default=0)
+    scale.add_argument("--json", help="Write the results to this file.")
+    scale.add_argument(
+        "--baseline", help="Results of a previous run to compare against."
+    )
+    scale.set_defaults(
+        func=lambda a: bench_scale(
+            a.tile_counts, a.aoi_counts, a.vertices, a.skews, a.tile_size,
+            a.aoi_size, a.seed, a.repeat, a.json, a.baseline,
+        )
+    )
+
+    generate = commands.add_parser(
+        "generate",
+        help="Write generated tiles.parquet and aois.parquet to a directory.",
+    )
+    generate.add_argument("outdir")
+    generate.add_argument("--tiles", type=int, default=1000)
+    generate.add_argument("--aois", type=int, default=50)
+    generate.add_argument("--vertices", type=int, default=16)
+    generate.add_argument("--skew", type=float, default=0.0)
+    generate.add_argument("--tile-size", type=float, default=0.05)
+    generate.add_argument("--aoi-size", type=float, default=1.0)
+    generate.add_argument("--seed", type=int, default=0)
+
+    def write(args):
+        os.makedirs(args.outdir, exist_ok=True)
+        con = duckdb.connect()
+        con.execute("LOAD spatial")
+        write_synthetic(
+            con, os.path.join(args.outdir, "tiles.parquet"), args.tiles,
+            args.tile_size, skew=args.skew, seed=args.seed, prefix="tile",
+        )
+        write_synthetic(
+            con, os.path.join(args.outdir, "aois.parquet"), args.aois,
+            args.aoi_size, args.vertices, args.skew, args.seed + 1, "aoi",
+        )
+
+    generate.set_defaults(func=write)
+
+
+def add_lambda_commands(commands):
+    """The `handler` and `startup` commands, which run the Lambda handler
+    itself against the local AWS stand-ins."""
+    handler = commands.add_parser(
+        "handler",
+        help="The whole Lambda handler against local S3, SNS and SQS.",
+    )
+    handler.add_argument(
+        "--aois", default=(DATA_DIR / "state_aois.parquet").as_posix()
+    )
+    handler.add_argument(
+        "--tiles",
+        nargs="+",
+        default=[(DATA_DIR / "big_state_tiles.parquet").as_posix()],
+    )
+    handler.add_argument("--invocations", type=int, default=20)
+    handler.add_argument("--batch-size", type=int, default=1)
+    handler.add_argument(
+        "--verbose", action="store_true", help="Print the handler's logs."
+    )
+    handler.set_defaults(
+        func=lambda a: bench_handler(
+            a.aois, a.tiles, a.invocations, a.batch_size, not a.verbose
+        )
+    )
+
+    startup = commands.add_parser(
+        "startup",
+        help="Import time and time to first query of a cold handler.",
+    )
+    startup.add_argument(
+        "--aois", default=(DATA_DIR / "state_aois.parquet").as_posix()
+    )
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=lambda a: bench_startup(a.aois, a.runs))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    commands = parser.add_subparsers(required=True)
+    add_scale_commands(commands)
+    add_lambda_commands(commands)
+
+    benches = {
+        "index": (
+            bench_index,
+            "Parquet subscriptions against the R-tree index.",
+        ),
+        "sorted": (
+            bench_sorted,
+            "Subscriptions as given against a Hilbert sorted copy.",
+        ),
+    }
+    for name, (func, description) in benches.items():
+        cmd = commands.add_parser(name, help=description)
+        cmd.add_argument(
+            "--aois", default=(DATA_DIR / "state_aois.parquet").as_posix()
+        )
+        cmd.add_argument(
+            "--tiles",
+            nargs="+",
+            default=[(DATA_DIR / "big_state_tiles.parquet").as_posix()],
+        )
+        cmd.set_defaults(func=lambda a, f=func: f(a.aois, a.tiles, a.repeat))
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,13 @@ from typing import Generator, TypeVar
 import pytest
 import json
 import boto3
+import duckdb
 import polars_st as st
 
 from pathlib import Path
 from time import sleep
 
-from intersects_lambda import CloudConfig
+from intersects_lambda import METRICS, CloudConfig, Metrics
 
 
 TILES_PER_FILE = 1000
@@ -18,6 +19,35 @@ Fixture = Generator[T, None, None]
 EventType = dict[str, list[dict[str, any]]]
 
 
+def read_intersects(
+    con: duckdb.DuckDBPyConnection, path: str
+) -> dict[str, list[str]]:
+    """AOI keys of an aoi layout intersects parquet, mapped to their sorted
+    tile keys. Checks there is one row per AOI."""
+    rows = con.execute(
+        f"SELECT aois, list_sort(tiles) FROM read_parquet('{path}')"
+    ).fetchall()
+    assert len(rows) == len(dict(rows))
+    return dict(rows)
+
+
+def set_local_env(monkeypatch, aws, td: str, **env: str) -> None:
+    """Lambda environment pointing the handler at the `local_aws` stand-ins
+    of `aws`, with fake values and a subscription cache under `td`."""
+    env = {
+        "SNS_OUT_ARN": "fake-sns-arn",
+        "AWS_REGION": "us-west-2",
+        "S3_BUCKET": "tns-fake-bucket",
+        "DEPLOY_PREFIX": "fake",
+        "MEMORY_LIMIT": "2048",
+        "AWS_S3_ENDPOINT": aws.endpoint,
+        "SUBS_CACHE_DIR": os.path.join(td, "subs_cache"),
+        **env,
+    }
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+
+
 def pytest_configure(config):
     config.addinivalue_line(
         "markers", "skip_by_env(env): fine tests based on terraform env."
@@ -307,6 +337,27 @@ def config(
     yield CloudConfig(region, sns_out, bucket_name, prefix, mem_size)
 
 
+@pytest.fixture(scope="function")
+def fake_config(small_aois_path: Path) -> Fixture[CloudConfig]:
+    """CloudConfig with fake AWS values comparing against the small AOIs."""
+    config = CloudConfig(
+        "us-west-2", "fake-sns-arn", "tns-fake-bucket", "fake", 5 * (2**10)
+    )
+    config.aois_path = small_aois_path.as_posix()
+    yield config
+    config.close()
+
+
+@pytest.fixture(scope="function")
+def metrics() -> Fixture[Metrics]:
+    """The handler's metrics, enabled, with what the test recorded dropped
+    afterwards."""
+    METRICS.enabled = True
+    yield METRICS
+    METRICS.enabled = False
+    METRICS.reset()
+
+
 @pytest.fixture(scope="function")
 def test_dir() -> Fixture[Path]:
     """Directory path of this file (conftest.py)."""
@@ -6,17 +6,490 @@ This module uses DuckDB to find the intersect between AOI Subscriptions and
 ingested Tiles and output the results to S3 and to SNS.
 """
 
+import functools
+import hashlib
 import json
 import os
+import resource
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from math import ceil
 
 import boto3
 import duckdb
 import traceback
+from botocore.exceptions import ClientError
 from tempfile import TemporaryDirectory as TempDir
+from typing import NamedTuple
 
 from uuid import uuid4
 
 MAX_MSG_BYTES = 2**10 * 256  # 256KB
+# most SNS messages a small result is split into instead of writing it to
+# S3, past two the publishes cost more calls than the PUT and GET they save
+INLINE_MAX_MESSAGES = 2
+SQS_BATCH = 10  # most entries SQS batch calls accept
+# rough model of the compare's working set, used to plan record groups that
+# fit in memory: decoded tiles per compressed byte, join and aggregation
+# state per tile row, and decoded subscriptions per compressed byte
+TILE_BYTES_FACTOR = 8
+JOIN_ROW_BYTES = 1024
+SUBS_BYTES_FACTOR = 4
+# share of the memory limit record groups are packed up to
+MEMORY_BUDGET = 0.6
+# share of the memory limit left for tiles when the subscriptions estimate
+# takes up the whole budget
+MIN_TILE_BUDGET = 0.1
+# share of the ephemeral storage DuckDB may spill to, the rest is left for
+# the subscription cache
+SPILL_STORAGE_SHARE = 0.75
+# grid cell size, in degrees, of the out of core compare's equi-join
+SPILL_CELL_SIZE = 1.0
+# held by an out of core compare, whose settings are global to the database
+# the cursors of a fanned out compare share, as is the storage it spills to
+SPILL_LOCK = threading.Lock()
+# how a record too big to compare even out of core is split into row group
+# ranges: not at all, compared by workers in this process, or re-enqueued
+# on the input queue as work units for other invocations
+FANOUT_MODES = ("off", "local", "sqs")
+# key of the work unit in the body of a re-enqueued SQS message
+UNIT_KEY = "TnsUnit"
+# receives of a work unit after which its run is announced as failed, below
+# the input queue's maxReceiveCount so units that keep failing, timing out
+# or crashing are caught before they go to the dead letter queue
+UNIT_MAX_RECEIVES = 5
+# shape of the compare output: one row per AOI with the list of its tiles,
+# one row per tile with the list of its AOIs, or one row per pair
+OUTPUT_LAYOUTS = ("aoi", "tile", "pairs")
+# rectangle inside each AOI, published with the subscriptions, for AOIs
+# without one the compare always runs the exact predicate
+INTERIOR_TYPE = "STRUCT(xmin DOUBLE, ymin DOUBLE, xmax DOUBLE, ymax DOUBLE)"
+NO_INTERIOR = f"NULL::{INTERIOR_TYPE}"
+SUBS_CACHE_DIR = "/tmp/tns_subs"
+# where to get the R-tree indexed subscriptions database from, if anywhere
+SUBS_INDEX_MODES = ("off", "local", "s3")
+# flat is the single subscriptions.parquet, partitioned is a dataset split on
+# a regular longitude/latitude grid under subs/cells/, delta is a base file
+# plus add/remove delta files listed in a versioned log under subs/delta/
+SUBS_LAYOUTS = ("flat", "partitioned", "delta")
+MANIFEST_NAME = "manifest.json"
+DELTA_LOG_NAME = "log.json"
+# CloudWatch namespace of the per invocation metrics record
+METRICS_NAMESPACE = "TNS"
+# loaded on every connection, they come installed in the image, see
+# duck_setup.sql
+DUCKDB_EXTENSIONS = ("httpfs", "spatial", "aws")
+# when to store query profiles of an invocation: never, when it is slower
+# than PROFILE_SLOW_MS, or always
+PROFILE_MODES = ("off", "slow", "always")
+# seconds between samples of the Python stack when profiling
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+
+class DeltaSubscriptions(NamedTuple):
+    """Files making up one version of delta log subscriptions."""
+
+    base: str
+    base_version: int
+    deltas: list[tuple[int, str]]
+
+
+class Metrics:
+    """Stage timings, counters and memory samples of one invocation, emitted
+    as a single CloudWatch embedded metric format record. Disabled, the
+    default, stages and counters cost a flag check and record nothing."""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # the record of the last emit, for local runs
+        self.last = None
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counts = {}
+        self.duckdb_memory = 0
+
+    @contextmanager
+    def timing(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        """Add `seconds` to stage `name`."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def stage(self, name: str):
+        """Context manager adding the time spent in it to stage `name`."""
+        if not self.enabled:
+            return nullcontext()
+        return self.timing(name)
+
+    def timed(self, name: str):
+        """Decorator adding the time spent in each call to stage `name`."""
+
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.timing(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def add(self, counters: dict):
+        """Add to the counts of rows, bytes and messages by name."""
+        if not self.enabled:
+            return
+        with self.lock:
+            for name, value in counters.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def sample_memory(self, con):
+        """Keep the highest memory usage DuckDB reports for `con`."""
+        if not self.enabled:
+            return
+        usage = con.execute(
+            "SELECT coalesce(sum(memory_usage_bytes), 0) FROM duckdb_memory()"
+        ).fetchone()[0]
+        self.duckdb_memory = max(self.duckdb_memory, int(usage))
+
+    def record(self, dimensions: dict[str, str]) -> dict:
+        """Embedded metric format record of the invocation: stages in
+        milliseconds, memory in bytes, the rest as counts. The peak RSS
+        is the process's, so over every invocation of a warm container."""
+        values = {f"{name}_ms": t * 1000 for name, t in self.stages.items()}
+        units = dict.fromkeys(values, "Milliseconds")
+        values["peak_rss_bytes"] = (
+            # ru_maxrss is in KiB on Linux
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2**10
+        )
+        values["duckdb_memory_bytes"] = self.duckdb_memory
+        units["peak_rss_bytes"] = units["duckdb_memory_bytes"] = "Bytes"
+        for name, count in self.counts.items():
+            values[name] = count
+            units[name] = "Bytes" if name.endswith("_bytes") else "Count"
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [list(dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, unit in units.items()
+                        ],
+                    }
+                ],
+            },
+            **dimensions,
+            **values,
+        }
+
+    def emit(self, dimensions: dict[str, str]) -> dict | None:
+        """Print the record of the invocation and start the next one."""
+        if not self.enabled:
+            return None
+        self.last = self.record(dimensions)
+        print(json.dumps(self.last))
+        self.reset()
+        return self.last
+
+
+METRICS = Metrics()
+
+
+def operator_timings(profile: dict) -> dict[str, float]:
+    """Seconds spent in each operator of a DuckDB JSON query profile, summed
+    by operator name, slowest first. The bbox range join shows as a join
+    operator, the ST_Intersects test of its candidates as the FILTER above
+    it."""
+    timings = {}
+    nodes = [profile]
+    while nodes:
+        node = nodes.pop()
+        name = node.get("operator_name")
+        if name:
+            timings[name] = (
+                timings.get(name, 0.0) + node.get("operator_timing", 0.0)
+            )
+        nodes.extend(node.get("children", []))
+    return dict(sorted(timings.items(), key=lambda t: -t[1]))
+
+
+class StackSampler(threading.Thread):
+    """Sample the Python stack of one thread every `interval` seconds and
+    count the samples of each stack. Time in DuckDB is counted against the
+    Python call that is waiting on the query."""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            calls = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                calls.append(
+                    f"{code.co_name} ({filename}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if calls:
+                stack = ";".join(reversed(calls))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self) -> str:
+        """Samples as collapsed stacks, one 'outer;...;inner count' line per
+        stack, the input of flame graph tools."""
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.items()
+        )
+
+
+class Profiler:
+    """DuckDB query profiles, and optionally a Python sampling profile, of
+    one invocation. Started on a connection, `capture` keeps the profile of
+    the statement just run there. Not started, the default, capture costs
+    a flag check."""
+
+    def __init__(self):
+        self.active = False
+        self.queries = []
+        self.sampler = None
+
+    def start(self, con, python: bool = False):
+        """Profile the statements run on `con`, and sample the Python stack
+        of the calling thread with `python`."""
+        con.execute("SET enable_profiling = 'no_output'")
+        con.execute("SET profiling_coverage = 'ALL'")
+        self.active = True
+        self.queries = []
+        self.sampler = None
+        if python:
+            self.sampler = StackSampler(
+                threading.get_ident(), PROFILE_SAMPLE_INTERVAL
+            )
+            self.sampler.start()
+
+    def capture(self, con, stage: str):
+        """Keep the profile of the last statement run on `con` as part of
+        `stage`. Cursors of a profiled connection aren't profiled."""
+        if not self.active:
+            return
+        profile = json.loads(con.get_profiling_information(format="json"))
+        if "children" not in profile:
+            return
+        self.queries.append({
+            "stage": stage,
+            "latency": profile.get("latency"),
+            "operators": operator_timings(profile),
+            "profile": profile,
+        })
+
+    def stop(self, con):
+        """Stop profiling `con` and sampling."""
+        self.active = False
+        if self.sampler is not None:
+            self.sampler.stop()
+        con.execute("RESET enable_profiling")
+        con.execute("RESET profiling_coverage")
+
+    def save(self, s3, bucket: str, prefix: str) -> list[str]:
+        """Put the query profiles, and the Python samples if taken, under
+        `prefix` in `bucket` and return their keys."""
+        objects = {
+            "duckdb.json": json.dumps(self.queries, indent=2),
+        }
+        if self.sampler is not None:
+            objects["python.txt"] = self.sampler.collapsed()
+        keys = []
+        for name, body in objects.items():
+            s3.put_object(Bucket=bucket, Key=f"{prefix}/{name}", Body=body)
+            keys.append(f"{prefix}/{name}")
+        return keys
+
+
+PROFILER = Profiler()
+
+
+@contextmanager
+def profiling(config, run_id: str):
+    """Profile the invocation run in it according to `config.profile`, one
+    of PROFILE_MODES, and store the profiles under
+    profiles/`run_id` of the deploy prefix: always, or when the
+    invocation took at least `config.profile_slow_ms` milliseconds."""
+    if config.profile == "off":
+        yield
+        return
+    PROFILER.start(config.con, config.profile_python)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        PROFILER.stop(config.con)
+        if config.profile == "always" or elapsed_ms >= config.profile_slow_ms:
+            try:
+                keys = PROFILER.save(
+                    config.s3,
+                    config.bucket,
+                    f"{config.prefix}/profiles/{run_id}",
+                )
+                print(json.dumps({
+                    "profile_ms": elapsed_ms,
+                    "profile_keys": keys,
+                    "profile_operators": [
+                        {"stage": q["stage"], "operators": q["operators"]}
+                        for q in PROFILER.queries
+                    ],
+                }))
+            except Exception:
+                # a failed save shouldn't fail the invocation
+                traceback.print_exc()
+
+
+def fetch_immutable(s3, bucket: str, key: str, local_path: str) -> str:
+    """Download an object that never changes once written, unless a local
+    copy already exists."""
+    if not os.path.exists(local_path):
+        part_path = f"{local_path}.part"
+        s3.download_file(bucket, key, part_path)
+        os.replace(part_path, local_path)
+    return local_path
+
+
+class ResultLedger:
+    """Results already announced, by `result_key`, under `root`, a local
+    directory or an s3:// prefix. An entry holding the SNS messages of a
+    result is written once they have been published, so a record that is
+    delivered again, replayed from the DLQ or split after running out of
+    memory can have them announced again instead of being compared."""
+
+    def __init__(self, root: str, s3=None):
+        self.root = root.rstrip("/")
+        self.s3 = s3
+        if self.root.startswith("s3://"):
+            self.bucket, _, self.prefix = self.root[5:].partition("/")
+            if self.s3 is None:
+                self.s3 = boto3.client("s3")
+        else:
+            os.makedirs(self.root, exist_ok=True)
+
+    def get(self, key: str) -> list[dict] | None:
+        """SNS messages of the result `key`, None if it isn't recorded."""
+        if self.s3 is None:
+            path = os.path.join(self.root, f"{key}.json")
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                return json.load(f)
+
+        try:
+            res = self.s3.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}/{key}.json"
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(res["Body"].read())
+
+    def put(self, key: str, messages: list[dict]):
+        """Record the SNS messages announcing the result `key`."""
+        body = json.dumps(messages)
+        if self.s3 is None:
+            with open(os.path.join(self.root, f"{key}.json"), "w") as f:
+                f.write(body)
+            return
+        self.s3.put_object(
+            Bucket=self.bucket, Key=f"{self.prefix}/{key}.json", Body=body
+        )
+
+
+def result_key(
+    etags: dict[str, str], subs_version: str, layout: str, chunk_rows: int
+) -> str:
+    """Content address of the result of comparing the tile objects in
+    `etags`, by path, against version `subs_version` of the subscriptions.
+    The output layout and streaming chunk size change what is written, so
+    they are part of it too."""
+    doc = {
+        "tiles": sorted(etags.items()),
+        "subscriptions": subs_version,
+        "layout": layout,
+        "chunk_rows": chunk_rows,
+    }
+    return hashlib.sha256(json.dumps(doc).encode()).hexdigest()
+
+
+class SubscriptionCache:
+    """Local copy of the subscriptions parquet in the Lambda's ephemeral
+    storage. Each fetch is a conditional GET on the object's ETag, so the file
+    is only downloaded again when it has changed in S3."""
+
+    def __init__(self, s3, bucket: str, key: str, cache_dir: str):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        os.makedirs(cache_dir, exist_ok=True)
+        self.local_path = os.path.join(cache_dir, os.path.basename(key))
+        self.etag = None
+        self.hits = 0
+        self.fetches = 0
+
+    def fetch(self) -> str:
+        """Revalidate the local copy and return its path."""
+        kwargs = {}
+        if self.etag is not None and os.path.exists(self.local_path):
+            kwargs["IfNoneMatch"] = self.etag
+        try:
+            res = self.s3.get_object(Bucket=self.bucket, Key=self.key, **kwargs)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in ("304", "NotModified"):
+                self.hits += 1
+                return self.local_path
+            raise
+
+        # write next to the destination and swap so readers never see a
+        # partially written file
+        part_path = f"{self.local_path}.part"
+        with open(part_path, "wb") as f:
+            for chunk in res["Body"].iter_chunks(2**20):
+                f.write(chunk)
+        os.replace(part_path, self.local_path)
+        self.etag = res["ETag"]
+        self.fetches += 1
+        print(
+            f"Subscriptions fetched from s3://{self.bucket}/{self.key} "
+            f"(ETag {self.etag}) to {self.local_path}"
+        )
+        return self.local_path
 
 
 class CloudConfig:
@@ -30,25 +503,47 @@ class CloudConfig:
         self.sns_out_arn = sns_out_arn
         self.bucket = bucket
         self.prefix = prefix
-        sub_key = f"{self.prefix}/subs/subscriptions.parquet"
+        self.subs_key = f"{self.prefix}/subs/subscriptions.parquet"
+
+        self.index_key = f"{self.prefix}/subs/subscriptions.duckdb"
+        self.manifest_key = f"{self.prefix}/subs/cells/{MANIFEST_NAME}"
 
-        self.aois_path = f"s3://{self.bucket}/{sub_key}"
+        self.aois_path = f"s3://{self.bucket}/{self.subs_key}"
+        self.cells_path = f"s3://{self.bucket}/{self.prefix}/subs/cells"
+        self.delta_key = f"{self.prefix}/subs/delta"
+        self.delta_path = f"s3://{self.bucket}/{self.delta_key}"
+        # one file per invocation listing the tile files it processed
+        self.catalog_path = f"s3://{self.bucket}/{self.prefix}/catalog"
+        self.subs_cache = None
+        self.index_cache = None
+        self.manifest_cache = None
+        self.log_cache = None
+        self.json_docs = {}
+        # last HEAD of the flat subscriptions in S3, for their size
+        self.subs_head = None
+        self.subs_index = "off"
+        self.subs_layout = "flat"
         self.cert_path = cert_path
         self.s3_endpoint = s3_endpoint
 
         self.cert_dest = None
         self.tempdir = TempDir(delete=True)
 
-        self.s3 = boto3.client("s3", region_name=self.region, verify=False)
-
         # if CA file exists, grab it from S3 and write it to the temp directory
         if self.cert_path is not None:
             self.cert_dest = f"{self.tempdir.name}/cert.pem"
-            # bypass ssl cert checking until we get it copied in
-            response = self.s3.get_object(Bucket=self.bucket, Key=self.cert_path)
-            cert_content = response["Body"].read()
-            with open(self.cert_dest, "wb") as f:
-                f.write(cert_content)
+            # bypass ssl cert checking until we get it copied in, this client
+            # is only used for the cert
+            cert_s3 = boto3.client(
+                "s3", region_name=self.region, verify=False
+            )
+            with METRICS.stage("cert"):
+                response = cert_s3.get_object(
+                    Bucket=self.bucket, Key=self.cert_path
+                )
+                cert_content = response["Body"].read()
+                with open(self.cert_dest, "wb") as f:
+                    f.write(cert_content)
             print(
                 f"Cert copied from s3://{self.bucket}/{self.cert_path} to "
                 f"{self.cert_dest}"
@@ -58,10 +553,14 @@ class CloudConfig:
         # 2**10 for value of GB here
         shorter = mem_limit / (2**10)
         self.mem_limit = f"{shorter}GB"
+        self.mem_limit_bytes = int(mem_limit) * 2**20
 
         # preliminary usage, will need to be remade after writing the cert
         # if the cert is present, remake the aws clients with it
         if self.cert_dest is not None:
+            self.s3 = boto3.client(
+                "s3", region_name=self.region, verify=self.cert_dest
+            )
             self.sns = boto3.client(
                 "sns", region_name=self.region, verify=self.cert_dest
             )
@@ -70,10 +569,41 @@ class CloudConfig:
             )
             self.using_certs = True
         else:
+            self.s3 = boto3.client("s3", region_name=self.region)
             self.sns = boto3.client("sns", region_name=self.region)
             self.sqs = boto3.client("sqs", region_name=self.region)
             self.using_certs = False
 
+        # MiB of ephemeral storage the out of core compare may spill to, it
+        # is disabled at 0
+        self.spill_limit = 0
+        # tile rows per chunk of the streaming compare, off at 0
+        self.chunk_rows = 0
+        # fan out of records too big to compare, see FANOUT_MODES
+        self.fanout = "off"
+        self.fanout_rows = 100_000
+        self.fanout_workers = 2
+        self.fanout_max_receives = UNIT_MAX_RECEIVES
+        # see OUTPUT_LAYOUTS
+        self.output_layout = "aoi"
+        # SNS messages results may be inlined in instead of S3, off at 0
+        self.inline_messages = 0
+        # ResultLedger of results already announced, if any
+        self.ledger = None
+        # query profiling of invocations, see PROFILE_MODES and `profiling`
+        self.profile = "off"
+        self.profile_slow_ms = 10_000
+        self.profile_python = False
+
+        # SQS queue URLs by queue ARN, looked up once per config
+        self.queue_urls = {}
+        # held while local subscription copies are revalidated, so threads
+        # comparing on copies of the config don't download over each other
+        self.subs_lock = threading.Lock()
+
+        # when kept alive, the DuckDB connection outlives the `with` block so
+        # that warm invocations can reuse it
+        self.keep_alive = False
         self.con = None
 
     def __enter__(self):
@@ -81,24 +611,35 @@ class CloudConfig:
             try:
                 self.con.execute("select 1")
                 return self
-            except duckdb.ConnectionException:
-                pass
+            except duckdb.Error:
+                # connection is unusable, drop it and make a new one
+                self.close_connection()
 
-        con = duckdb.connect()
+        with METRICS.stage("extensions"):
+            # a missing extension fails to load instead of being downloaded
+            # by a query that would autoload it
+            con = duckdb.connect(config={"autoinstall_known_extensions": False})
 
-        # lambdas will automatically write to '/tmp'
-        con.execute(f"SET temp_directory='{self.tempdir.name}'")
+            # lambdas will automatically write to '/tmp'
+            con.execute(f"SET temp_directory='{self.tempdir.name}'")
 
-        con.execute("LOAD httpfs")
-        con.execute("LOAD spatial")
-        con.execute("LOAD aws")
-        con.execute(f"SET memory_limit='{self.mem_limit}'")
+            for extension in DUCKDB_EXTENSIONS:
+                con.execute(f"LOAD {extension}")
+            con.execute(f"SET memory_limit='{self.mem_limit}'")
         if self.s3_endpoint is not None:
+            # a plain http endpoint is a local S3 compatible server, such as
+            # local_aws.LocalS3, which only understands path style requests
+            endpoint = self.s3_endpoint
+            local = ""
+            if endpoint.startswith("http://"):
+                endpoint = endpoint.removeprefix("http://")
+                local = "USE_SSL false, URL_STYLE 'path',"
             ex_str = f"""
                 CREATE SECRET (
                     TYPE S3,
                     REGION '{self.region}',
-                    ENDPOINT '{self.s3_endpoint}',
+                    ENDPOINT '{endpoint}',
+                    {local}
                     PROVIDER CREDENTIAL_CHAIN)
             """
         else:
@@ -108,46 +649,773 @@ class CloudConfig:
                     REGION '{self.region}',
                     PROVIDER CREDENTIAL_CHAIN)
             """
-        con.execute(ex_str)
+        with METRICS.stage("secret"):
+            con.execute(ex_str)
 
         self.con = con
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.con.close()
+        # don't trust a connection that saw an error to serve the next request
+        if not self.keep_alive or exc_type is not None:
+            self.close_connection()
+
+    def enable_subscription_cache(
+        self,
+        cache_dir: str = SUBS_CACHE_DIR,
+        subs_index: str = "off",
+        subs_layout: str = "flat",
+    ):
+        """Read subscriptions from ETag-validated local copies instead of
+        straight from S3. With `subs_index` as 'local' the copy is turned into
+        an R-tree indexed DuckDB database on first use, with 's3' a database
+        published next to the parquet is downloaded instead. With
+        `subs_layout` as 'partitioned' only the grid partition manifest is
+        cached and the compare reads the partitions it needs from S3. With
+        'delta' the log is revalidated and only base and delta files that
+        are new to this container are downloaded."""
+        if subs_index not in SUBS_INDEX_MODES:
+            raise ValueError(
+                f"Invalid subscription index mode {subs_index}, expected one "
+                f"of {SUBS_INDEX_MODES}."
+            )
+        if subs_layout not in SUBS_LAYOUTS:
+            raise ValueError(
+                f"Invalid subscription layout {subs_layout}, expected one "
+                f"of {SUBS_LAYOUTS}."
+            )
+        if subs_layout != "flat" and subs_index != "off":
+            raise ValueError(
+                "Subscription indexes are only supported for the flat layout."
+            )
+        self.subs_index = subs_index
+        self.subs_layout = subs_layout
+        if subs_layout == "partitioned":
+            self.manifest_cache = SubscriptionCache(
+                self.s3, self.bucket, self.manifest_key, cache_dir
+            )
+        elif subs_layout == "delta":
+            self.log_cache = SubscriptionCache(
+                self.s3, self.bucket, f"{self.delta_key}/{DELTA_LOG_NAME}",
+                cache_dir
+            )
+        elif subs_index == "s3":
+            self.index_cache = SubscriptionCache(
+                self.s3, self.bucket, self.index_key, cache_dir
+            )
+        else:
+            self.subs_cache = SubscriptionCache(
+                self.s3, self.bucket, self.subs_key, cache_dir
+            )
+
+    def load_json(self, cache: SubscriptionCache | None, local_path: str):
+        """Parse a JSON document kept up to date by `cache`, only reparsing
+        it when its ETag changes. Without a cache, `local_path` is read."""
+        if cache is None:
+            with open(local_path) as f:
+                return json.load(f)
+
+        path = cache.fetch()
+        etag, doc = self.json_docs.get(cache.key, (None, None))
+        if doc is None or etag != cache.etag:
+            with open(path) as f:
+                doc = json.load(f)
+            self.json_docs[cache.key] = (cache.etag, doc)
+        return doc
+
+    def get_manifest(self) -> dict:
+        """Grid partition manifest of the partitioned subscriptions."""
+        return self.load_json(
+            self.manifest_cache, f"{self.cells_path}/{MANIFEST_NAME}"
+        )
+
+    def get_delta_subscriptions(self) -> DeltaSubscriptions:
+        """Files of the current delta log version. Base and delta files are
+        immutable, so cached copies are reused and only new ones are
+        downloaded."""
+        log = self.load_json(
+            self.log_cache, f"{self.delta_path}/{DELTA_LOG_NAME}"
+        )
+        names = [log["base"]] + [d["path"] for d in log["deltas"]]
+        if self.log_cache is None:
+            paths = [f"{self.delta_path}/{name}" for name in names]
+        else:
+            cache_dir = os.path.dirname(self.log_cache.local_path)
+            paths = [
+                fetch_immutable(
+                    self.s3,
+                    self.bucket,
+                    f"{self.delta_key}/{name}",
+                    os.path.join(cache_dir, name),
+                )
+                for name in names
+            ]
+            # drop files from versions that have been compacted away
+            for name in os.listdir(cache_dir):
+                if name.endswith(".parquet") and name not in names:
+                    os.remove(os.path.join(cache_dir, name))
+
+        versions = [d["version"] for d in log["deltas"]]
+        deltas = list(zip(versions, paths[1:], strict=True))
+        return DeltaSubscriptions(paths[0], log["base_version"], deltas)
+
+    @METRICS.timed("subscriptions")
+    def get_aois_path(self, datapaths: list[str] | None = None):
+        """Path subscriptions should be read from for this invocation. For
+        partitioned subscriptions this is the list of partition files
+        touched by the tiles in `datapaths`, for delta log subscriptions the
+        DeltaSubscriptions of the current version."""
+        with self.subs_lock:
+            return self.find_aois_path(datapaths)
+
+    def find_aois_path(self, datapaths: list[str] | None):
+        """`get_aois_path`, with the subscriptions lock held."""
+        if self.subs_layout == "partitioned":
+            return get_partition_paths(
+                self.con, datapaths, self.get_manifest(), self.cells_path
+            )
+        if self.subs_layout == "delta":
+            return self.get_delta_subscriptions()
+        if self.index_cache is not None:
+            return self.index_cache.fetch()
+        if self.subs_cache is None:
+            return self.aois_path
+
+        local_path = self.subs_cache.fetch()
+        if self.subs_index != "local":
+            return local_path
+
+        # one database per subscription version, keyed by the parquet ETag
+        version = self.subs_cache.etag.strip('"')
+        cache_dir = os.path.dirname(local_path)
+        db_path = os.path.join(cache_dir, f"subscriptions-{version}.duckdb")
+        if not os.path.exists(db_path):
+            build_subscription_index(self.con, local_path, db_path)
+            for name in os.listdir(cache_dir):
+                stale = os.path.join(cache_dir, name)
+                if name.endswith(".duckdb") and stale != db_path:
+                    os.remove(stale)
+        return db_path
+
+    @METRICS.timed("subscriptions")
+    def get_subscriptions(self, datapaths: list[str] | None = None) -> tuple:
+        """`get_aois_path` and the `subscription_version` it points to, from
+        a single revalidation, so a result is keyed by the version of the
+        subscriptions it was compared against."""
+        with self.subs_lock:
+            aois_path = self.find_aois_path(datapaths)
+            return aois_path, self.find_version()
+
+    @METRICS.timed("subscriptions")
+    def subscription_version(self) -> str | None:
+        """Version of the subscriptions the compare reads: the ETag of the
+        object a cache revalidates, the size and modification time of a
+        local file, or the ETag of the manifest, delta log or flat
+        subscriptions in S3. None if it can't be told."""
+        with self.subs_lock:
+            cache = self.version_cache()
+            if cache is not None:
+                cache.fetch()
+            return self.find_version()
+
+    def version_cache(self) -> SubscriptionCache | None:
+        """Cache of the object the subscriptions are versioned by."""
+        if self.subs_layout == "partitioned":
+            return self.manifest_cache
+        if self.subs_layout == "delta":
+            return self.log_cache
+        return self.index_cache or self.subs_cache
+
+    def find_version(self) -> str | None:
+        """`subscription_version`, with the subscriptions lock held and the
+        cache already revalidated."""
+        cache = self.version_cache()
+        if cache is not None:
+            return cache.etag
+
+        if self.subs_layout == "partitioned":
+            local_path = f"{self.cells_path}/{MANIFEST_NAME}"
+            key = self.manifest_key
+        elif self.subs_layout == "delta":
+            local_path = f"{self.delta_path}/{DELTA_LOG_NAME}"
+            key = f"{self.delta_key}/{DELTA_LOG_NAME}"
+        else:
+            local_path = self.aois_path
+            key = self.subs_key
+        if os.path.exists(local_path):
+            stat = os.stat(local_path)
+            return f"{stat.st_mtime_ns}-{stat.st_size}"
+        res = self.head_subscriptions(key)
+        return None if res is None else res["ETag"]
+
+    def head_subscriptions(self, key: str | None = None) -> dict | None:
+        """HEAD `key`, the flat subscriptions in S3 by default, keeping the
+        response for `subscription_bytes` if it is them. None if it can't
+        be found."""
+        key = key or self.subs_key
+        try:
+            res = self.s3.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return None
+        if key == self.subs_key:
+            self.subs_head = res
+        return res
+
+    def subscription_bytes(self) -> int:
+        """Rough size of the subscriptions the compare reads, from local
+        copies where there are some, or else from the size the last HEAD
+        of the subscriptions in S3 saw. Partitioned subscriptions are read a
+        few grid cells at a time and count as nothing, as do delta log
+        subscriptions read from S3."""
+        if self.subs_layout == "partitioned":
+            return 0
+        if self.subs_layout == "delta":
+            if self.log_cache is None:
+                return 0
+            cache_dir = os.path.dirname(self.log_cache.local_path)
+            return sum(
+                os.path.getsize(os.path.join(cache_dir, name))
+                for name in os.listdir(cache_dir)
+                if name.endswith(".parquet")
+            )
+        for cache in (self.index_cache, self.subs_cache):
+            if cache is not None and os.path.exists(cache.local_path):
+                return os.path.getsize(cache.local_path)
+        if os.path.exists(self.aois_path):
+            return os.path.getsize(self.aois_path)
+        if self.subs_head is None and self.head_subscriptions() is None:
+            return 0
+        return self.subs_head["ContentLength"]
+
+    def get_queue_url(self, source_arn: str) -> str:
+        """URL of the SQS queue with ARN `source_arn`."""
+        if source_arn not in self.queue_urls:
+            queue_name = source_arn.split(":")[-1]
+            res = self.sqs.get_queue_url(QueueName=queue_name)
+            self.queue_urls[source_arn] = res["QueueUrl"]
+        return self.queue_urls[source_arn]
+
+    def close_connection(self):
+        """Close the DuckDB connection if one is open."""
+        if self.con is not None:
+            try:
+                self.con.close()
+            except duckdb.Error:
+                pass
         self.con = None
 
+    def close(self):
+        """Release the DuckDB connection and the temporary directory."""
+        self.close_connection()
+        self.tempdir.cleanup()
+
+
+class ConfigCache:
+    """Process-lifetime cache of the CloudConfig used by the handler, so warm
+    Lambda invocations reuse boto3 clients, the certificate and the DuckDB
+    connection. The cached config is replaced when any of the environment
+    values it was built from change."""
+
+    def __init__(self):
+        self.key = None
+        self.config = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, *args, **subs_options) -> tuple[CloudConfig, bool]:
+        """Return a CloudConfig for the given constructor arguments and
+        whether it was reused from a previous invocation. Any `subs_options`
+        are passed on to `CloudConfig.enable_subscription_cache`."""
+        key = (args, tuple(sorted(subs_options.items())))
+        if self.config is not None and self.key == key:
+            self.hits += 1
+            return self.config, True
+
+        self.clear()
+        config = CloudConfig(*args)
+        config.keep_alive = True
+        if subs_options:
+            config.enable_subscription_cache(**subs_options)
+        self.key = key
+        self.config = config
+        self.misses += 1
+        return config, False
+
+    def clear(self):
+        """Close and forget the cached config."""
+        if self.config is not None:
+            self.config.close()
+        self.key = None
+        self.config = None
+
+    def metric(self, warm: bool) -> dict:
+        """Warm hit information for the current invocation."""
+        total = self.hits + self.misses
+        return {
+            "config_cache": "hit" if warm else "miss",
+            "config_cache_hits": self.hits,
+            "config_cache_misses": self.misses,
+            "config_cache_hit_rate": self.hits / total if total else 0.0,
+        }
+
 
-def delete_sqs_message(e, config: CloudConfig):
-    """Remove Message from SQS Queue."""
-    source_arn = e["eventSourceARN"]
-    queue_name = source_arn.split(":")[-1]
-    queue_url = config.sqs.get_queue_url(QueueName=queue_name)["QueueUrl"]
-    receipt_handle = e["receiptHandle"]
-    return config.sqs.delete_message(
-        QueueUrl=queue_url, ReceiptHandle=receipt_handle
+CONFIG_CACHE = ConfigCache()
+# seconds `init` took, and whether no invocation has run in this process
+INIT_SECONDS = 0.0
+COLD_START = True
+
+
+def build_subscription_index(con, aois_path: str, db_path: str):
+    """Materialize subscriptions into a DuckDB database holding the AOIs as
+    native GEOMETRY with an R-tree index, so the compare reads the AOIs
+    within the tiles' extent with an index scan, see `get_aois_relation`,
+    instead of scanning and parsing the parquet."""
+    part_path = f"{db_path}.part"
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+    con.execute(f"ATTACH '{part_path}' AS subs_build")
+    try:
+        con.execute(f"""
+            CREATE TABLE subs_build.aois AS
+            SELECT pk_and_model, geometry::GEOMETRY AS geometry, geometry_bbox,
+                {interior_sql(con, aois_path)} AS interior
+            FROM read_parquet('{aois_path}')
+        """)
+        con.execute(
+            "CREATE INDEX aois_rtree ON subs_build.aois USING RTREE (geometry)"
+        )
+    finally:
+        con.execute("DETACH subs_build")
+    os.replace(part_path, db_path)
+    print(f"Subscription index built from {aois_path} at {db_path}")
+    return db_path
+
+
+def grid_index_sql(coord: str, offset: int, count: int, cell_size: float):
+    """SQL expression for the index of the grid row or column holding the
+    coordinate `coord`, clamped to the grid."""
+    return (
+        f"least(greatest(floor(({coord} + {offset}) / {cell_size}), 0), "
+        f"{count - 1})::BIGINT"
     )
 
 
-def get_data_paths(sqs_event):
-    """Process SQS events and return a list of paths to Tile Parquet in S3."""
+def grid_cells_sql(bbox: str, cell_size: float) -> str:
+    """SQL expression for the list of ids of the grid cells that the bbox
+    struct column `bbox` touches. Cells are `cell_size` degrees square and
+    numbered row-major from (-180, -90)."""
+    ncols = ceil(360 / cell_size)
+    nrows = ceil(180 / cell_size)
+
+    def index(coord, offset, count):
+        return grid_index_sql(f"{bbox}.{coord}", offset, count, cell_size)
+
+    return f"""flatten(list_transform(
+        range({index("ymin", 90, nrows)}, {index("ymax", 90, nrows)} + 1),
+        lambda iy: list_transform(
+            range({index("xmin", 180, ncols)}, {index("xmax", 180, ncols)} + 1),
+            lambda ix: iy * {ncols} + ix
+        )
+    ))"""
+
+
+def grid_cell_sql(x: str, y: str, cell_size: float) -> str:
+    """SQL expression for the id of the grid cell holding the point (x, y),
+    numbered as in `grid_cells_sql`."""
+    ncols = ceil(360 / cell_size)
+    nrows = ceil(180 / cell_size)
+    iy = grid_index_sql(y, 90, nrows, cell_size)
+    ix = grid_index_sql(x, 180, ncols, cell_size)
+    return f"{iy} * {ncols} + {ix}"
+
+
+def get_partition_paths(
+    con, datapaths: list[str], manifest: dict, cells_path: str
+) -> list[str]:
+    """Partition files of the subscriptions in grid cells touched by the
+    tiles in `datapaths`."""
+    cells = grid_cells_sql("geometry_bbox", manifest["cell_size"])
+    touched = con.execute(f"""
+        SELECT DISTINCT unnest({cells}) AS cell
+        FROM read_parquet({datapaths})
+    """).fetchall()
+    paths = []
+    for (cell,) in sorted(touched):
+        for part in manifest["cells"].get(str(cell), []):
+            paths.append(f"{cells_path}/{part}")
+    print(
+        f"Reading {len(paths)} subscription partition files for "
+        f"{len(touched)} grid cells."
+    )
+    return paths
+
+
+@METRICS.timed("extent")
+def get_tiles_extent(con, datapaths: list[str] | str):
+    """Bounding box (xmin, ymin, xmax, ymax) of every tile in `datapaths`, or
+    in a relation of tiles, read from the bbox covering columns only. None
+    if there are no tiles."""
+    if isinstance(datapaths, list):
+        datapaths = f"read_parquet({datapaths})"
+    extent = con.execute(f"""
+        SELECT
+            min(geometry_bbox.xmin), min(geometry_bbox.ymin),
+            max(geometry_bbox.xmax), max(geometry_bbox.ymax)
+        FROM {datapaths}
+    """).fetchone()
+    PROFILER.capture(con, "extent")
+    if extent is None or extent[0] is None:
+        return None
+    return extent
+
+
+def plan_tile_chunks(
+    con, datapaths: list[str], chunk_rows: int
+) -> list[list[tuple[str, int, int]]]:
+    """Split the tiles in `datapaths` into chunks of whole row groups of at
+    most `chunk_rows` rows, a bigger row group being a chunk of its own.
+    Each chunk is a list of (path, first row, end row) ranges, read from the
+    parquet footers."""
+    groups = con.execute(
+        """
+        SELECT DISTINCT file_name, row_group_id, row_group_num_rows
+        FROM parquet_metadata(?)
+        ORDER BY file_name, row_group_id
+        """,
+        [datapaths],
+    ).fetchall()
+
+    chunks = []
+    chunk = []
+    rows = 0
+    offsets = {}
+    for path, _, num_rows in groups:
+        start = offsets.get(path, 0)
+        offsets[path] = start + num_rows
+        if chunk and rows + num_rows > chunk_rows:
+            chunks.append(chunk)
+            chunk = []
+            rows = 0
+        if chunk and chunk[-1][0] == path and chunk[-1][2] == start:
+            chunk[-1] = (path, chunk[-1][1], start + num_rows)
+        else:
+            chunk.append((path, start, start + num_rows))
+        rows += num_rows
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def tile_chunk_sql(chunk: list[tuple[str, int, int]]) -> str:
+    """SQL relation for the tiles in the row ranges of a chunk. Filters on
+    the file row number skip the row groups outside the ranges."""
+    ranges = [
+        f"""
+            SELECT pk_and_model, geometry, geometry_bbox
+            FROM read_parquet('{path}', file_row_number = true)
+            WHERE file_row_number >= {start} AND file_row_number < {end}
+        """
+        for path, start, end in chunk
+    ]
+    return f"({'UNION ALL'.join(ranges)})"
+
+
+def interior_sql(con, paths: str | list[str]) -> str:
+    """Column expression for the interior rectangles of the subscriptions
+    in `paths`, NULL unless every file has them."""
+    (missing,) = con.execute(
+        """
+        SELECT count(*) FILTER (NOT list_contains(names, 'interior'))
+        FROM (
+            SELECT list(name) AS names
+            FROM parquet_schema(?)
+            GROUP BY file_name
+        )
+        """,
+        [paths],
+    ).fetchone()
+    return "interior" if missing == 0 else NO_INTERIOR
+
+
+def delta_merge_sql(
+    subs: DeltaSubscriptions, where: str = "", interiors: dict | None = None
+) -> str:
+    """SQL for the current subscriptions of a delta log: the base with each
+    delta applied in version order. The rows of the latest version of each
+    AOI win, all of its pieces if it was subdivided, and AOIs whose latest
+    version is a remove are dropped. `where` filters the base and
+    the merged result, deltas are read whole so that a change outside the
+    filter still hides the base row it replaces. `interiors` maps the files
+    that have interior rectangles to their column expression."""
+    interiors = interiors or {}
+
+    def interior(path):
+        return interiors.get(path, NO_INTERIOR)
+
+    rows = [f"""
+        SELECT pk_and_model, geometry::GEOMETRY AS geometry, geometry_bbox,
+            {interior(subs.base)} AS interior,
+            'add' AS op, {subs.base_version} AS version
+        FROM read_parquet('{subs.base}')
+        {where}
+    """]
+    for version, path in subs.deltas:
+        rows.append(f"""
+            SELECT pk_and_model, geometry::GEOMETRY AS geometry, geometry_bbox,
+                {interior(path)} AS interior, op, {version} AS version
+            FROM read_parquet('{path}')
+        """)
+    return f"""(
+            SELECT pk_and_model, geometry, geometry_bbox, interior
+            FROM (
+                SELECT *
+                FROM ({"UNION ALL".join(rows)})
+                QUALIFY version = max(version) OVER (
+                    PARTITION BY pk_and_model
+                )
+            )
+            WHERE op = 'add'
+            {where.replace("WHERE", "AND", 1)}
+        )"""
+
+
+def get_aois_relation(
+    con, aois_path: str | list[str] | DeltaSubscriptions, extent=None
+) -> str:
+    """SQL relation for the subscriptions at `aois_path`, attaching the
+    database read-only if it is an indexed subscriptions database. AOIs
+    outside `extent` are filtered in the scan: for parquet row groups whose
+    bbox statistics miss the tiles are skipped entirely, in an indexed
+    database the AOIs intersecting the extent are found with an R-tree index
+    scan."""
+    if isinstance(aois_path, str) and aois_path.endswith(".duckdb"):
+        attached = con.execute(
+            "SELECT path FROM duckdb_databases() WHERE database_name = 'subs'"
+        ).fetchall()
+        if attached and attached[0][0] != aois_path:
+            con.execute("DETACH subs")
+            attached = []
+        if not attached:
+            con.execute(f"ATTACH '{aois_path}' AS subs (READ_ONLY)")
+        aois = "subs.aois"
+        if extent is not None:
+            # tile bboxes are float32, widen the extent by their rounding
+            pad = max(map(abs, extent)) * 2**-20
+            xmin, ymin, xmax, ymax = extent
+            # only a constant geometry lets DuckDB scan the index
+            aois = f"""(
+                SELECT * FROM subs.aois
+                WHERE ST_Intersects(geometry, ST_MakeEnvelope(
+                    {xmin - pad}, {ymin - pad}, {xmax + pad}, {ymax + pad}
+                ))
+            )"""
+        (has_interior,) = con.execute("""
+            SELECT count(*) > 0 FROM duckdb_columns()
+            WHERE database_name = 'subs' AND table_name = 'aois'
+                AND column_name = 'interior'
+        """).fetchone()
+        if not has_interior:
+            # built before subscriptions had interior rectangles
+            return f"(SELECT *, {NO_INTERIOR} AS interior FROM {aois})"
+        return aois
+
+    where = ""
+    if extent is not None:
+        xmin, ymin, xmax, ymax = extent
+        where = f"""WHERE geometry_bbox.xmax >= {xmin}
+                AND geometry_bbox.xmin <= {xmax}
+                AND geometry_bbox.ymax >= {ymin}
+                AND geometry_bbox.ymin <= {ymax}"""
+
+    if isinstance(aois_path, DeltaSubscriptions):
+        paths = [aois_path.base] + [path for _, path in aois_path.deltas]
+        interiors = {path: interior_sql(con, path) for path in paths}
+        return delta_merge_sql(aois_path, where, interiors)
+    interior = interior_sql(con, aois_path)
+    if isinstance(aois_path, list):
+        # AOIs are copied into every cell they touch, keep one of each, or
+        # of each piece for AOIs published in pieces
+        return f"""(
+            SELECT DISTINCT ON (pk_and_model, geometry_bbox)
+                pk_and_model, geometry, geometry_bbox, {interior} AS interior
+            FROM read_parquet({aois_path})
+            {where}
+        )"""
+    return f"""(
+            SELECT pk_and_model, geometry, geometry_bbox,
+                {interior} AS interior
+            FROM read_parquet('{aois_path}')
+            {where}
+        )"""
+
+
+@METRICS.timed("delete")
+def delete_sqs_messages(events: list[dict], config: CloudConfig) -> list:
+    """Remove processed Messages from their SQS Queues in batches. Returns
+    the entries SQS failed to delete, those messages will be redelivered
+    once their visibility timeout expires."""
+    by_queue = {}
+    for e in events:
+        by_queue.setdefault(e["eventSourceARN"], []).append(e)
+
+    failed = []
+    for source_arn, queue_events in by_queue.items():
+        queue_url = config.get_queue_url(source_arn)
+        for start in range(0, len(queue_events), SQS_BATCH):
+            batch = queue_events[start : start + SQS_BATCH]
+            entries = [
+                {"Id": str(n), "ReceiptHandle": e["receiptHandle"]}
+                for n, e in enumerate(batch)
+            ]
+            res = config.sqs.delete_message_batch(
+                QueueUrl=queue_url, Entries=entries
+            )
+            failed = failed + res.get("Failed", [])
+    if failed:
+        print(f"Failed to delete SQS messages: {json.dumps(failed)}")
+    return failed
+
+
+def sqs_records(messages: list[dict], queue_arn: str, region: str) -> list:
+    """Lambda SQS event records of `messages` as `receive_message` returns
+    them, for running the handler on messages received outside of Lambda."""
+    return [
+        {
+            "messageId": message["MessageId"],
+            "receiptHandle": message["ReceiptHandle"],
+            "body": message["Body"],
+            "attributes": message.get("Attributes", {}),
+            "messageAttributes": {},
+            "eventSource": "aws:sqs",
+            "eventSourceARN": queue_arn,
+            "awsRegion": region,
+        }
+        for message in messages
+    ]
+
+
+def get_data_files(sqs_event) -> list[tuple[str, int]]:
+    """Process SQS events and return the paths to Tile Parquet in S3 with
+    their sizes in bytes, 0 where the S3 event doesn't carry one."""
     body = json.loads(sqs_event["body"])
     message = json.loads(body["Message"])
     # skip TestEvent
-    paths = []
+    files = []
     if "Event" not in message or message["Event"] != "s3:TestEvent":
         for sns_event in message["Records"]:
             s3_info = sns_event["s3"]
             bucket = s3_info["bucket"]["name"]
             key = s3_info["object"]["key"]
             path = f"s3://{bucket}/{key}"
-            paths.append(path)
-    return paths
+            files.append((path, s3_info["object"].get("size", 0)))
+    return files
+
+
+def get_data_paths(sqs_event):
+    """Process SQS events and return a list of paths to Tile Parquet in S3."""
+    return [path for path, _ in get_data_files(sqs_event)]
+
+
+def get_data_etags(sqs_event) -> dict[str, str]:
+    """ETags of the Tile Parquet objects of an SQS event by path, for the
+    S3 events that carry one."""
+    body = json.loads(sqs_event["body"])
+    message = json.loads(body["Message"])
+    etags = {}
+    for sns_event in message.get("Records", []):
+        s3_info = sns_event["s3"]
+        etag = s3_info["object"].get("eTag")
+        if etag:
+            bucket = s3_info["bucket"]["name"]
+            etags[f"s3://{bucket}/{s3_info['object']['key']}"] = etag
+    return etags
+
+
+def estimate_record_bytes(events: list[dict], config: CloudConfig) -> list:
+    """Estimated compare working set of the tiles in each SQS record, from
+    the object sizes in the S3 events and the row counts in the parquet
+    footers. Records that can't be parsed are estimated at 0, comparing
+    them will raise the error."""
+    files = []
+    for sqs_event in events:
+        try:
+            files.append(get_data_files(sqs_event))
+        except Exception:
+            files.append([])
+
+    paths = [path for record_files in files for path, _ in record_files]
+    rows = {}
+    if paths:
+        try:
+            rows = dict(
+                config.con.execute(
+                    "SELECT file_name, num_rows FROM parquet_file_metadata(?)",
+                    [paths],
+                ).fetchall()
+            )
+        except duckdb.Error as e:
+            print(f"Estimating from object sizes only, no footers: {e}")
+
+    return [
+        sum(
+            size * TILE_BYTES_FACTOR + rows.get(path, 0) * JOIN_ROW_BYTES
+            for path, size in record_files
+        )
+        for record_files in files
+    ]
+
+
+def plan_groups(sizes: list[int], budget: int) -> list[list[int]]:
+    """Pack items of the given `sizes` into as few groups as possible whose
+    total stays within `budget`, first fit decreasing. Items bigger than the
+    budget get a group of their own. Returns the item indexes of each group
+    in their original order."""
+    groups = []
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        for group in groups:
+            if group[0] + sizes[i] <= budget:
+                group[0] += sizes[i]
+                group[1].append(i)
+                break
+        else:
+            groups.append([sizes[i], [i]])
+    return sorted(sorted(indexes) for _, indexes in groups)
+
+
+@METRICS.timed("plan")
+def plan_record_groups(events: list[dict], config: CloudConfig) -> list:
+    """Split SQS records into groups whose estimated working set, on top of
+    the subscriptions, fits in the DuckDB memory limit. The streaming
+    compare bounds memory by chunk instead, so records stay together."""
+    if config.chunk_rows > 0:
+        return [events]
+    subs_bytes = config.subscription_bytes() * SUBS_BYTES_FACTOR
+    budget = max(
+        config.mem_limit_bytes * MEMORY_BUDGET - subs_bytes,
+        config.mem_limit_bytes * MIN_TILE_BUDGET,
+    )
+    sizes = estimate_record_bytes(events, config)
+    groups = plan_groups(sizes, budget)
+    print(
+        f"Planned {len(events)} records into {len(groups)} groups for an "
+        f"estimated {sum(sizes)} bytes of tiles and {subs_bytes} bytes of "
+        "subscriptions."
+    )
+    return [[events[i] for i in group] for group in groups]
 
 
-def get_pass_res(dpaths: list[str], output_path: str):
-    """Create SNS success message information on impacted AOIS. If the message
-    is too large, recursively split the AOI impact list until it fits."""
+def get_pass_res(
+    dpaths: list[str],
+    output_path: str,
+    parts: list[str] | None = None,
+    layout: str = "aoi",
+):
+    """Create SNS success message information on impacted AOIS written to
+    `output_path`, see `get_inline_res` for results in the message itself.
+    For a streaming compare `output_path` is the run's prefix and `parts`
+    lists the output files under it. `layout` is the output layout written,
+    see `OUTPUT_LAYOUTS`."""
 
     res = {
         "MessageAttributes": {
@@ -159,13 +1427,102 @@ def get_pass_res(dpaths: list[str], output_path: str):
                 "DataType": "String",
                 "StringValue": output_path,
             },
+            "output_layout": {"DataType": "String", "StringValue": layout},
             "status": {"DataType": "String", "StringValue": "succeeded"},
         },
         "Message": "succeeded",
     }
+    if parts is not None:
+        res["MessageAttributes"]["s3_output_parts"] = {
+            "DataType": "String",
+            "StringValue": json.dumps(parts),
+        }
     return res
 
 
+def get_inline_res(
+    dpaths: list[str], rows: list, layout: str, part: int, parts: int
+):
+    """Create SNS success message carrying `rows` of a result in `layout` as
+    compact JSON `[aois, tiles]` pairs, the `part` of `parts` messages the
+    result was split into."""
+    return {
+        "MessageAttributes": {
+            "source_files": {
+                "DataType": "String",
+                "StringValue": json.dumps(dpaths),
+            },
+            "inline_part": {
+                "DataType": "String",
+                "StringValue": json.dumps([part, parts]),
+            },
+            "output_layout": {"DataType": "String", "StringValue": layout},
+            "status": {"DataType": "String", "StringValue": "succeeded"},
+        },
+        "Message": json.dumps(rows, separators=(",", ":")),
+    }
+
+
+def message_bytes(res: dict) -> int:
+    """Size of an SNS message as counted against MAX_MSG_BYTES: the body
+    and the names, types and values of its attributes."""
+    size = len(res["Message"].encode())
+    for name, attr in res["MessageAttributes"].items():
+        size += len(name.encode()) + len(attr["DataType"].encode())
+        size += len(attr["StringValue"].encode())
+    return size
+
+
+def publish_messages(sns_messages: list[dict], config: CloudConfig):
+    """Announce results on the output topic, counting the messages and
+    their bytes in METRICS."""
+    with METRICS.stage("publish"):
+        for sns_message in sns_messages:
+            config.sns.publish(TopicArn=config.sns_out_arn, **sns_message)
+    if METRICS.enabled:
+        METRICS.add({
+            "messages_published": len(sns_messages),
+            "message_bytes": sum(message_bytes(m) for m in sns_messages),
+        })
+
+
+def inline_results(
+    con,
+    dpaths: list[str],
+    output_path: str,
+    layout: str = "aoi",
+    max_messages: int = INLINE_MAX_MESSAGES,
+) -> list[dict] | None:
+    """SNS success messages carrying the result written to `output_path`,
+    split across at most `max_messages` messages under MAX_MSG_BYTES. None
+    if it doesn't fit, it is then published to S3 instead."""
+    if os.path.getsize(output_path) > max_messages * MAX_MSG_BYTES:
+        # the JSON is bigger than the compressed parquet
+        return None
+    rows = con.execute(
+        f"SELECT aois, tiles FROM read_parquet('{output_path}')"
+    ).fetchall()
+    empty = get_inline_res(dpaths, [], layout, max_messages, max_messages)
+    budget = MAX_MSG_BYTES - message_bytes(empty)
+
+    chunks = [[]]
+    size = len(empty["Message"])
+    for row in rows:
+        # the row and the comma before it
+        row_bytes = len(json.dumps(row, separators=(",", ":")).encode()) + 1
+        if size + row_bytes > budget and chunks[-1]:
+            chunks.append([])
+            size = len(empty["Message"])
+        if size + row_bytes > budget or len(chunks) > max_messages:
+            return None
+        chunks[-1].append(row)
+        size += row_bytes
+    return [
+        get_inline_res(dpaths, chunk, layout, n, len(chunks))
+        for n, chunk in enumerate(chunks)
+    ]
+
+
 def get_fail_res(dpaths: list[str], err_str: str):
     """Create SNS failed message with error information and source files."""
     res = {
@@ -182,33 +1539,677 @@ def get_fail_res(dpaths: list[str], err_str: str):
     return res
 
 
-def apply_compare(datapaths: list[str], config, outpath):
-    """Perform DuckDB Intersect on Tiles and Subscriptions and return DuckDB
-    Relation object."""
-    sql = f"""
-        COPY (
-            SELECT aois.pk_and_model AS aois, list(tiles.pk_and_model) AS tiles
-            FROM read_parquet('{config.aois_path}') AS aois
-            JOIN read_parquet({datapaths}) AS tiles
-            ON (
+# tiles whose bbox is inside the AOI's interior rectangle intersect it, the
+# exact predicate only runs for the tiles near the boundary
+INTERIOR_ACCEPT = """coalesce(
+                tiles.geometry_bbox.xmin >= aois.interior.xmin AND
+                tiles.geometry_bbox.xmax <= aois.interior.xmax AND
+                tiles.geometry_bbox.ymin >= aois.interior.ymin AND
+                tiles.geometry_bbox.ymax <= aois.interior.ymax,
+                false
+            )"""
+
+BBOX_JOIN = f"""(
                 aois.geometry_bbox.xmin <= tiles.geometry_bbox.xmax AND
                 aois.geometry_bbox.xmax >= tiles.geometry_bbox.xmin AND
                 aois.geometry_bbox.ymin <= tiles.geometry_bbox.ymax AND
                 aois.geometry_bbox.ymax >= tiles.geometry_bbox.ymin
             )
-            AND ST_Intersects(aois.geometry, tiles.geometry)
-            GROUP BY aois.pk_and_model
+            AND (
+                {INTERIOR_ACCEPT}
+                OR ST_Intersects(aois.geometry, tiles.geometry)
+            )"""
+
+
+def output_sql(
+    pairs: str, layout: str = "aoi", keys: tuple[str, str] | None = None
+) -> str:
+    """Query writing the (aoi, tile) rows of relation `pairs` in `layout`,
+    as `aois` and `tiles` columns with the grouped side a list: tiles per
+    AOI, AOIs per tile, or one row per pair. An AOI published in pieces can
+    match a tile more than once, the pair is written once.
+
+    With `keys`, the AOI and tile key tables of `key_ids_sql`, the pairs
+    hold integer ids and are deduplicated and grouped on those, the keys
+    are only looked up for the output."""
+    if keys is not None:
+        return keyed_output_sql(pairs, layout, *keys)
+    if layout == "aoi":
+        return f"""
+            SELECT aoi AS aois, list(DISTINCT tile) AS tiles
+            FROM {pairs}
+            GROUP BY aoi
+        """
+    if layout == "tile":
+        return f"""
+            SELECT tile AS tiles, list(DISTINCT aoi) AS aois
+            FROM {pairs}
+            GROUP BY tile
+        """
+    if layout == "pairs":
+        return f"SELECT DISTINCT aoi AS aois, tile AS tiles FROM {pairs}"
+    raise ValueError(
+        f"Invalid output layout {layout}, expected one of {OUTPUT_LAYOUTS}."
+    )
+
+
+def keyed_output_sql(
+    pairs: str, layout: str, aoi_keys: str, tile_keys: str
+) -> str:
+    """`output_sql` for pairs of integer ids, see `key_ids_sql`."""
+    ids = f"""
+        (SELECT DISTINCT aoi, tile FROM {pairs}) AS ids
+        JOIN {aoi_keys} AS aoi_keys ON aoi_keys.id = ids.aoi
+        JOIN {tile_keys} AS tile_keys ON tile_keys.id = ids.tile
+    """
+    if layout == "aoi":
+        return f"""
+            SELECT any_value(aoi_keys.key) AS aois,
+                list(tile_keys.key) AS tiles
+            FROM {ids}
+            GROUP BY ids.aoi
+        """
+    if layout == "tile":
+        return f"""
+            SELECT any_value(tile_keys.key) AS tiles,
+                list(aoi_keys.key) AS aois
+            FROM {ids}
+            GROUP BY ids.tile
+        """
+    if layout == "pairs":
+        return f"SELECT aoi_keys.key AS aois, tile_keys.key AS tiles FROM {ids}"
+    raise ValueError(
+        f"Invalid output layout {layout}, expected one of {OUTPUT_LAYOUTS}."
+    )
+
+
+def key_ids_sql(relation: str) -> str:
+    """SQL numbering the distinct keys of `relation` with dense integer
+    ids, so the join and aggregation carry integers instead of the
+    free-form key strings."""
+    return f"""
+        SELECT row_number() OVER () AS id, key
+        FROM (SELECT DISTINCT key FROM {relation})
+    """
+
+
+def write_pairs(
+    con,
+    pairs: str,
+    outpath: str,
+    layout: str = "aoi",
+    keys: tuple[str, str] | None = None,
+) -> dict:
+    """Write the `pairs` query of (aoi, tile, fast) rows to `outpath` in
+    `layout`, see `output_sql`, streaming them through the join. With
+    `keys` the pairs are integer ids into those key tables. With metrics
+    enabled the pairs and those accepted by their interior rectangle are
+    counted too, which runs the join a second time, and the counters are
+    returned."""
+    output = output_sql(f"({pairs})", layout, keys)
+    with METRICS.stage("join"):
+        written = con.execute(f"""
+            COPY ({output})
+            TO '{outpath}'
+            (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE 100_000)
+        """).fetchone()[0]
+    PROFILER.capture(con, "join")
+    METRICS.sample_memory(con)
+    METRICS.add({"output_rows": written})
+    if not METRICS.enabled:
+        return {}
+    with METRICS.stage("count"):
+        total, fast = con.execute(
+            f"SELECT count(*), count(*) FILTER (fast) FROM ({pairs})"
+        ).fetchone()
+    counters = {"compare_pairs": total, "compare_fast_pairs": fast}
+    print(json.dumps(counters))
+    METRICS.add(counters)
+    return counters
+
+
+def unique_geometries_sql(
+    relation: str, key_ids: str | None = None, columns: str = ""
+) -> str:
+    """SQL for the distinct geometries of `relation` with the list of key
+    ids of the rows that have each, and `columns` that follow from the
+    geometry. The ids are looked up in the `key_ids` table if there is
+    one, otherwise every row has a key of its own and its `id` is used."""
+    if key_ids is None:
+        return f"""
+            SELECT geometry, any_value(geometry_bbox) AS geometry_bbox,
+                {columns} list(id) AS keys
+            FROM {relation}
+            GROUP BY geometry
+        """
+    return f"""
+        SELECT geometry, any_value(geometry_bbox) AS geometry_bbox,
+            {columns} list(key_ids.id) AS keys
+        FROM {relation} AS geoms
+        JOIN {key_ids} AS key_ids ON key_ids.key = geoms.key
+        GROUP BY geometry
+    """
+
+
+def write_intersects(
+    con,
+    aois: str,
+    tiles: str,
+    outpath: str,
+    layout: str = "aoi",
+) -> dict:
+    """Write the intersections of the `aois` and `tiles` relations to
+    `outpath` in `layout`, by default one row per AOI with the list of tile
+    keys. Pairs are accepted by interior rectangle where possible, see
+    `write_pairs`.
+
+    Tiles re-ingested with a new model and AOIs shared by subscriptions
+    repeat geometries, so the join runs over distinct geometries and the
+    pairs are expanded back to keys afterwards. Each side is read once
+    into a temporary table and its keys are numbered, so the expansion,
+    deduplication and grouping of the pairs work on integers. Rows are
+    numbered as they are read, and where every row has its own key the
+    table is cut down to the ids and keys once its geometries are grouped.
+    Only a side that repeats keys, like the pieces of a subdivided AOI,
+    gets a separate table of its distinct keys, see `key_ids_sql`. The row
+    and geometry counts of both sides are added to the counters."""
+    sides = {"aoi": aois, "tile": tiles}
+    columns = {"aoi": "any_value(interior) AS interior,", "tile": ""}
+    kept = {
+        "aoi": ["geometry", "geometry_bbox", "interior"],
+        "tile": ["geometry", "geometry_bbox"],
+    }
+    try:
+        for side, relation in sides.items():
+            with METRICS.stage("dedup"):
+                # the relations read S3 and merge deltas, only do it once
+                con.execute(f"""
+                    CREATE OR REPLACE TEMP TABLE {side}_rows AS
+                    SELECT row_number() OVER () AS id, pk_and_model AS key,
+                        {", ".join(kept[side])}
+                    FROM {relation}
+                """)
+                (unique,) = con.execute(
+                    f"SELECT count(DISTINCT key) = count(*) FROM {side}_rows"
+                ).fetchone()
+                key_ids = None
+                if not unique:
+                    key_ids = f"{side}_keys"
+                    con.execute(f"""
+                        CREATE OR REPLACE TEMP TABLE {key_ids} AS
+                        {key_ids_sql(f"{side}_rows")}
+                    """)
+                PROFILER.capture(con, "dedup")
+                query = unique_geometries_sql(
+                    f"{side}_rows", key_ids, columns[side]
+                )
+                con.execute(
+                    f"CREATE OR REPLACE TEMP TABLE {side}_geoms AS {query}"
+                )
+                PROFILER.capture(con, "dedup")
+                if unique:
+                    # the rows are the key table once the geometries go
+                    for column in kept[side]:
+                        con.execute(
+                            f"ALTER TABLE {side}_rows DROP COLUMN {column}"
+                        )
+                    con.execute(
+                        f"ALTER TABLE {side}_rows RENAME TO {side}_keys"
+                    )
+                else:
+                    con.execute(f"DROP TABLE {side}_rows")
+        dedup = {}
+        for side in sides:
+            geoms, rows = con.execute(
+                f"SELECT count(*), coalesce(sum(len(keys)), 0) "
+                f"FROM {side}_geoms"
+            ).fetchone()
+            dedup[f"compare_{side}_rows"] = rows
+            dedup[f"compare_{side}_geometries"] = geoms
+        print(json.dumps(dedup))
+        METRICS.add(dedup)
+        counters = write_pairs(
+            con,
+            f"""
+                SELECT unnest(aoi_keys) AS aoi, tile, fast
+                FROM (
+                    SELECT aois.keys AS aoi_keys, unnest(tiles.keys) AS tile,
+                        {INTERIOR_ACCEPT} AS fast
+                    FROM aoi_geoms AS aois
+                    JOIN tile_geoms AS tiles
+                    ON {BBOX_JOIN}
+                )
+            """,
+            outpath,
+            layout,
+            ("aoi_keys", "tile_keys"),
+        )
+    finally:
+        for side in sides:
+            con.execute(f"DROP TABLE IF EXISTS {side}_rows")
+            con.execute(f"DROP TABLE IF EXISTS {side}_keys")
+            con.execute(f"DROP TABLE IF EXISTS {side}_geoms")
+    return counters | dedup
+
+
+def write_intersects_out_of_core(
+    con,
+    aois: str,
+    tiles: str,
+    outpath: str,
+    spill_limit: int,
+    cell_size: float = SPILL_CELL_SIZE,
+    layout: str = "aoi",
+) -> dict:
+    """Write the same output as `write_intersects` with a plan DuckDB can
+    spill to disk, using at most `spill_limit` MiB of temporary storage.
+
+    The spatial join keeps its R-tree in memory, so candidates are found
+    with a hash equi-join on the grid cells touched by both bboxes instead,
+    keys only. Each candidate pair is kept in the cell holding the lower
+    left corner of the bbox intersection so it is tested once. Geometries
+    are joined back by key and bbox, which tells the pieces of an AOI
+    apart, for ST_Intersects, unless the tile is inside the
+    AOI's interior rectangle, and the joins and aggregation are hash based
+    and spill when they outgrow the memory limit. Out of core compares run
+    one at a time, see `SPILL_LOCK`."""
+    cells = grid_cells_sql("geometry_bbox", cell_size)
+    corner = grid_cell_sql(
+        "greatest(a.geometry_bbox.xmin, t.geometry_bbox.xmin)",
+        "greatest(a.geometry_bbox.ymin, t.geometry_bbox.ymin)",
+        cell_size,
+    )
+    with SPILL_LOCK:
+        con.execute("SET preserve_insertion_order = false")
+        con.execute(f"SET max_temp_directory_size = '{spill_limit}MiB'")
+        try:
+            return write_pairs(
+                con,
+                f"""
+                    WITH candidates AS (
+                        SELECT a.pk_and_model AS aoi,
+                            a.geometry_bbox AS aoi_bbox,
+                            t.pk_and_model AS tile
+                        FROM (
+                            SELECT pk_and_model, geometry_bbox,
+                                unnest({cells}) AS cell
+                            FROM {aois}
+                        ) AS a
+                        JOIN (
+                            SELECT pk_and_model, geometry_bbox,
+                                unnest({cells}) AS cell
+                            FROM {tiles}
+                        ) AS t
+                        ON a.cell = t.cell
+                        WHERE a.geometry_bbox.xmin <= t.geometry_bbox.xmax
+                            AND a.geometry_bbox.xmax >= t.geometry_bbox.xmin
+                            AND a.geometry_bbox.ymin <= t.geometry_bbox.ymax
+                            AND a.geometry_bbox.ymax >= t.geometry_bbox.ymin
+                            AND a.cell = {corner}
+                    )
+                    SELECT candidates.aoi, candidates.tile,
+                        {INTERIOR_ACCEPT} AS fast
+                    FROM candidates
+                    JOIN {aois} AS aois ON aois.pk_and_model = candidates.aoi
+                        AND aois.geometry_bbox = candidates.aoi_bbox
+                    JOIN {tiles} AS tiles
+                        ON tiles.pk_and_model = candidates.tile
+                    WHERE {INTERIOR_ACCEPT}
+                        OR ST_Intersects(aois.geometry, tiles.geometry)
+                """,
+                outpath,
+                layout,
+            )
+        finally:
+            con.execute("RESET preserve_insertion_order")
+            con.execute("RESET max_temp_directory_size")
+
+
+def write_empty_intersects(con, outpath: str, layout: str = "aoi"):
+    """Write an intersects file in `layout` with no rows."""
+    pairs = "(SELECT NULL::VARCHAR AS aoi, NULL::VARCHAR AS tile LIMIT 0)"
+    con.execute(f"""
+        COPY ({output_sql(pairs, layout)})
+        TO '{outpath}'
+        (FORMAT parquet, COMPRESSION zstd)
+    """)
+
+
+@METRICS.timed("catalog")
+def write_tile_catalog(con, datapaths: list[str], catalog_file: str):
+    """Record the tile files in `datapaths` with their extent and the time
+    they were processed, so subscriptions added later can be backfilled
+    against them."""
+    con.execute(f"""
+        COPY (
+            SELECT
+                filename AS key,
+                {{
+                    'xmin': min(geometry_bbox.xmin),
+                    'ymin': min(geometry_bbox.ymin),
+                    'xmax': max(geometry_bbox.xmax),
+                    'ymax': max(geometry_bbox.ymax)
+                }} AS bbox,
+                count(*) AS tiles,
+                now() AS ingested_at
+            FROM read_parquet({datapaths}, filename = true)
+            GROUP BY filename
         )
+        TO '{catalog_file}'
+        (FORMAT parquet, COMPRESSION zstd)
+    """)
+
+
+def apply_compare(
+    datapaths: list[str], config, outpath, spill=False, aois_path=None
+):
+    """Perform DuckDB Intersect on Tiles and Subscriptions and return DuckDB
+    Relation object. With `spill` the compare runs out of core, spilling to
+    at most `config.spill_limit` MiB of temporary storage. The
+    subscriptions are read from `aois_path` if it was already resolved."""
+    layout = config.output_layout
+    if aois_path is None:
+        aois_path = config.get_aois_path(datapaths)
+    if not aois_path:
+        # no subscription partitions touch these tiles
+        write_empty_intersects(config.con, outpath, layout)
+        return get_pass_res(datapaths, outpath, layout=layout)
+
+    tiles = f"read_parquet({datapaths})"
+    spill_limit = config.spill_limit if spill else 0
+    write_compare(config.con, aois_path, tiles, outpath, spill_limit, layout)
+    return get_pass_res(datapaths, outpath, layout=layout)
+
+
+def apply_compare_inline(
+    datapaths: list[str], config, outpath: str, spill=False, aois_path=None
+) -> list[dict]:
+    """Compare like `apply_compare` into a local file and return the
+    messages of `inline_results` if the result fits in
+    `config.inline_messages` of them, saving the S3 write and the
+    consumer's read. Larger results are copied to `outpath` and announced
+    as usual."""
+    layout = config.output_layout
+    local = os.path.join(config.tempdir.name, f"inline-{uuid4()}.parquet")
+    try:
+        apply_compare(datapaths, config, local, spill, aois_path)
+        messages = inline_results(
+            config.con, datapaths, local, layout, config.inline_messages
+        )
+        if messages is not None:
+            print(f"Inlined the result in {len(messages)} messages.")
+            return messages
+        config.con.execute(f"""
+            COPY (FROM read_parquet('{local}'))
+            TO '{outpath}'
+            (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE 100_000)
+        """)
+        return [get_pass_res(datapaths, outpath, layout=layout)]
+    finally:
+        if os.path.exists(local):
+            os.remove(local)
+
+
+def write_compare(
+    con,
+    aois_path,
+    tiles: str,
+    outpath: str,
+    spill_limit: int = 0,
+    layout: str = "aoi",
+) -> dict:
+    """Write the intersections of the subscriptions at `aois_path` with the
+    `tiles` relation to `outpath` in `layout`, reading only subscriptions
+    within the tiles' extent. With a `spill_limit` the compare runs out of
+    core. Returns the pair counters of `write_pairs`."""
+    extent = get_tiles_extent(con, tiles)
+    aois = get_aois_relation(con, aois_path, extent)
+    if spill_limit > 0:
+        return write_intersects_out_of_core(
+            con, aois, tiles, outpath, spill_limit, layout=layout
+        )
+    return write_intersects(con, aois, tiles, outpath, layout)
+
+
+def apply_compare_streaming(
+    datapaths: list[str], config, outdir: str, spill=False, aois_path=None
+):
+    """Compare the tiles in chunks of at most `config.chunk_rows` rows,
+    writing one output part per chunk under `outdir`, so memory use follows
+    the chunk size rather than the batch. An AOI intersecting tiles of
+    several chunks has a row in each of their parts."""
+    layout = config.output_layout
+    if aois_path is None:
+        aois_path = config.get_aois_path(datapaths)
+    chunks = []
+    if datapaths:
+        chunks = plan_tile_chunks(config.con, datapaths, config.chunk_rows)
+
+    spill_limit = config.spill_limit if spill else 0
+    parts = []
+    for n, chunk in enumerate(chunks):
+        part = f"{outdir}/part-{n:05d}.parquet"
+        if aois_path:
+            tiles = tile_chunk_sql(chunk)
+            write_compare(
+                config.con, aois_path, tiles, part, spill_limit, layout
+            )
+        else:
+            write_empty_intersects(config.con, part, layout)
+        parts.append(part)
+    if not parts:
+        parts.append(f"{outdir}/part-00000.parquet")
+        write_empty_intersects(config.con, parts[0], layout)
+    print(f"Compared {len(chunks)} tile chunks into {outdir}")
+    return get_pass_res(datapaths, outdir, parts, layout)
+
+
+def compare_unit(
+    con,
+    aois_path,
+    ranges: list,
+    outpath: str,
+    spill_limit: int = 0,
+    layout: str = "aoi",
+):
+    """Compare the tiles in the row ranges of a work unit, out of core if
+    they don't fit in memory and there is a `spill_limit`."""
+    tiles = tile_chunk_sql(ranges)
+    try:
+        write_compare(con, aois_path, tiles, outpath, layout=layout)
+    except duckdb.OutOfMemoryException:
+        if spill_limit <= 0:
+            raise
+        write_compare(con, aois_path, tiles, outpath, spill_limit, layout)
+
+
+def merge_unit_outputs(
+    con, parts: list[str], outpath: str, layout: str = "aoi"
+):
+    """Merge the outputs of a run's work units into one result in `layout`.
+    Units hold disjoint tiles, so only the AOI layout has rows to combine,
+    the others are concatenated."""
+    if layout == "aoi":
+        merged = f"""
+            SELECT aois, flatten(list(tiles)) AS tiles
+            FROM read_parquet({parts})
+            GROUP BY aois
+        """
+    else:
+        merged = f"SELECT aois, tiles FROM read_parquet({parts})"
+    con.execute(f"""
+        COPY ({merged})
         TO '{outpath}'
         (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE 100_000)
-    """
-    config.con.execute(sql)
-    return get_pass_res(datapaths, outpath)
+    """)
+
+
+def apply_compare_fanout(
+    datapaths: list[str], config, outpath: str, aois_path=None
+):
+    """Split the tiles into work units of at most `config.fanout_rows` rows
+    of whole row groups, compare the units in parallel on cursors of the
+    config's connection and merge their outputs to `outpath`. The workers
+    share the connection's memory limit."""
+    layout = config.output_layout
+    if aois_path is None:
+        aois_path = config.get_aois_path(datapaths)
+    if not aois_path:
+        write_empty_intersects(config.con, outpath, layout)
+        return get_pass_res(datapaths, outpath, layout=layout)
+    # attach an indexed database once, before the workers share it
+    get_aois_relation(config.con, aois_path)
+
+    units = plan_tile_chunks(config.con, datapaths, config.fanout_rows)
+    unit_dir = os.path.join(config.tempdir.name, f"units-{uuid4()}")
+    os.makedirs(unit_dir)
+
+    def compare(n):
+        part = os.path.join(unit_dir, f"unit-{n:05d}.parquet")
+        con = config.con.cursor()
+        try:
+            compare_unit(
+                con, aois_path, units[n], part, config.spill_limit, layout
+            )
+        finally:
+            con.close()
+        return part
+
+    try:
+        with ThreadPoolExecutor(config.fanout_workers) as pool:
+            parts = list(pool.map(compare, range(len(units))))
+        merge_unit_outputs(config.con, parts, outpath, layout)
+    finally:
+        shutil.rmtree(unit_dir)
+    print(f"Compared {len(units)} work units of {datapaths} in process.")
+    return get_pass_res(datapaths, outpath, layout=layout)
+
+
+def get_unit(sqs_event) -> dict | None:
+    """Work unit of an SQS record re-enqueued by a fan out, None for the
+    records of S3 events."""
+    try:
+        return json.loads(sqs_event["body"]).get(UNIT_KEY)
+    except Exception:
+        return None
+
+
+def enqueue_units(sqs_event, datapaths: list[str], config) -> str:
+    """Split the tiles of an SQS record into work units and send them to the
+    record's queue, to be compared by other invocations. Returns the id of
+    the run the units belong to."""
+    units = plan_tile_chunks(config.con, datapaths, config.fanout_rows)
+    run = str(uuid4())
+    bodies = [
+        json.dumps({
+            UNIT_KEY: {
+                "run": run,
+                "sources": datapaths,
+                "ranges": ranges,
+                "index": n,
+                "count": len(units),
+            }
+        })
+        for n, ranges in enumerate(units)
+    ]
+    queue_url = config.get_queue_url(sqs_event["eventSourceARN"])
+    for start in range(0, len(bodies), SQS_BATCH):
+        entries = [
+            {"Id": str(n), "MessageBody": body}
+            for n, body in enumerate(bodies[start : start + SQS_BATCH])
+        ]
+        res = config.sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        if res.get("Failed"):
+            raise RuntimeError(
+                f"Failed to enqueue work units: {json.dumps(res['Failed'])}"
+            )
+    print(f"Enqueued {len(units)} work units of {datapaths} as run {run}.")
+    return run
 
 
-def get_env_vars(var_name: str):
+def put_run_marker(config, key: str) -> bool:
+    """Write the empty marker object `key` with a conditional put. Returns
+    False if another invocation wrote it first."""
+    try:
+        config.s3.put_object(
+            Bucket=config.bucket, Key=key, Body=b"", IfNoneMatch="*"
+        )
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code in ("PreconditionFailed", "ConditionalRequestConflict"):
+            return False
+        raise
+    return True
+
+
+def compare_unit_record(sqs_event, config: CloudConfig) -> dict | None:
+    """Compare the work unit of a re-enqueued SQS record. The unit that
+    finds every output of its run written merges them into the run's result
+    and announces it, a marker written with a conditional put makes sure
+    only one does. A unit received more than `config.fanout_max_receives`
+    times isn't compared again, its run is announced as failed instead,
+    once. Returns the SNS message if this unit announced one."""
+    unit = get_unit(sqs_event)
+    run_key = f"{config.prefix}/intersects/{unit['run']}"
+    attributes = sqs_event.get("attributes", {})
+    receives = int(attributes.get("ApproximateReceiveCount", 1))
+    if receives > config.fanout_max_receives:
+        if not put_run_marker(config, f"{run_key}/failed"):
+            return None
+        fail_msg = get_fail_res(
+            unit["sources"],
+            f"Work unit {unit['index']} of run {unit['run']} was received "
+            f"{receives} times without completing, giving up on the run.",
+        )
+        publish_messages([fail_msg], config)
+        return fail_msg
+
+    run_path = f"s3://{config.bucket}/{run_key}"
+    part = f"{run_path}/units/unit-{unit['index']:05d}.parquet"
+    layout = config.output_layout
+
+    aois_path = config.get_aois_path(unit["sources"])
+    if aois_path:
+        compare_unit(
+            config.con,
+            aois_path,
+            unit["ranges"],
+            part,
+            config.spill_limit,
+            layout,
+        )
+    else:
+        write_empty_intersects(config.con, part, layout)
+
+    parts = []
+    pages = config.s3.get_paginator("list_objects_v2").paginate(
+        Bucket=config.bucket, Prefix=f"{run_key}/units/"
+    )
+    for page in pages:
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".parquet"):
+                parts.append(f"s3://{config.bucket}/{obj['Key']}")
+    if len(parts) < unit["count"]:
+        return None
+
+    outpath = f"{run_path}.parquet"
+    merge_unit_outputs(config.con, sorted(parts), outpath, layout)
+    if not put_run_marker(config, f"{run_key}/merged"):
+        # another unit of the run merged and announced it
+        return None
+
+    sources = unit["sources"]
+    write_tile_catalog(
+        config.con, sources, f"{config.catalog_path}/{unit['run']}.parquet"
+    )
+    sns_message = get_pass_res(sources, outpath, layout=layout)
+    publish_messages([sns_message], config)
+    return sns_message
+
+
+def get_env_vars(var_name: str, default=None):
     """Handle fetching requirend environment variables and crafting error
-    messages if they're missing."""
+    messages if they're missing. Variables with a default are optional."""
     val = os.environ.get(var_name)
 
     if val is not None and val != "":
@@ -217,31 +2218,281 @@ def get_env_vars(var_name: str):
         return val
     elif var_name == "S3_CERT_PATH":
         return None
+    elif default is not None:
+        return default
     else:
         raise ValueError(
             f"Required variable {var_name} missing from environment."
         )
 
 
+def compare_and_publish(
+    data_paths: list[str],
+    config: CloudConfig,
+    mode: str = "memory",
+    etags: dict[str, str] | None = None,
+) -> list[dict]:
+    """Compare the tiles in `data_paths` together, record them in the tile
+    catalog and announce the results on SNS, inlined in the messages if
+    the config allows and they fit. `mode` is one of the modes of
+    `compare_records`: in memory, out of core with 'spill', or split into
+    work units compared in process with 'fanout'. Returns the messages.
+
+    When the tiles' object `etags` are known the outputs are named by
+    `result_key`, so comparing the same tiles against the same
+    subscriptions again overwrites the same objects, and a result already
+    in the config's ledger is announced again without comparing."""
+    if not data_paths:
+        print("No GeoParquet files found in events."
+              "If the lambda was started by an 's3:TestEvent' then "
+              "this is expected.")
+
+    key = None
+    etags = etags or {}
+    # the version keys the result, so it has to be the one compared against
+    if data_paths and all(etags.get(path) for path in data_paths):
+        aois_path, subs_version = config.get_subscriptions(data_paths)
+    else:
+        aois_path, subs_version = config.get_aois_path(data_paths), None
+    if subs_version is not None:
+        key = result_key(
+            {path: etags[path] for path in data_paths},
+            subs_version,
+            config.output_layout,
+            config.chunk_rows,
+        )
+    if key is not None and config.ledger is not None:
+        sns_messages = config.ledger.get(key)
+        if sns_messages is not None:
+            print(f"Announcing result {key} again from the ledger.")
+            publish_messages(sns_messages, config)
+            return sns_messages
+
+    name = key or uuid4()
+    spill = mode == "spill"
+    base_s3_path = f"{config.bucket}/{config.prefix}/intersects/{name}.parquet"
+    full_s3_path = f"s3://{base_s3_path}"
+    if mode == "fanout":
+        sns_message = apply_compare_fanout(
+            data_paths, config, full_s3_path, aois_path
+        )
+        sns_messages = [sns_message]
+    elif config.chunk_rows > 0:
+        outdir = f"s3://{config.bucket}/{config.prefix}/intersects/{name}"
+        sns_message = apply_compare_streaming(
+            data_paths, config, outdir, spill, aois_path
+        )
+        sns_messages = [sns_message]
+    elif config.inline_messages > 0:
+        sns_messages = apply_compare_inline(
+            data_paths, config, full_s3_path, spill, aois_path
+        )
+    else:
+        sns_message = apply_compare(
+            data_paths, config, full_s3_path, spill, aois_path
+        )
+        sns_messages = [sns_message]
+    if data_paths:
+        write_tile_catalog(
+            config.con, data_paths, f"{config.catalog_path}/{name}.parquet"
+        )
+    publish_messages(sns_messages, config)
+    if key is not None and config.ledger is not None:
+        config.ledger.put(key, sns_messages)
+    return sns_messages
+
+
+def next_compare_mode(mode: str, config: CloudConfig) -> str | None:
+    """Mode to compare a single record in after it ran out of memory in
+    `mode`, None if there is nothing left to try."""
+    if mode == "memory" and config.spill_limit > 0:
+        return "spill"
+    if mode in ("memory", "spill") and config.fanout != "off":
+        return "fanout"
+    return None
+
+
+def compare_records(
+    events: list[dict],
+    config: CloudConfig,
+    report_failures: bool,
+    mode: str = "memory",
+) -> tuple[list[dict], list[dict]]:
+    """Compare the tiles of the SQS records together. On an out of memory
+    error, or any error when reporting batch item failures, the records are
+    bisected and each half compared again. A single record that runs out of
+    memory is compared again out of core if the config has a spill limit,
+    and then split into row group work units if the config fans out.
+    Returns the SNS messages of the groups that succeeded and, when
+    reporting batch item failures, the failures of single records that
+    didn't. Otherwise errors are raised."""
+    data_paths = []
+    etags = {}
+    try:
+        for sqs_event in events:
+            data_paths = data_paths + get_data_paths(sqs_event)
+            etags.update(get_data_etags(sqs_event))
+        if mode == "fanout" and config.fanout == "sqs":
+            # the run is announced by the invocation merging its units
+            enqueue_units(events[0], data_paths, config)
+            return [], []
+        return compare_and_publish(data_paths, config, mode, etags), []
+    except Exception as e:
+        oom = isinstance(e, duckdb.OutOfMemoryException)
+        next_mode = None
+        if oom and len(events) == 1:
+            next_mode = next_compare_mode(mode, config)
+        if len(events) > 1 and (oom or report_failures):
+            print(f"Bisecting {len(events)} records after: {e}")
+        elif next_mode is not None:
+            print(f"Comparing with mode {next_mode} after: {e}")
+            return compare_records(events, config, report_failures, next_mode)
+        elif report_failures:
+            fail_msg = get_fail_res(data_paths, traceback.format_exc())
+            config.sns.publish(TopicArn=config.sns_out_arn, **fail_msg)
+            return [], [{"itemIdentifier": events[0]["messageId"]}]
+        else:
+            raise e
+
+    half = len(events) // 2
+    first = compare_records(events[:half], config, report_failures)
+    second = compare_records(events[half:], config, report_failures)
+    return first[0] + second[0], first[1] + second[1]
+
+
+def get_config() -> tuple[CloudConfig, bool]:
+    """The handler's CloudConfig for the environment, from CONFIG_CACHE, and
+    whether it was reused from an earlier invocation or `init`."""
+    sns_out = get_env_vars("SNS_OUT_ARN")
+    region = get_env_vars("AWS_REGION")
+    bucket = get_env_vars("S3_BUCKET")
+    prefix = get_env_vars("DEPLOY_PREFIX")
+    mem_limit = int(get_env_vars("MEMORY_LIMIT"))
+    s3_endpoint = get_env_vars("AWS_S3_ENDPOINT")
+    # on sc/tc, we need a custom certicate to make aws service calls
+    cert_path = get_env_vars("S3_CERT_PATH")
+    config, warm = CONFIG_CACHE.get(
+        region,
+        sns_out,
+        bucket,
+        prefix,
+        mem_limit,
+        cert_path,
+        s3_endpoint,
+        cache_dir=get_env_vars("SUBS_CACHE_DIR", SUBS_CACHE_DIR),
+        subs_index=get_env_vars("SUBS_INDEX", "off"),
+        subs_layout=get_env_vars("SUBS_LAYOUT", "flat"),
+    )
+
+    # MiB of Lambda ephemeral storage set aside for the out of core compare,
+    # which is off unless configured
+    storage = int(get_env_vars("EPHEMERAL_STORAGE", "0"))
+    config.spill_limit = int(storage * SPILL_STORAGE_SHARE)
+    config.chunk_rows = int(get_env_vars("COMPARE_CHUNK_ROWS", "0"))
+    config.fanout = get_env_vars("FANOUT_MODE", "off")
+    if config.fanout not in FANOUT_MODES:
+        raise ValueError(
+            f"Invalid fan out mode {config.fanout}, expected one of "
+            f"{FANOUT_MODES}."
+        )
+    config.fanout_rows = int(get_env_vars("FANOUT_ROWS", "100000"))
+    config.fanout_workers = int(get_env_vars("FANOUT_WORKERS", "2"))
+    config.fanout_max_receives = int(
+        get_env_vars("FANOUT_MAX_RECEIVES", str(UNIT_MAX_RECEIVES))
+    )
+    config.inline_messages = int(get_env_vars("INLINE_MESSAGES", "0"))
+    config.output_layout = get_env_vars("OUTPUT_LAYOUT", "aoi")
+    if get_env_vars("RESULT_LEDGER", "false").lower() == "true":
+        config.ledger = ResultLedger(
+            f"s3://{bucket}/{prefix}/ledger", config.s3
+        )
+    else:
+        config.ledger = None
+    if config.output_layout not in OUTPUT_LAYOUTS:
+        raise ValueError(
+            f"Invalid output layout {config.output_layout}, expected one "
+            f"of {OUTPUT_LAYOUTS}."
+        )
+    config.profile = get_env_vars("PROFILE_MODE", "off")
+    if config.profile not in PROFILE_MODES:
+        raise ValueError(
+            f"Invalid profile mode {config.profile}, expected one of "
+            f"{PROFILE_MODES}."
+        )
+    config.profile_slow_ms = int(get_env_vars("PROFILE_SLOW_MS", "10000"))
+    config.profile_python = (
+        get_env_vars("PROFILE_PYTHON", "false").lower() == "true"
+    )
+    return config, warm
+
+
+def init():
+    """Build the handler's config and open its DuckDB connection ahead of
+    the first invocation. Run on import in Lambda, this moves the boto3
+    clients, the certificate and the extension loads to the init phase,
+    which runs with more CPU. A failure is logged and left for the first
+    invocation to hit again and report."""
+    global INIT_SECONDS
+    start = time.perf_counter()
+    try:
+        with METRICS.stage("config"):
+            config, _ = get_config()
+        # the config is kept alive, so is the connection
+        with config:
+            pass
+    except Exception:
+        traceback.print_exc()
+        CONFIG_CACHE.clear()
+    INIT_SECONDS = time.perf_counter() - start
+
+
 def handler(event: dict[str, str], context):
     """Base Lambda handler method which coordinates SQS message processing and
-    SNS responses in case of errors."""
+    SNS responses in case of errors.
+
+    Records are compared in groups planned to fit in memory. With
+    REPORT_BATCH_FAILURES set to 'true' the event source mapping is expected
+    to use ReportBatchItemFailures: failing groups are bisected down to the
+    records that fail and only those are returned for redelivery, the
+    mapping deletes the rest. Otherwise processed messages are deleted here
+    and the SNS messages are returned.
+
+    With EMIT_METRICS set to 'true' a record of the time spent in each
+    stage, memory used and rows, bytes and messages handled is printed in
+    CloudWatch embedded metric format at the end of the invocation, see
+    `Metrics`.
+
+    PROFILE_MODE 'always' stores the DuckDB query profiles of the compare
+    under profiles/<request id> of the deploy prefix, 'slow' only for
+    invocations taking PROFILE_SLOW_MS or more. PROFILE_PYTHON 'true' adds
+    a Python sampling profile, see `profiling`."""
+    global COLD_START
+    METRICS.enabled = get_env_vars("EMIT_METRICS", "false").lower() == "true"
+    if COLD_START:
+        COLD_START = False
+        METRICS.add({"cold_starts": 1})
+        if INIT_SECONDS:
+            METRICS.add_time("init", INIT_SECONDS)
+    try:
+        with METRICS.stage("invocation"):
+            return handle_records(event, context)
+    finally:
+        METRICS.emit({"DeployPrefix": os.environ.get("DEPLOY_PREFIX", "")})
+
+
+def handle_records(event: dict[str, str], context=None):
+    """Compare the records of a Lambda `event`, see `handler`."""
     sns_out = get_env_vars("SNS_OUT_ARN")
     region = get_env_vars("AWS_REGION")
 
     config = None
     try:
-        bucket = get_env_vars("S3_BUCKET")
-        prefix = get_env_vars("DEPLOY_PREFIX")
-        mem_limit = get_env_vars("MEMORY_LIMIT")
-        s3_endpoint = get_env_vars("AWS_S3_ENDPOINT")
-
-        # on sc/tc, we need a custom certicate to make aws service calls
-        cert_path = get_env_vars("S3_CERT_PATH")
-        mem_limit = int(mem_limit)
-        config = CloudConfig(
-            region, sns_out, bucket, prefix, mem_limit, cert_path, s3_endpoint
+        report_failures = (
+            get_env_vars("REPORT_BATCH_FAILURES", "false").lower() == "true"
         )
+        with METRICS.stage("config"):
+            config, warm = get_config()
+        print(json.dumps(CONFIG_CACHE.metric(warm)))
     except Exception as e:
         # this section won't work in sc/tc because sns won't have
         # the cert allowing them to connect yet
@@ -251,54 +2502,84 @@ def handler(event: dict[str, str], context):
         sns.publish(TopicArn=sns_out, **fail_msg)
         raise e
 
+    # profiles are stored by request id, local runs have none
+    run_id = getattr(context, "aws_request_id", None) or str(uuid4())
     data_paths = []
     try:
-        with config:
+        with config, profiling(config, run_id):
             print("Event:", json.dumps(event))
             events = event["Records"]
-
-            # collect data paths, delete messages after processing
-            for sqs_event in events:
-                data_paths = data_paths + get_data_paths(sqs_event)
-            if not data_paths:
-                print("No GeoParquet files found in events."
-                      "If the lambda was started by an 's3:TestEvent' then "
-                      "this is expected.")
-
-            # process data paths together
-            name = uuid4()
-            base_s3_path = (
-                f"{config.bucket}/{config.prefix}/intersects/{name}.parquet"
-            )
-            full_s3_path = f"s3://{base_s3_path}"
-            sns_message = apply_compare(data_paths, config, full_s3_path)
-            config.sns.publish(TopicArn=config.sns_out_arn, **sns_message)
-
-            # delete sqs messages now that we're done
             for sqs_event in events:
-                delete_sqs_message(sqs_event, config)
-
-            # return as list to conform with possibility of needing to split
-            return [sns_message]
-    except duckdb.OutOfMemoryException as e:
-        events = event["Records"]
-        # if it can't be split further, raise memory error
-        if len(events) == 1:
-            raise e
-
-        # split into single event runs to see if that alleviates issues
-        try:
-            split_events = [{"Records": [e]} for e in events]
-            sns_messages = [handler(re, None)[0] for re in split_events]
-            return sns_messages
-        except Exception as e:
-            exc_str = traceback.format_exc()
-            fail_msg = get_fail_res(data_paths, exc_str)
-            config.sns.publish(TopicArn=config.sns_out_arn, **fail_msg)
-            raise e
-
+                try:
+                    data_paths = data_paths + get_data_paths(sqs_event)
+                except Exception:
+                    # work units, or raised again by their compare
+                    continue
+            return process_records(events, config, report_failures)
     except Exception as e:
         exc_str = traceback.format_exc()
         fail_msg = get_fail_res(data_paths, exc_str)
         config.sns.publish(TopicArn=config.sns_out_arn, **fail_msg)
         raise e
+
+
+def process_records(
+    events: list[dict], config: CloudConfig, report_failures: bool
+) -> list[dict] | dict:
+    """Compare the SQS records of `events` on an entered `config`. With
+    `report_failures` the records that failed are returned as batch item
+    failures and nothing is deleted, otherwise the records are deleted once
+    compared and the SNS messages returned."""
+    # work units re-enqueued by a fan out are compared on their own
+    unit_events = [e for e in events if get_unit(e) is not None]
+    tile_events = [e for e in events if get_unit(e) is None]
+
+    tile_bytes = 0
+    for sqs_event in tile_events:
+        try:
+            files = get_data_files(sqs_event)
+        except Exception:
+            # raised again by the compare of its group
+            continue
+        tile_bytes += sum(size for _, size in files)
+    METRICS.add({"records": len(events), "tile_bytes": tile_bytes})
+
+    # process records in groups that should fit in memory
+    sns_messages = []
+    failures = []
+    for group in plan_record_groups(tile_events, config):
+        messages, group_failures = compare_records(
+            group, config, report_failures
+        )
+        sns_messages = sns_messages + messages
+        failures = failures + group_failures
+
+    for sqs_event in unit_events:
+        try:
+            message = compare_unit_record(sqs_event, config)
+        except Exception:
+            if not report_failures:
+                raise
+            fail_msg = get_fail_res(
+                get_unit(sqs_event)["sources"], traceback.format_exc()
+            )
+            config.sns.publish(TopicArn=config.sns_out_arn, **fail_msg)
+            failures.append({"itemIdentifier": sqs_event["messageId"]})
+            continue
+        if message is not None:
+            sns_messages.append(message)
+
+    if report_failures:
+        return {"batchItemFailures": failures}
+
+    # delete sqs messages now that we're done
+    delete_sqs_messages(events, config)
+
+    # return as list to conform with possibility of needing to split
+    return sns_messages
+
+
+# AWS_LAMBDA_FUNCTION_NAME is only set in Lambda, where the module is
+# imported in the init phase
+if "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+    init()
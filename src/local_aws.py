@@ -0,0 +1,451 @@
+"""
+In-process stand-ins for the AWS services the compare Lambda calls, so
+`intersects_lambda.handler` can be run end to end without network access.
+
+`LocalS3` keeps objects as files under a directory and serves them over HTTP
+with the S3 calls DuckDB's httpfs makes, so the `s3://` paths the compare
+reads and writes through `AWS_S3_ENDPOINT` are the same files the boto3
+stand-in sees. `LocalSNS` and `LocalSQS` record what is published, sent and
+deleted.
+
+    with LocalAWS(root) as aws:
+        os.environ["AWS_S3_ENDPOINT"] = aws.endpoint
+        aws.s3.upload_file("subscriptions.parquet", bucket, subs_key)
+        handler(sqs_event(messages, queue_arn, region), None)
+"""
+
+import json
+import os
+import re
+import shutil
+import threading
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest import mock
+from urllib.parse import parse_qs, unquote, urlsplit
+from uuid import uuid4
+from xml.sax.saxutils import escape
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+from intersects_lambda import sqs_records
+
+
+def client_error(code: str, status: int, operation: str) -> ClientError:
+    """ClientError as botocore raises it for an S3 error response."""
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": code},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        },
+        operation,
+    )
+
+
+class LocalS3:
+    """S3 client stand-in keeping each object at `{root}/{bucket}/{key}`.
+    ETags are made from the file's modification time and size, so they
+    change whenever an object is written again."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp = os.path.join(root, ".tmp")
+        self.uploads = os.path.join(root, ".uploads")
+        os.makedirs(self.tmp, exist_ok=True)
+        os.makedirs(self.uploads, exist_ok=True)
+        self.server = None
+
+    def path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def etag(self, path: str) -> str:
+        stat = os.stat(path)
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    def write(self, bucket: str, key: str, body: bytes, exclusive=False):
+        """Write an object atomically, failing if it exists and `exclusive`
+        is set, like a put with `IfNoneMatch='*'`."""
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = os.path.join(self.tmp, str(uuid4()))
+        with open(part, "wb") as f:
+            f.write(body)
+        if exclusive:
+            try:
+                # a hard link fails if the object exists, replace wouldn't
+                os.link(part, path)
+            except FileExistsError:
+                raise client_error(
+                    "PreconditionFailed", 412, "PutObject"
+                ) from None
+            finally:
+                os.remove(part)
+        else:
+            os.replace(part, path)
+        return self.etag(path)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise client_error("404", 404, "HeadObject")
+        stat = os.stat(path)
+        return {
+            "ETag": self.etag(path),
+            "ContentLength": stat.st_size,
+            "LastModified": datetime.fromtimestamp(
+                stat.st_mtime, timezone.utc
+            ),
+        }
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise client_error("NoSuchKey", 404, "GetObject")
+        etag = self.etag(path)
+        if IfNoneMatch == etag:
+            raise client_error("304", 304, "GetObject")
+        with open(path, "rb") as f:
+            body = f.read()
+        return {
+            "ETag": etag,
+            "ContentLength": len(body),
+            "Body": StreamingBody(BytesIO(body), len(body)),
+        }
+
+    def put_object(self, Bucket, Key, Body=b"", IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode()
+        elif hasattr(Body, "read"):
+            Body = Body.read()
+        etag = self.write(Bucket, Key, Body, exclusive=IfNoneMatch == "*")
+        return {"ETag": etag}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise client_error("404", 404, "HeadObject")
+        shutil.copyfile(path, Filename)
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, "rb") as f:
+            self.write(Bucket, Key, f.read())
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        bucket_dir = os.path.join(self.root, Bucket)
+        contents = []
+        for dirpath, _, filenames in os.walk(bucket_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, bucket_dir).replace(os.sep, "/")
+                if key.startswith(Prefix):
+                    head = self.head_object(Bucket, key)
+                    contents.append({
+                        "Key": key,
+                        "Size": head["ContentLength"],
+                        "ETag": head["ETag"],
+                        "LastModified": head["LastModified"],
+                    })
+        contents.sort(key=lambda obj: obj["Key"])
+        res = {"KeyCount": len(contents), "IsTruncated": False}
+        if contents:
+            res["Contents"] = contents
+        return res
+
+    def get_paginator(self, operation_name: str):
+        if operation_name != "list_objects_v2":
+            raise NotImplementedError(operation_name)
+        return self
+
+    def paginate(self, **kwargs):
+        """Every listing fits in one page."""
+        return [self.list_objects_v2(**kwargs)]
+
+    def serve(self) -> str:
+        """Serve the objects over HTTP on a free local port and return the
+        endpoint, for DuckDB's S3 secret."""
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), S3RequestHandler)
+        self.server.daemon_threads = True
+        self.server.store = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    """Path style S3 API over a `LocalS3`: object HEAD, ranged GET and PUT,
+    ListObjectsV2, and the multipart uploads DuckDB writes files with.
+    Requests aren't authenticated."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def parse(self):
+        url = urlsplit(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        query = parse_qs(url.query, keep_blank_values=True)
+        return unquote(bucket), unquote(key), query
+
+    def body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def reply(self, status: int, body: bytes = b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def reply_xml(self, xml: str):
+        body = f'<?xml version="1.0" encoding="UTF-8"?>{xml}'.encode()
+        self.reply(200, body, {"Content-Type": "application/xml"})
+
+    def object_headers(self, path: str) -> dict:
+        stat = os.stat(path)
+        return {
+            "ETag": self.server.store.etag(path),
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Content-Type": "binary/octet-stream",
+            "Accept-Ranges": "bytes",
+        }
+
+    def do_HEAD(self):
+        bucket, key, _ = self.parse()
+        path = self.server.store.path(bucket, key)
+        if not key or not os.path.isfile(path):
+            self.reply(404)
+            return
+        self.send_response(200)
+        for name, value in self.object_headers(path).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        if not key or "list-type" in query:
+            self.list_objects(bucket, query.get("prefix", [""])[0])
+            return
+        path = self.server.store.path(bucket, key)
+        if not os.path.isfile(path):
+            self.reply(404)
+            return
+        headers = self.object_headers(path)
+        size = os.path.getsize(path)
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        with open(path, "rb") as f:
+            if match is None:
+                self.reply(200, f.read(), headers)
+                return
+            start = int(match[1])
+            end = min(int(match[2]) if match[2] else size - 1, size - 1)
+            f.seek(start)
+            body = f.read(end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        self.reply(206, body, headers)
+
+    def list_objects(self, bucket: str, prefix: str):
+        res = self.server.store.list_objects_v2(bucket, prefix)
+        contents = "".join(
+            f"<Contents><Key>{escape(obj['Key'])}</Key>"
+            f"<Size>{obj['Size']}</Size><ETag>{escape(obj['ETag'])}</ETag>"
+            f"<LastModified>{obj['LastModified'].isoformat()}</LastModified>"
+            "</Contents>"
+            for obj in res.get("Contents", [])
+        )
+        self.reply_xml(
+            "<ListBucketResult>"
+            f"<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>"
+            f"<KeyCount>{res['KeyCount']}</KeyCount>"
+            f"<IsTruncated>false</IsTruncated>{contents}"
+            "</ListBucketResult>"
+        )
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        body = self.body()
+        if "uploadId" in query:
+            upload_dir = os.path.join(
+                self.server.store.uploads, query["uploadId"][0]
+            )
+            part = os.path.join(upload_dir, query["partNumber"][0])
+            with open(part, "wb") as f:
+                f.write(body)
+            self.reply(200, headers={"ETag": f'"{len(body):x}"'})
+            return
+        try:
+            etag = self.server.store.write(
+                bucket, key, body,
+                exclusive=self.headers.get("If-None-Match") == "*",
+            )
+        except ClientError:
+            self.reply(412)
+            return
+        self.reply(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        body = self.body()
+        uploads = self.server.store.uploads
+        if "uploads" in query:
+            upload_id = uuid4().hex
+            os.makedirs(os.path.join(uploads, upload_id))
+            self.reply_xml(
+                "<InitiateMultipartUploadResult>"
+                f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                f"<UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>"
+            )
+            return
+        if "uploadId" in query:
+            upload_dir = os.path.join(uploads, query["uploadId"][0])
+            numbers = re.findall(rb"<PartNumber>(\d+)</PartNumber>", body)
+            data = b""
+            for n in sorted(numbers, key=int):
+                with open(os.path.join(upload_dir, n.decode()), "rb") as f:
+                    data += f.read()
+            etag = self.server.store.write(bucket, key, data)
+            shutil.rmtree(upload_dir)
+            self.reply_xml(
+                "<CompleteMultipartUploadResult>"
+                f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                f"<ETag>{escape(etag)}</ETag>"
+                "</CompleteMultipartUploadResult>"
+            )
+            return
+        self.reply(400)
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        if "uploadId" in query:
+            path = os.path.join(self.server.store.uploads, query["uploadId"][0])
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path = self.server.store.path(bucket, key)
+            if os.path.isfile(path):
+                os.remove(path)
+        self.reply(204)
+
+
+class LocalSNS:
+    """SNS client stand-in recording the messages published."""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, **kwargs):
+        self.messages.append({"TopicArn": TopicArn, **kwargs})
+        return {"MessageId": str(uuid4())}
+
+
+class LocalSQS:
+    """SQS client stand-in holding the messages sent to each queue until
+    they are received, and those received in flight until they are deleted
+    or made visible again. Deletes and visibility changes are recorded,
+    visibility timeouts don't expire."""
+
+    def __init__(self):
+        self.queues = {}
+        # (queue URL, message) by receipt handle
+        self.in_flight = {}
+        self.deleted = []
+        self.visibility = []
+
+    def get_queue_url(self, QueueName):
+        url = f"http://sqs.local/{QueueName}"
+        self.queues.setdefault(url, [])
+        return {"QueueUrl": url}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful = []
+        for entry in Entries:
+            message_id = str(uuid4())
+            self.queues.setdefault(QueueUrl, []).append({
+                "MessageId": message_id,
+                "ReceiptHandle": str(uuid4()),
+                "Body": entry["MessageBody"],
+                "Attributes": {"ApproximateReceiveCount": "0"},
+            })
+            successful.append({"Id": entry["Id"], "MessageId": message_id})
+        return {"Successful": successful, "Failed": []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        queue = self.queues.get(QueueUrl, [])
+        messages = queue[:MaxNumberOfMessages]
+        del queue[:MaxNumberOfMessages]
+        for message in messages:
+            attributes = message["Attributes"]
+            receives = int(attributes["ApproximateReceiveCount"]) + 1
+            attributes["ApproximateReceiveCount"] = str(receives)
+            self.in_flight[message["ReceiptHandle"]] = (QueueUrl, message)
+        return {"Messages": messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        for e in Entries:
+            self.in_flight.pop(e["ReceiptHandle"], None)
+            self.deleted.append((QueueUrl, e["ReceiptHandle"]))
+        successful = [{"Id": e["Id"]} for e in Entries]
+        return {"Successful": successful, "Failed": []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        for e in Entries:
+            timeout = e["VisibilityTimeout"]
+            self.visibility.append((QueueUrl, e["ReceiptHandle"], timeout))
+            if timeout == 0 and e["ReceiptHandle"] in self.in_flight:
+                _, message = self.in_flight.pop(e["ReceiptHandle"])
+                self.queues[QueueUrl].insert(0, message)
+        successful = [{"Id": e["Id"]} for e in Entries]
+        return {"Successful": successful, "Failed": []}
+
+
+class LocalAWS:
+    """The three stand-ins together, with the S3 one served for DuckDB.
+    Inside the `with` block `boto3.client` returns them, so the clients a
+    `CloudConfig` makes, and the handler's own SNS client, are local."""
+
+    def __init__(self, root: str):
+        self.s3 = LocalS3(root)
+        self.sns = LocalSNS()
+        self.sqs = LocalSQS()
+        self.endpoint = None
+        self.patch = mock.patch("boto3.client", self.client)
+
+    def client(self, service_name: str, *args, **kwargs):
+        return {"s3": self.s3, "sns": self.sns, "sqs": self.sqs}[service_name]
+
+    def __enter__(self):
+        self.endpoint = self.s3.serve()
+        self.patch.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.patch.stop()
+        self.s3.shutdown()
+
+
+def s3_event_body(bucket: str, key: str, size: int, etag: str) -> str:
+    """SQS body of the SNS notification S3 sends for a new tile object."""
+    record = {
+        "s3": {
+            "bucket": {"name": bucket},
+            "object": {"key": key, "size": size, "eTag": etag.strip('"')},
+        }
+    }
+    return json.dumps({"Message": json.dumps({"Records": [record]})})
+
+
+def sqs_event(messages: list[dict], queue_arn: str, region: str) -> dict:
+    """Lambda event for SQS `messages` as `receive_message` returns them."""
+    return {"Records": sqs_records(messages, queue_arn, region)}
@@ -0,0 +1,851 @@
+"""
+Offline tools for publishing AOI Subscriptions for TNS.
+
+These run wherever subscriptions are produced, not in the Lambda, and write
+the artifacts the compare reads from `{prefix}/subs/`.
+
+    python src/publish.py index subscriptions.parquet subscriptions.duckdb
+    python src/publish.py partition subscriptions.parquet cells/
+    python src/publish.py subdivide subscriptions.parquet pieces.parquet
+    python src/publish.py sort subscriptions.parquet sorted.parquet
+    python src/publish.py delta init s3://bucket/prefix/subs/delta \
+        subscriptions.parquet
+    python src/publish.py delta append s3://bucket/prefix/subs/delta \
+        --adds new_aois.parquet --removes aoi_1 aoi_2
+    python src/publish.py delta compact s3://bucket/prefix/subs/delta
+    python src/publish.py backfill s3://bucket/prefix \
+        --old previous.parquet --new subscriptions.parquet
+    python src/publish.py backfill s3://bucket/prefix \
+        --delta s3://bucket/prefix/subs/delta --since 3
+    python src/publish.py catalog s3://bucket/prefix
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+from math import ceil, sqrt
+from uuid import uuid4
+
+import boto3
+import duckdb
+
+from intersects_lambda import (
+    DELTA_LOG_NAME,
+    INTERIOR_TYPE,
+    MANIFEST_NAME,
+    NO_INTERIOR,
+    OUTPUT_LAYOUTS,
+    DeltaSubscriptions,
+    build_subscription_index,
+    get_aois_relation,
+    get_pass_res,
+    grid_cells_sql,
+    interior_sql,
+    write_empty_intersects,
+    write_intersects,
+)
+
+
+def get_connection(region: str | None = None, s3_endpoint: str | None = None):
+    """DuckDB connection with the extensions TNS uses, able to read and write
+    S3 paths through the default AWS credential chain."""
+    con = duckdb.connect()
+    con.execute("LOAD httpfs")
+    con.execute("LOAD spatial")
+    con.execute("LOAD aws")
+    secret = ["TYPE S3", "PROVIDER CREDENTIAL_CHAIN"]
+    if region is not None:
+        secret.append(f"REGION '{region}'")
+    if s3_endpoint is not None:
+        secret.append(f"ENDPOINT '{s3_endpoint}'")
+    con.execute(f"CREATE SECRET ({', '.join(secret)})")
+    return con
+
+
+def write_partitioned_subscriptions(
+    con, aois_path: str, out_dir: str, cell_size: float = 1.0
+) -> dict:
+    """Split subscriptions into `cell=<id>/part_<n>.parquet` files on a
+    regular grid of `cell_size` degrees, and write the manifest the compare
+    uses to find the partitions touched by a batch of tiles. AOIs crossing
+    cell edges are written to every cell they touch."""
+    cells = grid_cells_sql("geometry_bbox", cell_size)
+    interior = interior_sql(con, aois_path)
+    con.execute(f"""
+        COPY (
+            SELECT
+                pk_and_model, geometry, geometry_bbox,
+                {interior} AS interior, unnest({cells}) AS cell
+            FROM read_parquet('{aois_path}')
+        )
+        TO '{out_dir}'
+        (
+            FORMAT parquet,
+            COMPRESSION zstd,
+            PARTITION_BY (cell),
+            FILENAME_PATTERN 'part_{{i}}',
+            OVERWRITE_OR_IGNORE
+        )
+    """)
+
+    manifest = {"cell_size": cell_size, "cells": {}}
+    pattern = os.path.join(out_dir, "cell=*", "*.parquet")
+    for path in sorted(glob.glob(pattern)):
+        part = os.path.relpath(path, out_dir)
+        cell = part.split(os.sep)[0].removeprefix("cell=")
+        manifest["cells"].setdefault(cell, []).append(part)
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+# GeoParquet names for the geometry types reported by ST_GeometryType
+GEOPARQUET_TYPES = {
+    "POINT": "Point",
+    "LINESTRING": "LineString",
+    "POLYGON": "Polygon",
+    "MULTIPOINT": "MultiPoint",
+    "MULTILINESTRING": "MultiLineString",
+    "MULTIPOLYGON": "MultiPolygon",
+    "GEOMETRYCOLLECTION": "GeometryCollection",
+}
+
+
+def pick_row_group_size(
+    count: int,
+    target_groups: int = 256,
+    min_rows: int = 2048,
+    max_rows: int = 100_000,
+) -> int:
+    """Rows per row group for `count` spatially sorted AOIs. Smaller groups
+    cover a smaller stretch of the curve, so their bbox statistics are
+    tighter and prune better, but each group adds footer metadata and a
+    separate read, so the size is bounded on both ends."""
+    return max(min_rows, min(max_rows, ceil(count / target_groups)))
+
+
+# the interior square is shrunk from the one inscribed in the circle, so that
+# tile bboxes rounded to floats can't cross it
+INTERIOR_MARGIN = 0.99
+
+
+def interior_rectangles_sql(relation: str) -> str:
+    """SQL for the subscriptions of `relation` with their interior
+    rectangle: the square inscribed in each polygon's maximum inscribed
+    circle. It is NULL for other geometry types, the compare then always
+    tests those AOIs exactly."""
+    half = INTERIOR_MARGIN / sqrt(2)
+    corner = "ST_{axis}(circle.center) {sign} circle.radius * {half}"
+    rectangle = {
+        key: corner.format(axis=axis, sign=sign, half=half)
+        for key, axis, sign in (
+            ("xmin", "X", "-"),
+            ("ymin", "Y", "-"),
+            ("xmax", "X", "+"),
+            ("ymax", "Y", "+"),
+        )
+    }
+    return f"""(
+        SELECT pk_and_model, geometry, geometry_bbox,
+            CASE WHEN circle.radius > 0 THEN {{
+                'xmin': {rectangle["xmin"]},
+                'ymin': {rectangle["ymin"]},
+                'xmax': {rectangle["xmax"]},
+                'ymax': {rectangle["ymax"]}
+            }}::{INTERIOR_TYPE} END AS interior
+        FROM (
+            SELECT pk_and_model, geometry, geometry_bbox,
+                CASE
+                    WHEN ST_GeometryType(geometry::GEOMETRY)::VARCHAR
+                        IN ('POLYGON', 'MULTIPOLYGON')
+                    THEN ST_MaximumInscribedCircle(geometry::GEOMETRY)
+                END AS circle
+            FROM {relation}
+        )
+    )"""
+
+
+MAX_PIECE_VERTICES = 256
+# every round halves the pieces still over the vertex cap, stop at pieces of
+# 1/65536th of the AOI's bbox whatever is left in them
+MAX_SUBDIVIDE_ROUNDS = 16
+
+
+def float_bbox_sql(geometry: str) -> str:
+    """`geometry_bbox` struct for `geometry`, rounded outwards to FLOAT so
+    the box still covers the geometry."""
+
+    def bound(func, direction):
+        return f"nextafter({func}({geometry})::FLOAT, '{direction}'::FLOAT)"
+
+    return f"""{{
+            'xmin': {bound("ST_XMin", "-inf")},
+            'ymin': {bound("ST_YMin", "-inf")},
+            'xmax': {bound("ST_XMax", "inf")},
+            'ymax': {bound("ST_YMax", "inf")}
+        }}"""
+
+
+def write_subdivided_subscriptions(
+    con,
+    aois_path: str,
+    out_path: str,
+    max_vertices: int = MAX_PIECE_VERTICES,
+) -> tuple[int, int]:
+    """Split polygon AOIs with more than `max_vertices` vertices into
+    pieces that each keep the AOI's `pk_and_model`, by halving them along
+    the longer side of their bbox until every piece is under the cap. Pieces
+    have tighter bboxes and cheaper ST_Intersects calls, and the compare
+    merges their matches back to one row per AOI. Other AOIs are copied as
+    they are. Rows without an interior rectangle, the new pieces among them,
+    get one. Returns the number of AOIs and of pieces written."""
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE pieces AS
+        SELECT pk_and_model, geometry::GEOMETRY AS geometry, geometry_bbox,
+            {interior_sql(con, aois_path)} AS interior
+        FROM read_parquet('{aois_path}')
+    """)
+    oversized = f"""
+        ST_NPoints(geometry) > {max_vertices}
+        AND ST_GeometryType(geometry)::VARCHAR IN ('POLYGON', 'MULTIPOLYGON')
+    """
+    try:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE oversized AS
+            SELECT pk_and_model, geometry, geometry_bbox
+            FROM pieces WHERE {oversized}
+        """)
+        con.execute(f"DELETE FROM pieces WHERE {oversized}")
+        for _ in range(MAX_SUBDIVIDE_ROUNDS):
+            (left,) = con.execute("SELECT count(*) FROM oversized").fetchone()
+            if left == 0:
+                break
+            con.execute(f"""
+                CREATE OR REPLACE TEMP TABLE oversized AS
+                SELECT pk_and_model, part.geom AS geometry,
+                    {float_bbox_sql("part.geom")} AS geometry_bbox
+                FROM (
+                    SELECT pk_and_model, unnest(ST_Dump(ST_CollectionExtract(
+                        ST_Intersection(geometry, half), 3
+                    ))) AS part
+                    FROM (
+                        SELECT pk_and_model, geometry, unnest(
+                            CASE WHEN x1 - x0 >= y1 - y0 THEN [
+                                ST_MakeEnvelope(x0, y0, (x0 + x1) / 2, y1),
+                                ST_MakeEnvelope((x0 + x1) / 2, y0, x1, y1)
+                            ] ELSE [
+                                ST_MakeEnvelope(x0, y0, x1, (y0 + y1) / 2),
+                                ST_MakeEnvelope(x0, (y0 + y1) / 2, x1, y1)
+                            ] END
+                        ) AS half
+                        FROM (
+                            SELECT pk_and_model, geometry,
+                                ST_XMin(geometry) AS x0,
+                                ST_YMin(geometry) AS y0,
+                                ST_XMax(geometry) AS x1,
+                                ST_YMax(geometry) AS y1
+                            FROM oversized
+                        )
+                    )
+                )
+                WHERE NOT ST_IsEmpty(part.geom)
+            """)
+            con.execute(f"""
+                INSERT INTO pieces BY NAME
+                FROM oversized WHERE ST_NPoints(geometry) <= {max_vertices}
+            """)
+            con.execute(f"""
+                DELETE FROM oversized
+                WHERE ST_NPoints(geometry) <= {max_vertices}
+            """)
+        con.execute("INSERT INTO pieces BY NAME FROM oversized")
+
+        con.execute(f"""
+            COPY (
+                SELECT pk_and_model, geometry, geometry_bbox, interior
+                FROM pieces WHERE interior IS NOT NULL
+                UNION ALL
+                SELECT pk_and_model, geometry, geometry_bbox, interior
+                FROM {interior_rectangles_sql(
+                    "(FROM pieces WHERE interior IS NULL)"
+                )}
+            )
+            TO '{out_path}'
+            (FORMAT parquet, COMPRESSION zstd)
+        """)
+        return con.execute(
+            "SELECT count(DISTINCT pk_and_model), count(*) FROM pieces"
+        ).fetchone()
+    finally:
+        con.execute("DROP TABLE IF EXISTS pieces")
+        con.execute("DROP TABLE IF EXISTS oversized")
+
+
+def geoparquet_metadata(con, relation: str) -> str:
+    """GeoParquet 1.1 metadata for `relation`, including the bbox covering
+    that points readers at the `geometry_bbox` struct column."""
+    xmin, ymin, xmax, ymax, types = con.execute(f"""
+        SELECT
+            min(geometry_bbox.xmin), min(geometry_bbox.ymin),
+            max(geometry_bbox.xmax), max(geometry_bbox.ymax),
+            list(DISTINCT ST_GeometryType(geometry)::VARCHAR)
+        FROM {relation}
+    """).fetchone()
+    covering = {
+        k: ["geometry_bbox", k] for k in ("xmin", "ymin", "xmax", "ymax")
+    }
+    geo = {
+        "version": "1.1.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {
+                "encoding": "WKB",
+                "geometry_types": sorted(
+                    GEOPARQUET_TYPES[t] for t in types if t is not None
+                ),
+                "bbox": [xmin, ymin, xmax, ymax],
+                "covering": {"bbox": covering},
+            }
+        },
+    }
+    return json.dumps(geo)
+
+
+def write_sorted_subscriptions(
+    con, aois_path: str, out_path: str, row_group_size: int | None = None
+) -> int:
+    """Write subscriptions ordered along a Hilbert curve over their bbox
+    centers, so each row group covers a compact area and the compare's bbox
+    filter can skip most of them using parquet statistics, with the interior
+    rectangles the compare accepts tiles by. Returns the row group size
+    used."""
+    relation = f"read_parquet('{aois_path}')"
+    if row_group_size is None:
+        (count,) = con.execute(f"SELECT count(*) FROM {relation}").fetchone()
+        row_group_size = pick_row_group_size(count)
+
+    geo = geoparquet_metadata(con, relation).replace("'", "''")
+    con.execute(f"""
+        COPY (
+            WITH bounds AS (
+                SELECT {{
+                    'min_x': min(geometry_bbox.xmin),
+                    'min_y': min(geometry_bbox.ymin),
+                    'max_x': max(geometry_bbox.xmax),
+                    'max_y': max(geometry_bbox.ymax)
+                }}::BOX_2D AS box
+                FROM {relation}
+            )
+            SELECT pk_and_model, geometry, geometry_bbox, interior
+            FROM {interior_rectangles_sql(relation)}, bounds
+            ORDER BY ST_Hilbert(
+                (geometry_bbox.xmin + geometry_bbox.xmax) / 2,
+                (geometry_bbox.ymin + geometry_bbox.ymax) / 2,
+                bounds.box
+            )
+        )
+        TO '{out_path}'
+        (
+            FORMAT parquet,
+            COMPRESSION zstd,
+            ROW_GROUP_SIZE {row_group_size},
+            GEOPARQUET_VERSION 'NONE',
+            KV_METADATA {{geo: '{geo}'}}
+        )
+    """)
+    return row_group_size
+
+
+class DeltaStore:
+    """Delta log subscriptions under `root`, a local directory or an s3://
+    prefix. Base and delta files are written once under new names and the
+    log is replaced with a conditional write, so concurrent publishers can't
+    lose each other's updates and readers always see a complete version."""
+
+    def __init__(self, root: str, s3=None):
+        self.root = root.rstrip("/")
+        self.s3 = s3
+        if self.root.startswith("s3://"):
+            self.bucket, _, self.prefix = self.root[5:].partition("/")
+            if self.s3 is None:
+                self.s3 = boto3.client("s3")
+        else:
+            os.makedirs(self.root, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return f"{self.root}/{name}"
+
+    def read_log(self) -> tuple[dict | None, str | None]:
+        """Current log and its ETag, or (None, None) if there is no log."""
+        if self.s3 is None:
+            log_path = self.path(DELTA_LOG_NAME)
+            if not os.path.exists(log_path):
+                return None, None
+            with open(log_path, "rb") as f:
+                body = f.read()
+            return json.loads(body), hashlib.md5(body).hexdigest()
+
+        try:
+            res = self.s3.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}/{DELTA_LOG_NAME}"
+            )
+        except self.s3.exceptions.NoSuchKey:
+            return None, None
+        return json.loads(res["Body"].read()), res["ETag"]
+
+    def write_log(self, log: dict, etag: str | None):
+        """Replace the log if it is still at `etag`, or create it if `etag`
+        is None and there is no log yet."""
+        body = json.dumps(log).encode()
+        if self.s3 is None:
+            _, current = self.read_log()
+            if current != etag:
+                raise RuntimeError("Delta log changed while it was updated.")
+            with open(self.path(DELTA_LOG_NAME), "wb") as f:
+                f.write(body)
+            return
+
+        condition = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}/{DELTA_LOG_NAME}",
+            Body=body,
+            **condition,
+        )
+
+    def subscriptions(
+        self, log: dict, version: int | None = None
+    ) -> DeltaSubscriptions:
+        """Files of the log's current version, or of an earlier `version`
+        that has not been compacted into the base yet."""
+        if version is not None and version < log["base_version"]:
+            raise ValueError(
+                f"Version {version} was compacted into the version "
+                f"{log['base_version']} base."
+            )
+        return DeltaSubscriptions(
+            self.path(log["base"]),
+            log["base_version"],
+            [
+                (d["version"], self.path(d["path"]))
+                for d in log["deltas"]
+                if version is None or d["version"] <= version
+            ],
+        )
+
+
+def init_delta_log(con, store: DeltaStore, aois_path: str) -> dict:
+    """Start a delta log with `aois_path` as the version 0 base."""
+    base = "base-00000000.parquet"
+    con.execute(f"""
+        COPY (
+            SELECT pk_and_model, geometry, geometry_bbox,
+                {interior_sql(con, aois_path)} AS interior
+            FROM read_parquet('{aois_path}')
+        )
+        TO '{store.path(base)}'
+        (FORMAT parquet, COMPRESSION zstd)
+    """)
+    log = {"version": 0, "base": base, "base_version": 0, "deltas": []}
+    store.write_log(log, None)
+    return log
+
+
+def append_delta(
+    con,
+    store: DeltaStore,
+    adds_path: str | None = None,
+    removes: list[str] | tuple = (),
+) -> dict:
+    """Add or replace the AOIs in `adds_path` and remove the AOIs keyed by
+    `removes` as a new version of the log."""
+    log, etag = store.read_log()
+    version = log["version"] + 1
+    name = f"delta-{version:08d}.parquet"
+
+    rows = []
+    if adds_path is not None:
+        rows.append(f"""
+            SELECT pk_and_model, geometry::GEOMETRY AS geometry, geometry_bbox,
+                {interior_sql(con, adds_path)} AS interior, 'add' AS op
+            FROM read_parquet('{adds_path}')
+        """)
+    if removes:
+        keys = ", ".join("'{}'".format(k.replace("'", "''")) for k in removes)
+        rows.append(f"""
+            SELECT
+                unnest([{keys}]) AS pk_and_model,
+                NULL::GEOMETRY AS geometry,
+                NULL::STRUCT(xmin FLOAT, ymin FLOAT, xmax FLOAT, ymax FLOAT)
+                    AS geometry_bbox,
+                {NO_INTERIOR} AS interior,
+                'remove' AS op
+        """)
+    if not rows:
+        raise ValueError("A delta needs AOIs to add or keys to remove.")
+
+    con.execute(f"""
+        COPY ({"UNION ALL".join(rows)})
+        TO '{store.path(name)}'
+        (FORMAT parquet, COMPRESSION zstd)
+    """)
+    log = dict(log, version=version)
+    log["deltas"] = log["deltas"] + [{"version": version, "path": name}]
+    store.write_log(log, etag)
+    return log
+
+
+def compact_delta_log(con, store: DeltaStore, max_deltas: int = 8) -> bool:
+    """Fold the deltas into a new base once there are more than
+    `max_deltas` of them. Replaced files are left in place for readers still
+    on the previous version, an S3 lifecycle rule can expire them."""
+    log, etag = store.read_log()
+    if len(log["deltas"]) <= max_deltas:
+        return False
+
+    version = log["version"]
+    base = f"base-{version:08d}.parquet"
+    merged = get_aois_relation(con, store.subscriptions(log))
+    con.execute(f"""
+        COPY (SELECT * FROM {merged})
+        TO '{store.path(base)}'
+        (FORMAT parquet, COMPRESSION zstd)
+    """)
+    log = {"version": version, "base": base, "base_version": version,
+           "deltas": []}
+    store.write_log(log, etag)
+    return True
+
+
+def changed_subscriptions_sql(old: str, new: str) -> str:
+    """SQL for the AOIs of relation `new` that are not in relation `old` or
+    whose geometry differs from it, comparing all pieces of subdivided AOIs.
+    Both are subscription relations as made by `get_aois_relation`."""
+
+    def shapes(relation):
+        return f"""(
+                SELECT pk_and_model,
+                    list_sort(list(ST_AsWKB(geometry::GEOMETRY))) AS shape
+                FROM {relation}
+                GROUP BY pk_and_model
+            )"""
+
+    return f"""(
+            SELECT new.pk_and_model, new.geometry::GEOMETRY AS geometry,
+                new.geometry_bbox, new.interior
+            FROM {new} AS new
+            SEMI JOIN (
+                SELECT new.pk_and_model
+                FROM {shapes(new)} AS new
+                LEFT JOIN {shapes(old)} AS old
+                    ON old.pk_and_model = new.pk_and_model
+                WHERE old.pk_and_model IS NULL
+                    OR new.shape IS DISTINCT FROM old.shape
+            ) AS changed
+            ON changed.pk_and_model = new.pk_and_model
+        )"""
+
+
+def backfill_subscriptions(
+    con, changed: str, catalog_path: str, outpath: str, layout: str = "aoi"
+) -> list[str]:
+    """Match the AOIs of relation `changed` against the tile files recorded
+    in the tile catalog at `catalog_path`, writing the intersections to
+    `outpath` in the compare's output `layout`. Only catalog files whose
+    extent touches a changed AOI are read. Returns the tile files read."""
+    con.execute(f"CREATE OR REPLACE TEMP TABLE changed AS FROM {changed}")
+    keys = con.execute(f"""
+        SELECT DISTINCT catalog.key
+        FROM read_parquet('{catalog_path}/*.parquet') AS catalog
+        JOIN changed AS aois
+        ON aois.geometry_bbox.xmin <= catalog.bbox.xmax
+            AND aois.geometry_bbox.xmax >= catalog.bbox.xmin
+            AND aois.geometry_bbox.ymin <= catalog.bbox.ymax
+            AND aois.geometry_bbox.ymax >= catalog.bbox.ymin
+        ORDER BY catalog.key
+    """).fetchall()
+    keys = [k for (k,) in keys]
+    if keys:
+        write_intersects(
+            con, "changed", f"read_parquet({keys})", outpath, layout=layout
+        )
+    else:
+        write_empty_intersects(con, outpath, layout)
+    con.execute("DROP TABLE changed")
+    return keys
+
+
+def compact_tile_catalog(con, catalog_path: str, s3=None) -> tuple[int, int]:
+    """Fold the files of the tile catalog at `catalog_path`, a local
+    directory or an s3:// prefix, into one file with a row per tile file,
+    the latest where a file was processed more than once. Returns the
+    number of files folded and of rows kept.
+
+    Files the Lambdas write while it runs are left for the next compaction.
+    Backfill reads the catalog keys distinctly, so readers that see the new
+    file next to the ones it replaces match the same tile files."""
+    catalog_path = catalog_path.rstrip("/")
+    files = [
+        f
+        for (f,) in con.execute(
+            f"SELECT file FROM glob('{catalog_path}/*.parquet')"
+        ).fetchall()
+    ]
+    if len(files) < 2:
+        return 0, 0
+
+    compacted = f"{catalog_path}/compacted-{uuid4()}.parquet"
+    con.execute(f"""
+        COPY (
+            SELECT key, bbox, tiles, ingested_at
+            FROM read_parquet({files})
+            QUALIFY row_number() OVER (
+                PARTITION BY key ORDER BY ingested_at DESC
+            ) = 1
+            ORDER BY key
+        )
+        TO '{compacted}'
+        (FORMAT parquet, COMPRESSION zstd)
+    """)
+    (rows,) = con.execute(
+        f"SELECT count(*) FROM read_parquet('{compacted}')"
+    ).fetchone()
+
+    if catalog_path.startswith("s3://"):
+        s3 = s3 or boto3.client("s3")
+        bucket = catalog_path[5:].partition("/")[0]
+        keys = [f.removeprefix(f"s3://{bucket}/") for f in files]
+        for start in range(0, len(keys), 1000):
+            s3.delete_objects(
+                Bucket=bucket,
+                Delete={
+                    "Objects": [{"Key": k} for k in keys[start:start + 1000]],
+                    "Quiet": True,
+                },
+            )
+    else:
+        for f in files:
+            os.remove(f)
+    return len(files), rows
+
+
+def index(args):
+    con = get_connection(args.region, args.s3_endpoint)
+    build_subscription_index(con, args.aois_path, args.db_path)
+
+
+def partition(args):
+    con = get_connection(args.region, args.s3_endpoint)
+    manifest = write_partitioned_subscriptions(
+        con, args.aois_path, args.out_dir, args.cell_size
+    )
+    print(
+        f"Wrote {len(manifest['cells'])} grid cells of {args.cell_size} "
+        f"degrees to {args.out_dir}"
+    )
+
+
+def subdivide(args):
+    con = get_connection(args.region, args.s3_endpoint)
+    aois, pieces = write_subdivided_subscriptions(
+        con, args.aois_path, args.out_path, args.max_vertices
+    )
+    print(
+        f"Wrote {aois} AOIs in {pieces} pieces of at most "
+        f"{args.max_vertices} vertices to {args.out_path}"
+    )
+
+
+def sort(args):
+    con = get_connection(args.region, args.s3_endpoint)
+    row_group_size = write_sorted_subscriptions(
+        con, args.aois_path, args.out_path, args.row_group_size
+    )
+    print(
+        f"Wrote Hilbert sorted subscriptions to {args.out_path} with "
+        f"{row_group_size} rows per row group"
+    )
+
+
+def delta(args):
+    con = get_connection(args.region, args.s3_endpoint)
+    store = DeltaStore(args.root)
+    if args.action == "init":
+        log = init_delta_log(con, store, args.aois_path)
+    elif args.action == "append":
+        log = append_delta(con, store, args.adds, args.removes)
+        if args.max_deltas is not None:
+            compact_delta_log(con, store, args.max_deltas)
+    elif args.action == "compact":
+        compact_delta_log(con, store, args.max_deltas or 0)
+    log, _ = store.read_log()
+    print(
+        f"Delta log at {args.root} is at version {log['version']} with "
+        f"{len(log['deltas'])} deltas"
+    )
+
+
+def backfill(args):
+    con = get_connection(args.region, args.s3_endpoint)
+    if args.delta is not None:
+        store = DeltaStore(args.delta)
+        log, _ = store.read_log()
+        old = get_aois_relation(con, store.subscriptions(log, args.since))
+        new = get_aois_relation(con, store.subscriptions(log))
+    elif args.old is not None and args.new is not None:
+        old = get_aois_relation(con, args.old)
+        new = get_aois_relation(con, args.new)
+    else:
+        raise ValueError("Backfill needs --old and --new, or --delta.")
+
+    root = args.root.rstrip("/")
+    outpath = f"{root}/intersects/backfill-{uuid4()}.parquet"
+    keys = backfill_subscriptions(
+        con,
+        changed_subscriptions_sql(old, new),
+        f"{root}/catalog",
+        outpath,
+        args.output_layout,
+    )
+    print(f"Backfilled against {len(keys)} tile files to {outpath}")
+    if args.sns_out_arn is not None:
+        sns = boto3.client("sns", region_name=args.region)
+        res = get_pass_res(keys, outpath, layout=args.output_layout)
+        sns.publish(TopicArn=args.sns_out_arn, **res)
+
+
+def catalog(args):
+    con = get_connection(args.region, args.s3_endpoint)
+    files, rows = compact_tile_catalog(
+        con, f"{args.root.rstrip('/')}/catalog"
+    )
+    print(f"Compacted {files} tile catalog files into {rows} rows")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--region", default=None)
+    parser.add_argument("--s3-endpoint", default=None)
+    commands = parser.add_subparsers(required=True)
+
+    index_cmd = commands.add_parser(
+        "index",
+        help="Build the R-tree indexed subscriptions database, to be "
+        "uploaded as {prefix}/subs/subscriptions.duckdb.",
+    )
+    index_cmd.add_argument("aois_path", help="Subscriptions parquet.")
+    index_cmd.add_argument("db_path", help="Local output database path.")
+    index_cmd.set_defaults(func=index)
+
+    partition_cmd = commands.add_parser(
+        "partition",
+        help="Write grid partitioned subscriptions, to be synced to "
+        "{prefix}/subs/cells/ with the manifest uploaded last.",
+    )
+    partition_cmd.add_argument("aois_path", help="Subscriptions parquet.")
+    partition_cmd.add_argument("out_dir", help="Local output directory.")
+    partition_cmd.add_argument(
+        "--cell-size", type=float, default=1.0, help="Grid cell size, degrees."
+    )
+    partition_cmd.set_defaults(func=partition)
+
+    subdivide_cmd = commands.add_parser(
+        "subdivide",
+        help="Split AOIs with many vertices into smaller pieces, to be "
+        "sorted, partitioned or indexed like any subscriptions.",
+    )
+    subdivide_cmd.add_argument("aois_path", help="Subscriptions parquet.")
+    subdivide_cmd.add_argument("out_path", help="Output parquet path.")
+    subdivide_cmd.add_argument(
+        "--max-vertices",
+        type=int,
+        default=MAX_PIECE_VERTICES,
+        help="Most vertices in a piece.",
+    )
+    subdivide_cmd.set_defaults(func=subdivide)
+
+    sort_cmd = commands.add_parser(
+        "sort",
+        help="Write subscriptions sorted along a Hilbert curve, to be "
+        "uploaded as {prefix}/subs/subscriptions.parquet.",
+    )
+    sort_cmd.add_argument("aois_path", help="Subscriptions parquet.")
+    sort_cmd.add_argument("out_path", help="Output parquet path.")
+    sort_cmd.add_argument(
+        "--row-group-size",
+        type=int,
+        default=None,
+        help="Rows per row group, picked from the AOI count if not set.",
+    )
+    sort_cmd.set_defaults(func=sort)
+
+    delta_cmd = commands.add_parser(
+        "delta",
+        help="Manage delta log subscriptions under {prefix}/subs/delta/.",
+    )
+    delta_cmd.add_argument("action", choices=("init", "append", "compact"))
+    delta_cmd.add_argument("root", help="Local directory or s3:// prefix.")
+    delta_cmd.add_argument(
+        "aois_path", nargs="?", help="Subscriptions parquet, for init."
+    )
+    delta_cmd.add_argument("--adds", help="Parquet of AOIs to add or replace.")
+    delta_cmd.add_argument(
+        "--removes", nargs="*", default=(), help="Keys of AOIs to remove."
+    )
+    delta_cmd.add_argument(
+        "--max-deltas",
+        type=int,
+        default=None,
+        help="Compact once the log has more deltas than this.",
+    )
+    delta_cmd.set_defaults(func=delta)
+
+    backfill_cmd = commands.add_parser(
+        "backfill",
+        help="Match new and changed subscriptions against the tile catalog, "
+        "writing the results to {prefix}/intersects/.",
+    )
+    backfill_cmd.add_argument(
+        "root", help="Deployment root, s3://{bucket}/{prefix}."
+    )
+    backfill_cmd.add_argument("--old", help="Previous subscriptions parquet.")
+    backfill_cmd.add_argument("--new", help="Current subscriptions parquet.")
+    backfill_cmd.add_argument(
+        "--delta", help="Delta log root, instead of --old and --new."
+    )
+    backfill_cmd.add_argument(
+        "--since",
+        type=int,
+        default=0,
+        help="Delta log version to diff the current version against.",
+    )
+    backfill_cmd.add_argument(
+        "--sns-out-arn", help="Topic to announce the results on, if any."
+    )
+    backfill_cmd.add_argument(
+        "--output-layout",
+        choices=OUTPUT_LAYOUTS,
+        default="aoi",
+        help="Layout of the results, as the compare's OUTPUT_LAYOUT.",
+    )
+    backfill_cmd.set_defaults(func=backfill)
+
+    catalog_cmd = commands.add_parser(
+        "catalog",
+        help="Compact the tile catalog under {prefix}/catalog/, one file per "
+        "compare, into a single file.",
+    )
+    catalog_cmd.add_argument(
+        "root", help="Deployment root, s3://{bucket}/{prefix}."
+    )
+    catalog_cmd.set_defaults(func=catalog)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
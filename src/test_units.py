@@ -1,14 +1,70 @@
 import json
 from pathlib import Path
+import duckdb
+import pytest
+import intersects_lambda
 import polars_st as st
+import pyarrow.parquet as pq
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 import os.path
+import re
+from concurrent.futures import ThreadPoolExecutor
+import time
+from fnmatch import fnmatch
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
 
 from intersects_lambda import (
+    OUTPUT_LAYOUTS,
     CloudConfig,
+    ConfigCache,
+    ResultLedger,
+    SubscriptionCache,
     get_pass_res,
     get_fail_res,
     apply_compare,
+    apply_compare_fanout,
+    apply_compare_inline,
+    apply_compare_streaming,
+    build_subscription_index,
+    compare_and_publish,
+    compare_records,
+    compare_unit_record,
+    delete_sqs_messages,
+    get_aois_relation,
+    get_data_etags,
+    message_bytes,
+    next_compare_mode,
+    plan_groups,
+    plan_record_groups,
+    plan_tile_chunks,
+    result_key,
+    profiling,
+    write_compare,
+    write_empty_intersects,
+    write_intersects,
+    write_tile_catalog,
+)
+from conftest import read_intersects, set_local_env
+from bench import SYNTHETIC_EXTENT, write_synthetic
+from local_aws import LocalAWS, LocalS3, s3_event_body, sqs_event
+from worker import Worker
+from publish import (
+    DeltaStore,
+    append_delta,
+    backfill_subscriptions,
+    changed_subscriptions_sql,
+    compact_delta_log,
+    compact_tile_catalog,
+    init_delta_log,
+    pick_row_group_size,
+    write_partitioned_subscriptions,
+    write_sorted_subscriptions,
+    write_subdivided_subscriptions,
 )
 
 
@@ -94,6 +150,7 @@ def test_pass_res():
     assert "StringValue" in attrs["status"]
     assert "DataType" in attrs["status"]
     assert attrs["status"]["StringValue"] == "succeeded"
+    assert attrs["output_layout"]["StringValue"] == "aoi"
 
 
 def test_config():
@@ -125,4 +182,1610 @@ def test_config():
         with TemporaryDirectory() as td:
             assert os.path.dirname(td) == os.path.dirname(td_name)
         a = config.con.sql("select 1")
-        assert a.pl().get_column("1").to_list()[0] == 1
\ No newline at end of file
+        assert a.pl().get_column("1").to_list()[0] == 1
+
+
+def test_config_cert():
+    """Test that only the cert is fetched without TLS verification and that
+    every client, S3 included, verifies with it afterwards."""
+    bucket = "tns-fake-bucket"
+    with TemporaryDirectory() as td, LocalAWS(td) as aws:
+        aws.s3.put_object(Bucket=bucket, Key="fake/cert.pem", Body=b"cert")
+        clients = []
+
+        def client(service_name, *args, **kwargs):
+            clients.append((service_name, kwargs.get("verify")))
+            return aws.client(service_name)
+
+        with mock.patch("boto3.client", client):
+            config = CloudConfig(
+                "us-west-2", "fake-sns-arn", bucket, "fake", 2**10,
+                "fake/cert.pem",
+            )
+        try:
+            assert config.using_certs
+            with open(config.cert_dest, "rb") as f:
+                assert f.read() == b"cert"
+            assert clients == [
+                ("s3", False),
+                ("s3", config.cert_dest),
+                ("sns", config.cert_dest),
+                ("sqs", config.cert_dest),
+            ]
+        finally:
+            config.close()
+
+
+def test_config_cache():
+    """Test that configs and their connections are reused between invocations
+    and rebuilt when the environment changes."""
+    cache = ConfigCache()
+    args = ("us-west-2", "fake-sns-arn", "tns-fake-bucket", "fake", 5 * 2**10)
+
+    config, warm = cache.get(*args)
+    assert not warm
+    assert config.keep_alive
+    with config:
+        con = config.con
+
+    # connection survives the context and is reused on the next hit
+    again, warm = cache.get(*args)
+    assert warm
+    assert again is config
+    with again:
+        assert again.con is con
+
+    # broken connections are replaced by the health check
+    con.close()
+    with again:
+        assert again.con is not con
+        a = again.con.sql("select 1")
+        assert a.fetchone()[0] == 1
+
+    # changed memory limit invalidates the cached config
+    changed, warm = cache.get(*args[:-1], 3 * 2**10)
+    assert not warm
+    assert changed is not config
+    assert config.con is None
+    assert changed.mem_limit == "3.0GB"
+
+    metric = cache.metric(warm)
+    assert metric["config_cache"] == "miss"
+    assert metric["config_cache_hits"] == 1
+    assert metric["config_cache_misses"] == 2
+    cache.clear()
+
+
+class FakeS3:
+    """Minimal S3 client answering conditional GetObject calls."""
+
+    def __init__(self, body: bytes, etag: str):
+        self.body = body
+        self.etag = etag
+        self.gets = 0
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.gets += 1
+        if IfNoneMatch == self.etag:
+            raise ClientError(
+                {"Error": {"Code": "304", "Message": "Not Modified"}},
+                "GetObject",
+            )
+        return {
+            "ETag": self.etag,
+            "Body": StreamingBody(BytesIO(self.body), len(self.body)),
+        }
+
+
+class FakeSQS:
+    """Minimal SQS client recording queue URL lookups and batch deletes."""
+
+    def __init__(self):
+        self.lookups = []
+        self.deletes = []
+
+    def get_queue_url(self, QueueName):
+        self.lookups.append(QueueName)
+        return {"QueueUrl": f"https://sqs.fake/{QueueName}"}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deletes.append((QueueUrl, Entries))
+        failed = [
+            {"Id": e["Id"], "Code": "ReceiptHandleIsInvalid"}
+            for e in Entries
+            if e["ReceiptHandle"] == "bad"
+        ]
+        return {"Successful": [], "Failed": failed}
+
+
+class FakeSNS:
+    """Minimal SNS client recording published messages."""
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, TopicArn, **kwargs):
+        self.published.append(kwargs)
+
+
+def test_delete_sqs_messages(fake_config: CloudConfig):
+    """Test that messages are deleted in batches of ten per queue, with each
+    queue URL looked up once."""
+    fake_config.sqs = FakeSQS()
+    arn = "arn:aws:sqs:us-west-2:000000000000:{}"
+    events = [
+        {"eventSourceARN": arn.format("in"), "receiptHandle": f"r{n}"}
+        for n in range(23)
+    ]
+    events.append(
+        {"eventSourceARN": arn.format("other"), "receiptHandle": "bad"}
+    )
+
+    failed = delete_sqs_messages(events, fake_config)
+    assert [f["Code"] for f in failed] == ["ReceiptHandleIsInvalid"]
+    deletes = fake_config.sqs.deletes
+    assert [len(entries) for _, entries in deletes] == [10, 10, 3, 1]
+    assert deletes[0][0] == "https://sqs.fake/in"
+
+    # queue URLs are cached on the config
+    delete_sqs_messages(events, fake_config)
+    assert fake_config.sqs.lookups == ["in", "other"]
+
+
+def test_subscription_cache(small_aois_path: Path):
+    """Test that subscriptions are only downloaded when their ETag changes."""
+    body = small_aois_path.read_bytes()
+    s3 = FakeS3(body, '"v1"')
+    with TemporaryDirectory() as td:
+        key = "fake/subs/subscriptions.parquet"
+        cache = SubscriptionCache(s3, "bucket", key, td)
+
+        path = cache.fetch()
+        assert path == os.path.join(td, "subscriptions.parquet")
+        with open(path, "rb") as f:
+            assert f.read() == body
+        assert cache.fetches == 1
+
+        # unchanged object is revalidated, not downloaded
+        assert cache.fetch() == path
+        assert cache.fetches == 1
+        assert cache.hits == 1
+
+        # new version is downloaded over the old copy
+        s3.body = b"new version"
+        s3.etag = '"v2"'
+        assert cache.fetch() == path
+        with open(path, "rb") as f:
+            assert f.read() == b"new version"
+        assert cache.etag == '"v2"'
+        assert cache.fetches == 2
+        assert s3.gets == 3
+
+
+def test_subscription_index(
+    small_tiles_path: Path, small_aois_path: Path, fake_config: CloudConfig
+):
+    """Test that the R-tree indexed subscriptions database gives the same
+    intersections as the parquet, reading the AOIs within the tiles' extent
+    with an index scan, and is rebuilt per subscription version."""
+    datapaths = [small_tiles_path.as_posix()]
+
+    with TemporaryDirectory() as td, fake_config:
+        con = fake_config.con
+        parquet_out = os.path.join(td, "parquet_out.parquet")
+        apply_compare(datapaths, fake_config, parquet_out)
+
+        db_path = os.path.join(td, "subscriptions.duckdb")
+        build_subscription_index(con, fake_config.aois_path, db_path)
+        index_out = os.path.join(td, "index_out.parquet")
+        fake_config.aois_path = db_path
+        apply_compare(datapaths, fake_config, index_out)
+
+        assert len(read_intersects(con, index_out)) == 50
+        assert read_intersects(con, index_out) == read_intersects(
+            con, parquet_out
+        )
+
+        extent = intersects_lambda.get_tiles_extent(con, datapaths)
+        aois = get_aois_relation(con, db_path, extent)
+        plan = con.execute(f"EXPLAIN SELECT * FROM {aois}").fetchall()
+        assert "RTREE_INDEX_SCAN" in plan[0][1]
+        assert "SEQ_SCAN" not in plan[0][1]
+
+        # locally built indexes follow the cached parquet's version
+        cache_dir = os.path.join(td, "cache")
+        fake_config.s3 = FakeS3(small_aois_path.read_bytes(), '"v1"')
+        fake_config.enable_subscription_cache(cache_dir, "local")
+        v1_path = fake_config.get_aois_path()
+        assert v1_path == os.path.join(cache_dir, "subscriptions-v1.duckdb")
+        assert fake_config.get_aois_path() == v1_path
+
+        fake_config.s3.etag = '"v2"'
+        v2_path = fake_config.get_aois_path()
+        assert v2_path == os.path.join(cache_dir, "subscriptions-v2.duckdb")
+        assert os.path.exists(v2_path)
+        assert not os.path.exists(v1_path)
+
+
+def test_partitioned_subscriptions(
+    small_tiles_path: Path, test_dir: Path, fake_config: CloudConfig
+):
+    """Test that grid partitioned subscriptions give the same intersections
+    as the flat file while only reading the partitions the tiles touch."""
+    datapaths = [small_tiles_path.as_posix()]
+
+    with TemporaryDirectory() as td, fake_config:
+        con = fake_config.con
+        flat_out = os.path.join(td, "flat_out.parquet")
+        apply_compare(datapaths, fake_config, flat_out)
+
+        cells_dir = os.path.join(td, "cells")
+        manifest = write_partitioned_subscriptions(
+            con, fake_config.aois_path, cells_dir, cell_size=5.0
+        )
+        assert manifest["cell_size"] == 5.0
+        assert os.path.exists(os.path.join(cells_dir, "manifest.json"))
+
+        fake_config.subs_layout = "partitioned"
+        fake_config.cells_path = cells_dir
+        part_out = os.path.join(td, "part_out.parquet")
+        apply_compare(datapaths, fake_config, part_out)
+
+        assert len(read_intersects(con, part_out)) == 50
+        assert read_intersects(con, part_out) == read_intersects(
+            con, flat_out
+        )
+
+        # a single tile only needs the partitions around it
+        one_tile = [(test_dir / "data" / "one_tile.parquet").as_posix()]
+        paths = fake_config.get_aois_path(one_tile)
+        all_parts = sum(len(p) for p in manifest["cells"].values())
+        assert 0 < len(paths) < all_parts
+
+        # tiles outside every partition produce an empty result
+        with open(os.path.join(cells_dir, "manifest.json"), "w") as f:
+            json.dump({"cell_size": 5.0, "cells": {}}, f)
+        empty_out = os.path.join(td, "empty_out.parquet")
+        apply_compare(one_tile, fake_config, empty_out)
+        assert read_intersects(con, empty_out) == {}
+
+
+def test_sorted_subscriptions(
+    metrics: intersects_lambda.Metrics,
+    small_tiles_path: Path,
+    small_aois_path: Path,
+    fake_config: CloudConfig,
+):
+    """Test that Hilbert sorted subscriptions keep every AOI, carry bbox
+    covering metadata and give the same intersections, with the pairs
+    inside interior rectangles counted with metrics enabled."""
+    assert pick_row_group_size(10) == 2048
+    assert pick_row_group_size(100_000_000) == 100_000
+    assert pick_row_group_size(2_560_000) == 10_000
+
+    datapaths = [small_tiles_path.as_posix()]
+
+    with TemporaryDirectory() as td, fake_config:
+        con = fake_config.con
+        flat_out = os.path.join(td, "flat_out.parquet")
+        apply_compare(datapaths, fake_config, flat_out)
+
+        sorted_path = os.path.join(td, "sorted.parquet")
+        size = write_sorted_subscriptions(
+            con, fake_config.aois_path, sorted_path, row_group_size=10
+        )
+        assert size == 10
+
+        geo = con.execute(
+            f"SELECT value FROM parquet_kv_metadata('{sorted_path}') "
+            "WHERE key = 'geo'"
+        ).fetchone()[0]
+        geo = json.loads(geo)["columns"]["geometry"]
+        assert geo["covering"]["bbox"]["xmin"] == ["geometry_bbox", "xmin"]
+        assert geo["geometry_types"] == ["Polygon"]
+
+        keys = con.execute(
+            f"SELECT pk_and_model FROM read_parquet('{sorted_path}')"
+        ).fetchall()
+        assert sorted(keys) == sorted(
+            con.execute(
+                f"SELECT pk_and_model FROM read_parquet('{small_aois_path}')"
+            ).fetchall()
+        )
+
+        sorted_out = os.path.join(td, "sorted_out.parquet")
+        fake_config.aois_path = sorted_path
+        apply_compare(datapaths, fake_config, sorted_out)
+
+        assert read_intersects(con, sorted_out) == read_intersects(
+            con, flat_out
+        )
+
+        # every polygon gets an interior rectangle inside its bbox
+        (outside,) = con.execute(f"""
+            SELECT count(*) FROM read_parquet('{sorted_path}')
+            WHERE interior IS NULL
+                OR interior.xmin < geometry_bbox.xmin
+                OR interior.xmax > geometry_bbox.xmax
+                OR interior.ymin < geometry_bbox.ymin
+                OR interior.ymax > geometry_bbox.ymax
+        """).fetchone()
+        assert outside == 0
+
+        # small tiles in the middle of each interior skip ST_Intersects
+        # and match the same AOIs as the exact test
+        inner_path = os.path.join(td, "inner_tiles.parquet")
+        con.execute(f"""
+            COPY (
+                SELECT pk_and_model, geometry,
+                    {{
+                        'xmin': ST_XMin(geometry)::FLOAT,
+                        'ymin': ST_YMin(geometry)::FLOAT,
+                        'xmax': ST_XMax(geometry)::FLOAT,
+                        'ymax': ST_YMax(geometry)::FLOAT
+                    }} AS geometry_bbox
+                FROM (
+                    SELECT 'inner_' || pk_and_model AS pk_and_model,
+                        ST_Buffer(ST_Centroid(ST_MakeEnvelope(
+                            interior.xmin, interior.ymin,
+                            interior.xmax, interior.ymax
+                        )), 0.01) AS geometry
+                    FROM read_parquet('{sorted_path}')
+                )
+            ) TO '{inner_path}'
+        """)
+        inner = f"read_parquet(['{inner_path}'])"
+        counters = write_compare(con, sorted_path, inner, sorted_out)
+        assert 0 < counters["compare_fast_pairs"] <= counters["compare_pairs"]
+        counters = write_compare(
+            con, small_aois_path.as_posix(), inner, flat_out
+        )
+        assert counters["compare_fast_pairs"] == 0
+        # the flat result again, with the small tiles
+        assert read_intersects(con, sorted_out) == read_intersects(
+            con, flat_out
+        )
+
+
+def test_delta_subscriptions(
+    small_tiles_path: Path, small_aois_path: Path, fake_config: CloudConfig
+):
+    """Test that delta log subscriptions are merged at read time and give the
+    same intersections before and after compaction."""
+    datapaths = [small_tiles_path.as_posix()]
+
+    with TemporaryDirectory() as td, fake_config:
+        con = fake_config.con
+
+        def compare(name):
+            outpath = os.path.join(td, f"{name}.parquet")
+            apply_compare(datapaths, fake_config, outpath)
+            return read_intersects(con, outpath)
+
+        flat = compare("flat")
+
+        store = DeltaStore(os.path.join(td, "delta"))
+        init_delta_log(con, store, fake_config.aois_path)
+        fake_config.subs_layout = "delta"
+        fake_config.delta_path = store.root
+        assert compare("base") == flat
+
+        # rename Alabama and drop Alaska in one delta, Texas in another
+        adds_path = os.path.join(td, "adds.parquet")
+        con.execute(f"""
+            COPY (
+                SELECT 'New Alabama' AS pk_and_model, geometry, geometry_bbox
+                FROM read_parquet('{small_aois_path}')
+                WHERE pk_and_model = 'Alabama'
+            ) TO '{adds_path}'
+        """)
+        append_delta(con, store, adds_path, ["Alabama", "Alaska"])
+        log = append_delta(con, store, removes=["Texas"])
+        assert log["version"] == 2
+        assert len(log["deltas"]) == 2
+
+        expected = dict(flat)
+        expected["New Alabama"] = expected.pop("Alabama")
+        expected.pop("Alaska")
+        expected.pop("Texas")
+        merged = compare("merged")
+        assert merged == expected
+
+        # nothing to do under the threshold, folded into a new base above it
+        assert not compact_delta_log(con, store, max_deltas=2)
+        assert compact_delta_log(con, store, max_deltas=1)
+        log, _ = store.read_log()
+        assert log["base"] == "base-00000002.parquet"
+        assert log["deltas"] == []
+        assert compare("compacted") == expected
+
+
+def test_backfill(
+    small_tiles_path: Path, small_aois_path: Path, fake_config: CloudConfig
+):
+    """Test that subscriptions added after tiles were processed are matched
+    against the tile catalog, and only those subscriptions."""
+    datapaths = [small_tiles_path.as_posix()]
+
+    with TemporaryDirectory() as td, fake_config:
+        con = fake_config.con
+
+        catalog_path = os.path.join(td, "catalog")
+        os.makedirs(catalog_path)
+        write_tile_catalog(
+            con, datapaths, os.path.join(catalog_path, "first.parquet")
+        )
+        key, tiles = con.execute(
+            f"SELECT key, tiles FROM read_parquet('{catalog_path}/*.parquet')"
+        ).fetchone()
+        assert key == datapaths[0]
+        assert tiles > 0
+
+        full_out = os.path.join(td, "full.parquet")
+        apply_compare(datapaths, fake_config, full_out)
+        full = read_intersects(con, full_out)
+
+        old_path = os.path.join(td, "old.parquet")
+        con.execute(f"""
+            COPY (
+                SELECT * FROM read_parquet('{small_aois_path}')
+                WHERE pk_and_model NOT IN ('Alabama', 'Texas')
+            ) TO '{old_path}'
+        """)
+        old = get_aois_relation(con, old_path)
+        changed = changed_subscriptions_sql(
+            old, get_aois_relation(con, small_aois_path.as_posix())
+        )
+        backfill_out = os.path.join(td, "backfill.parquet")
+        keys = backfill_subscriptions(con, changed, catalog_path, backfill_out)
+        assert keys == datapaths
+        assert read_intersects(con, backfill_out) == {
+            k: v for k, v in full.items() if k in ("Alabama", "Texas")
+        }
+
+        # nothing changed, nothing to match
+        unchanged = changed_subscriptions_sql(old, old)
+        backfill_subscriptions(con, unchanged, catalog_path, backfill_out)
+        assert read_intersects(con, backfill_out) == {}
+
+        # the same tile file processed again and another one, compacted
+        # into a single file with a row per tile file
+        other_path = os.path.join(td, "other.parquet")
+        con.execute(f"""
+            COPY (
+                SELECT * FROM read_parquet('{small_tiles_path}')
+                WHERE pk_and_model != 'raster_0'
+            ) TO '{other_path}'
+        """)
+        for name, paths in (("again", datapaths), ("other", [other_path])):
+            write_tile_catalog(
+                con, paths, os.path.join(catalog_path, f"{name}.parquet")
+            )
+        assert compact_tile_catalog(con, catalog_path) == (3, 2)
+        (compacted,) = os.listdir(catalog_path)
+        assert compacted.startswith("compacted-")
+        assert compact_tile_catalog(con, catalog_path) == (0, 0)
+        changed = changed_subscriptions_sql(
+            old, get_aois_relation(con, small_aois_path.as_posix())
+        )
+        keys = backfill_subscriptions(con, changed, catalog_path, backfill_out)
+        assert keys == sorted(datapaths + [other_path])
+
+
+def test_subdivided_subscriptions(
+    small_tiles_path: Path, small_aois_path: Path, fake_config: CloudConfig
+):
+    """Test that AOIs split into pieces keep their keys and give the same
+    intersections in every layout, one row per AOI."""
+    datapaths = [small_tiles_path.as_posix()]
+
+    with TemporaryDirectory() as td, fake_config:
+        con = fake_config.con
+
+        def compare(name, spill=False):
+            outpath = os.path.join(td, f"{name}_out.parquet")
+            apply_compare(datapaths, fake_config, outpath, spill)
+            return read_intersects(con, outpath)
+
+        flat = compare("flat")
+
+        pieces_path = os.path.join(td, "pieces.parquet")
+        aois, pieces = write_subdivided_subscriptions(
+            con, fake_config.aois_path, pieces_path, max_vertices=32
+        )
+        assert aois == 50
+        assert pieces > aois
+        (most,) = con.execute(
+            f"SELECT max(ST_NPoints(geometry)) FROM '{pieces_path}'"
+        ).fetchone()
+        assert most <= 32
+        # every piece gets an interior rectangle of its own
+        (missing,) = con.execute(
+            f"SELECT count(*) FROM '{pieces_path}' WHERE interior IS NULL"
+        ).fetchone()
+        assert missing == 0
+
+        # lines and points are copied as they are, with their keys
+        mixed_path = os.path.join(td, "mixed.parquet")
+        con.execute(f"""
+            COPY (
+                SELECT pk_and_model, geometry::GEOMETRY AS geometry,
+                    geometry_bbox
+                FROM read_parquet('{small_aois_path}')
+                UNION ALL
+                SELECT pk_and_model || ' border',
+                    ST_Boundary(geometry::GEOMETRY), geometry_bbox
+                FROM read_parquet('{small_aois_path}')
+                UNION ALL
+                SELECT pk_and_model || ' center',
+                    ST_Centroid(geometry::GEOMETRY), geometry_bbox
+                FROM read_parquet('{small_aois_path}')
+            ) TO '{mixed_path}'
+        """)
+        mixed_pieces_path = os.path.join(td, "mixed_pieces.parquet")
+        aois, _ = write_subdivided_subscriptions(
+            con, mixed_path, mixed_pieces_path, max_vertices=32
+        )
+        assert aois == 150
+        keys, others = con.execute(f"""
+            SELECT count(DISTINCT pk_and_model),
+                count(*) FILTER (
+                    ST_GeometryType(geometry)::VARCHAR
+                        NOT IN ('POLYGON', 'MULTIPOLYGON')
+                )
+            FROM '{mixed_pieces_path}'
+        """).fetchone()
+        assert keys == 150
+        assert others == 100
+
+        fake_config.aois_path = pieces_path
+        assert compare("pieces") == flat
+        fake_config.spill_limit = 100
+        assert compare("pieces_spill", spill=True) == flat
+
+        sorted_path = os.path.join(td, "sorted.parquet")
+        write_sorted_subscriptions(con, pieces_path, sorted_path)
+        fake_config.aois_path = sorted_path
+        assert compare("sorted") == flat
+
+        cells_dir = os.path.join(td, "cells")
+        write_partitioned_subscriptions(con, pieces_path, cells_dir, 5.0)
+        fake_config.subs_layout = "partitioned"
+        fake_config.cells_path = cells_dir
+        assert compare("partitioned") == flat
+
+        # replacing one subdivided AOI in a delta replaces all its pieces
+        store = DeltaStore(os.path.join(td, "delta"))
+        init_delta_log(con, store, pieces_path)
+        adds_path = os.path.join(td, "adds.parquet")
+        con.execute(f"""
+            COPY (
+                SELECT * FROM read_parquet('{small_aois_path}')
+                WHERE pk_and_model = 'Texas'
+            ) TO '{adds_path}'
+        """)
+        append_delta(con, store, adds_path)
+        fake_config.subs_layout = "delta"
+        fake_config.delta_path = store.root
+        assert compare("delta") == flat
+
+        # only the AOIs that were split count as changed
+        original = get_aois_relation(con, small_aois_path.as_posix())
+        split = get_aois_relation(con, pieces_path)
+        changed = con.execute(f"""
+            SELECT DISTINCT pk_and_model
+            FROM {changed_subscriptions_sql(original, split)}
+        """).fetchall()
+        assert ("Texas",) in changed
+        assert len(changed) < aois
+        unchanged = changed_subscriptions_sql(split, split)
+        assert con.execute(f"SELECT count(*) FROM {unchanged}").fetchone() == (
+            0,
+        )
+
+
+def test_plan_groups():
+    """Test that records are packed first fit decreasing within the budget,
+    with oversized records on their own."""
+    assert plan_groups([], 10) == []
+    assert plan_groups([4, 4, 4], 10) == [[0, 1], [2]]
+    assert plan_groups([2, 9, 3, 6, 1], 10) == [[0], [1, 4], [2, 3]]
+    assert plan_groups([20, 1, 1], 10) == [[0], [1, 2]]
+
+
+def make_record(n: int) -> dict:
+    """SQS record for the S3 event of one tile file."""
+    s3_event = {
+        "s3": {
+            "bucket": {"name": "tns-fake-bucket"},
+            "object": {"key": f"fake/compare/{n}.parquet", "size": 100},
+        }
+    }
+    message = json.dumps({"Records": [s3_event]})
+    return {"messageId": str(n), "body": json.dumps({"Message": message})}
+
+
+def test_compare_records(monkeypatch, fake_config: CloudConfig):
+    """Test that groups are bisected on out of memory errors, and that with
+    batch item failures reported only failing records are returned."""
+    compared = []
+
+    def fake_compare(data_paths, config, mode="memory", etags=None):
+        if len(data_paths) > 2:
+            raise duckdb.OutOfMemoryException("fake out of memory")
+        if "s3://tns-fake-bucket/fake/compare/3.parquet" in data_paths:
+            raise ValueError("bad tile")
+        compared.append(len(data_paths))
+        return [get_pass_res(data_paths, "out")]
+
+    monkeypatch.setattr(intersects_lambda, "compare_and_publish", fake_compare)
+    fake_config.sns = FakeSNS()
+    records = [make_record(n) for n in range(6)]
+
+    # 6 -> 3 + 3 -> 1 + 2 + 1 + 2, record 3 is bad on its own
+    messages, failures = compare_records(records, fake_config, True)
+    assert failures == [{"itemIdentifier": "3"}]
+    assert compared == [1, 2, 2]
+    assert len(messages) == 3
+    assert len(fake_config.sns.published) == 1
+
+    # without reporting failures errors other than out of memory are raised
+    with pytest.raises(ValueError):
+        compare_records(records, fake_config, False)
+
+    # single records that run out of memory are compared out of core
+    def fake_in_memory(data_paths, config, mode="memory", etags=None):
+        if mode != "spill":
+            raise duckdb.OutOfMemoryException("fake out of memory")
+        return [get_pass_res(data_paths, "out")]
+
+    monkeypatch.setattr(
+        intersects_lambda, "compare_and_publish", fake_in_memory
+    )
+    with pytest.raises(duckdb.OutOfMemoryException):
+        compare_records(records[:1], fake_config, False)
+    fake_config.spill_limit = 100
+    messages, failures = compare_records(records[:2], fake_config, False)
+    assert len(messages) == 2
+
+
+def test_plan_record_groups(monkeypatch, fake_config: CloudConfig):
+    """Test that records are still grouped when the subscriptions take up
+    the whole budget, and that the size of the subscriptions in S3 is only
+    looked up once."""
+    heads = []
+
+    class HeadS3:
+        def head_object(self, Bucket, Key):
+            heads.append(Key)
+            return {"ETag": '"v1"', "ContentLength": 2**40}
+
+    fake_config.s3 = HeadS3()
+    fake_config.aois_path = f"s3://{fake_config.bucket}/{fake_config.subs_key}"
+    monkeypatch.setattr(
+        intersects_lambda,
+        "estimate_record_bytes",
+        lambda events, config: [200 * 2**20] * len(events),
+    )
+    records = [make_record(n) for n in range(4)]
+
+    # 200MB records in the 512MB left for tiles of the 5GB limit
+    groups = plan_record_groups(records, fake_config)
+    assert groups == [records[:2], records[2:]]
+    assert plan_record_groups(records, fake_config) == groups
+    assert heads == [fake_config.subs_key]
+
+
+def test_compare_out_of_core(small_tiles_path: Path, fake_config: CloudConfig):
+    """Test that the out of core compare finds the same intersections."""
+    fake_config.spill_limit = 100
+    datapaths = [small_tiles_path.as_posix()]
+
+    with TemporaryDirectory() as td, fake_config:
+
+        def compare(name, spill):
+            outpath = os.path.join(td, f"{name}.parquet")
+            apply_compare(datapaths, fake_config, outpath, spill)
+            return read_intersects(fake_config.con, outpath)
+
+        in_memory = compare("in_memory", False)
+        assert len(in_memory) == 50
+        assert compare("out_of_core", True) == in_memory
+
+        # settings are restored for the next in memory compare
+        (order,) = fake_config.con.execute(
+            "SELECT current_setting('preserve_insertion_order')"
+        ).fetchone()
+        assert order
+
+
+def test_concurrent_spills(
+    monkeypatch, small_tiles_path: Path, fake_config: CloudConfig
+):
+    """Test that units spilling at once on cursors of one connection each
+    keep their spill settings until they are done."""
+    write_pairs = intersects_lambda.write_pairs
+    seen = {}
+
+    def slow_write_pairs(con, pairs, outpath, *args):
+        # give the other unit time to reset the settings under this one
+        time.sleep(0.5)
+        seen[outpath] = con.execute("""
+            SELECT current_setting('max_temp_directory_size'),
+                current_setting('preserve_insertion_order')
+        """).fetchone()
+        return write_pairs(con, pairs, outpath, *args)
+
+    monkeypatch.setattr(intersects_lambda, "write_pairs", slow_write_pairs)
+    with TemporaryDirectory() as td, fake_config:
+        aois = get_aois_relation(fake_config.con, fake_config.aois_path)
+        tiles = f"read_parquet(['{small_tiles_path.as_posix()}'])"
+
+        def spill(limit):
+            outpath = os.path.join(td, f"{limit}.parquet")
+            con = fake_config.con.cursor()
+            try:
+                intersects_lambda.write_intersects_out_of_core(
+                    con, aois, tiles, outpath, limit
+                )
+            finally:
+                con.close()
+            return read_intersects(fake_config.con, outpath)
+
+        with ThreadPoolExecutor(2) as pool:
+            results = list(pool.map(spill, [100, 200]))
+        assert len(results[0]) == 50
+        assert results[0] == results[1]
+        assert seen == {
+            os.path.join(td, "100.parquet"): ("100.0 MiB", False),
+            os.path.join(td, "200.parquet"): ("200.0 MiB", False),
+        }
+
+
+def test_compare_streaming(small_tiles_path: Path, fake_config: CloudConfig):
+    """Test that the streaming compare writes a part per chunk of row groups
+    and that the parts together hold the batch's intersections."""
+    fake_config.chunk_rows = 20
+
+    with TemporaryDirectory() as td, fake_config:
+        # 50 tiles in row groups of 10
+        tiles_path = os.path.join(td, "tiles.parquet")
+        pq.write_table(
+            pq.read_table(small_tiles_path), tiles_path, row_group_size=10
+        )
+        datapaths = [tiles_path]
+        chunks = plan_tile_chunks(
+            fake_config.con, datapaths, fake_config.chunk_rows
+        )
+        assert chunks == [
+            [(tiles_path, 0, 20)],
+            [(tiles_path, 20, 40)],
+            [(tiles_path, 40, 50)],
+        ]
+
+        batch_out = os.path.join(td, "batch.parquet")
+        apply_compare(datapaths, fake_config, batch_out)
+        outdir = os.path.join(td, "run")
+        os.makedirs(outdir)
+        res = apply_compare_streaming(datapaths, fake_config, outdir)
+
+        attrs = res["MessageAttributes"]
+        assert attrs["s3_output_path"]["StringValue"] == outdir
+        parts = json.loads(attrs["s3_output_parts"]["StringValue"])
+        assert parts == [
+            os.path.join(outdir, f"part-0000{n}.parquet") for n in range(3)
+        ]
+
+        def read(relation):
+            return dict(
+                fake_config.con.execute(f"""
+                    SELECT aois, list_sort(flatten(list(tiles)))
+                    FROM {relation}
+                    GROUP BY aois
+                """).fetchall()
+            )
+
+        batch = read(f"read_parquet('{batch_out}')")
+        assert read(f"read_parquet({parts})") == batch
+
+
+def test_compare_fanout(small_tiles_path: Path, fake_config: CloudConfig):
+    """Test that a tile file split into row group work units compared in
+    parallel gives the same result as comparing it whole."""
+    # out of memory single records go out of core, then fan out
+    assert next_compare_mode("memory", fake_config) is None
+    fake_config.fanout = "local"
+    assert next_compare_mode("memory", fake_config) == "fanout"
+    fake_config.spill_limit = 100
+    assert next_compare_mode("memory", fake_config) == "spill"
+    assert next_compare_mode("spill", fake_config) == "fanout"
+    assert next_compare_mode("fanout", fake_config) is None
+
+    fake_config.fanout_rows = 10
+    fake_config.fanout_workers = 3
+    with TemporaryDirectory() as td, fake_config:
+        tiles_path = os.path.join(td, "tiles.parquet")
+        pq.write_table(
+            pq.read_table(small_tiles_path), tiles_path, row_group_size=10
+        )
+        datapaths = [tiles_path]
+
+        def compare(name, func):
+            outpath = os.path.join(td, f"{name}.parquet")
+            attrs = func(datapaths, fake_config, outpath)["MessageAttributes"]
+            assert attrs["s3_output_path"]["StringValue"] == outpath
+            return read_intersects(fake_config.con, outpath)
+
+        whole = compare("whole", apply_compare)
+        assert len(whole) == 50
+        assert compare("fanout", apply_compare_fanout) == whole
+        # unit outputs are cleaned up
+        tempdir = fake_config.tempdir.name
+        assert not [n for n in os.listdir(tempdir) if "units" in n]
+
+
+def test_unit_receives():
+    """Test that a work unit received too many times gives up on its run
+    and announces it as failed, once."""
+    with TemporaryDirectory() as td, LocalAWS(td) as aws:
+        config = CloudConfig(
+            "us-west-2", "fake-sns-arn", "tns-fake-bucket", "fake", 5 * 2**10
+        )
+        sources = ["s3://tns-fake-bucket/tiles/a.parquet"]
+        unit = {
+            "run": "run-1",
+            "sources": sources,
+            "ranges": [],
+            "index": 1,
+            "count": 2,
+        }
+        receives = str(config.fanout_max_receives + 1)
+        record = {
+            "messageId": "0",
+            "body": json.dumps({intersects_lambda.UNIT_KEY: unit}),
+            "attributes": {"ApproximateReceiveCount": receives},
+        }
+        try:
+            message = compare_unit_record(record, config)
+            attrs = message["MessageAttributes"]
+            assert attrs["status"]["StringValue"] == "failed"
+            assert json.loads(attrs["source_files"]["StringValue"]) == sources
+            assert "run-1" in attrs["error"]["StringValue"]
+            assert aws.sns.messages == [{"TopicArn": "fake-sns-arn", **message}]
+
+            # the other units of the run don't announce it again
+            assert compare_unit_record(record, config) is None
+            assert len(aws.sns.messages) == 1
+        finally:
+            config.close()
+
+
+def test_run_marker_policy(monkeypatch, test_dir: Path):
+    """Test that the Lambda role may put every run marker a work unit
+    writes, the failed one and the merged one."""
+    lambdas_dir = test_dir / ".." / "terraform" / "resources" / "lambdas"
+    policy = (lambdas_dir / "common.tf").read_text()
+    statement = policy[policy.index('Sid = "WriteIntersects"'):]
+    resources = statement[: statement.index("]", statement.index("Resource"))]
+    patterns = [
+        arn.replace("${var.bucket_name}", "tns-fake-bucket")
+        .replace("${var.prefix}", "fake")
+        .removeprefix("arn:aws:s3:::")
+        for arn in re.findall(r'"(arn:aws:s3:::[^"]+)"', resources)
+    ]
+
+    markers = []
+    put_run_marker = intersects_lambda.put_run_marker
+
+    def record_marker(config, key):
+        markers.append(f"{config.bucket}/{key}")
+        return put_run_marker(config, key)
+
+    monkeypatch.setattr(intersects_lambda, "put_run_marker", record_marker)
+    # the unit's own compare and the merge aren't what is tested here
+    for name in (
+        "write_empty_intersects", "merge_unit_outputs", "write_tile_catalog"
+    ):
+        monkeypatch.setattr(intersects_lambda, name, lambda *args: None)
+    with TemporaryDirectory() as td, LocalAWS(td) as aws:
+        config = CloudConfig(
+            "us-west-2", "fake-sns-arn", "tns-fake-bucket", "fake", 5 * 2**10
+        )
+        config.get_aois_path = lambda datapaths: []
+        aws.s3.put_object(
+            Bucket="tns-fake-bucket",
+            Key="fake/intersects/run-1/units/unit-00000.parquet",
+            Body=b"",
+        )
+        unit = {
+            "run": "run-1",
+            "sources": ["s3://tns-fake-bucket/tiles/a.parquet"],
+            "ranges": [],
+            "index": 0,
+            "count": 1,
+        }
+        record = {
+            "messageId": "0",
+            "body": json.dumps({intersects_lambda.UNIT_KEY: unit}),
+            "attributes": {"ApproximateReceiveCount": "1"},
+        }
+        try:
+            assert compare_unit_record(record, config) is not None
+            record["attributes"]["ApproximateReceiveCount"] = str(
+                config.fanout_max_receives + 1
+            )
+            assert compare_unit_record(record, config) is not None
+        finally:
+            config.close()
+
+    assert markers == [
+        "tns-fake-bucket/fake/intersects/run-1/merged",
+        "tns-fake-bucket/fake/intersects/run-1/failed",
+    ]
+    for key in markers:
+        assert any(fnmatch(key, pattern) for pattern in patterns), key
+
+
+def test_output_layouts(small_tiles_path: Path, fake_config: CloudConfig):
+    """Test that every output layout holds the same pairs, in memory, out of
+    core and fanned out, and is named in the SNS message."""
+    fake_config.spill_limit = 100
+    fake_config.fanout_rows = 10
+
+    # the side of each layout that is a list of keys
+    unnest = {
+        "aoi": "SELECT aois, unnest(tiles) AS tiles",
+        "tile": "SELECT unnest(aois) AS aois, tiles",
+        "pairs": "SELECT aois, tiles",
+    }
+
+    with TemporaryDirectory() as td, fake_config:
+        tiles_path = os.path.join(td, "tiles.parquet")
+        pq.write_table(
+            pq.read_table(small_tiles_path), tiles_path, row_group_size=10
+        )
+        datapaths = [tiles_path]
+
+        def compare(layout, func, *args):
+            fake_config.output_layout = layout
+            outpath = os.path.join(td, f"{layout}_{func.__name__}.parquet")
+            res = func(datapaths, fake_config, outpath, *args)
+            attrs = res["MessageAttributes"]
+            assert attrs["output_layout"]["StringValue"] == layout
+            return sorted(
+                fake_config.con.execute(
+                    f"{unnest[layout]} FROM read_parquet('{outpath}')"
+                ).fetchall()
+            )
+
+        pairs = compare("aoi", apply_compare)
+        assert len(pairs) == 250
+        for layout in OUTPUT_LAYOUTS:
+            assert compare(layout, apply_compare) == pairs
+            assert compare(layout, apply_compare, True) == pairs
+            assert compare(layout, apply_compare_fanout) == pairs
+
+        # one row per tile in the tile layout
+        fake_config.output_layout = "tile"
+        outpath = os.path.join(td, "tile.parquet")
+        apply_compare(datapaths, fake_config, outpath)
+        tiles = fake_config.con.execute(
+            f"SELECT tiles FROM read_parquet('{outpath}')"
+        ).fetchall()
+        assert len(tiles) == len(set(tiles))
+
+        # empty results have the layout's columns
+        for layout in OUTPUT_LAYOUTS:
+            empty = os.path.join(td, f"empty_{layout}.parquet")
+            write_empty_intersects(fake_config.con, empty, layout)
+            assert fake_config.con.execute(
+                f"{unnest[layout]} FROM read_parquet('{empty}')"
+            ).fetchall() == []
+
+        fake_config.output_layout = "columns"
+        with pytest.raises(ValueError):
+            apply_compare(datapaths, fake_config, outpath)
+
+
+def test_inline_results(
+    monkeypatch, small_tiles_path: Path, fake_config: CloudConfig
+):
+    """Test that small results are carried in the SNS messages, split across
+    several when needed, and that larger ones are still written out."""
+    fake_config.inline_messages = 2
+    datapaths = [small_tiles_path.as_posix()]
+
+    with TemporaryDirectory() as td, fake_config:
+        whole_out = os.path.join(td, "whole.parquet")
+        apply_compare(datapaths, fake_config, whole_out)
+        whole = {
+            aoi: sorted(tiles)
+            for aoi, tiles in fake_config.con.execute(
+                f"SELECT aois, tiles FROM read_parquet('{whole_out}')"
+            ).fetchall()
+        }
+
+        def read(messages):
+            rows = {}
+            for n, message in enumerate(messages):
+                attrs = message["MessageAttributes"]
+                assert "s3_output_path" not in attrs
+                part = json.loads(attrs["inline_part"]["StringValue"])
+                assert part == [n, len(messages)]
+                assert message_bytes(message) <= intersects_lambda.MAX_MSG_BYTES
+                for aoi, tiles in json.loads(message["Message"]):
+                    rows[aoi] = sorted(tiles)
+            return rows
+
+        outpath = os.path.join(td, "out.parquet")
+        messages = apply_compare_inline(datapaths, fake_config, outpath)
+        assert len(messages) == 1
+        assert read(messages) == whole
+        assert not os.path.exists(outpath)
+        # the local copy is cleaned up
+        assert not [
+            n for n in os.listdir(fake_config.tempdir.name) if "inline" in n
+        ]
+
+        # split in two under a smaller limit
+        size = message_bytes(messages[0])
+        monkeypatch.setattr(intersects_lambda, "MAX_MSG_BYTES", size * 2 // 3)
+        messages = apply_compare_inline(datapaths, fake_config, outpath)
+        assert len(messages) == 2
+        assert read(messages) == whole
+
+        # too big for the messages allowed, written out as usual
+        fake_config.inline_messages = 1
+        messages = apply_compare_inline(datapaths, fake_config, outpath)
+        assert len(messages) == 1
+        attrs = messages[0]["MessageAttributes"]
+        assert attrs["s3_output_path"]["StringValue"] == outpath
+        assert fake_config.con.execute(
+            f"SELECT count(*) FROM read_parquet('{outpath}')"
+        ).fetchone() == (50,)
+
+
+def test_result_ledger(
+    monkeypatch,
+    small_tiles_path: Path,
+    small_aois_path: Path,
+    fake_config: CloudConfig,
+):
+    """Test that results are keyed by tile ETags and subscription version,
+    revalidated once per compare, and that a result in the ledger is
+    announced again without comparing."""
+    etags = {"s3://b/1.parquet": '"a"', "s3://b/2.parquet": '"b"'}
+    key = result_key(etags, '"v1"', "aoi", 0)
+    assert key == result_key(dict(reversed(etags.items())), '"v1"', "aoi", 0)
+    assert key != result_key(etags, '"v2"', "aoi", 0)
+    assert key != result_key(etags, '"v1"', "tile", 0)
+    assert key != result_key(
+        dict(etags, **{"s3://b/2.parquet": '"c"'}), '"v1"', "aoi", 0
+    )
+
+    record = make_record(0)
+    body = json.loads(record["body"])
+    message = json.loads(body["Message"])
+    message["Records"][0]["s3"]["object"]["eTag"] = "abc"
+    record["body"] = json.dumps({"Message": json.dumps(message)})
+    assert get_data_etags(record) == {
+        "s3://tns-fake-bucket/fake/compare/0.parquet": "abc"
+    }
+    assert get_data_etags(make_record(1)) == {}
+
+    fake_config.inline_messages = 2
+    fake_config.sns = FakeSNS()
+    datapaths = [small_tiles_path.as_posix()]
+    tile_etags = {datapaths[0]: '"tile-etag"'}
+
+    with TemporaryDirectory() as td, fake_config:
+        fake_config.catalog_path = os.path.join(td, "catalog")
+        os.makedirs(fake_config.catalog_path)
+        fake_config.ledger = ResultLedger(os.path.join(td, "ledger"))
+        s3 = FakeS3(small_aois_path.read_bytes(), '"v1"')
+        fake_config.s3 = s3
+        fake_config.enable_subscription_cache(os.path.join(td, "subs"))
+
+        first = compare_and_publish(datapaths, fake_config, etags=tile_etags)
+        assert len(fake_config.sns.published) == 1
+        assert s3.gets == 1
+        key = result_key(tile_etags, '"v1"', "aoi", 0)
+        assert fake_config.ledger.get(key) == first
+        assert os.listdir(fake_config.catalog_path) == [f"{key}.parquet"]
+
+        def no_compare(*args):
+            raise AssertionError("compared a result in the ledger")
+
+        monkeypatch.setattr(
+            intersects_lambda, "apply_compare_inline", no_compare
+        )
+        again = compare_and_publish(datapaths, fake_config, etags=tile_etags)
+        assert again == first
+        assert fake_config.sns.published == first + first
+        assert s3.gets == 2
+
+        # a new version of the tiles is compared again
+        with pytest.raises(AssertionError):
+            compare_and_publish(
+                datapaths, fake_config, etags={datapaths[0]: "x"}
+            )
+
+    # uncached partitioned subscriptions are versioned by their manifest
+    fake_config.manifest_cache = fake_config.subs_cache = None
+    fake_config.subs_layout = "partitioned"
+    fake_config.cells_path = "s3://tns-fake-bucket/fake/cells"
+    fake_config.s3 = mock.Mock()
+    fake_config.s3.head_object.return_value = {"ETag": '"m1"'}
+    assert fake_config.subscription_version() == '"m1"'
+    fake_config.s3.head_object.assert_called_once_with(
+        Bucket="tns-fake-bucket", Key=fake_config.manifest_key
+    )
+
+
+def test_geometry_dedup(
+    metrics: intersects_lambda.Metrics,
+    small_tiles_path: Path,
+    small_aois_path: Path,
+):
+    """Test that tiles and AOIs sharing a geometry are joined once and
+    expanded back to all their keys, and counted with metrics enabled."""
+    con = duckdb.connect()
+    con.execute("LOAD spatial")
+    with TemporaryDirectory() as td:
+        # every tile again under a new model, and a copy of each AOI
+        tiles_path = os.path.join(td, "tiles.parquet")
+        con.execute(f"""
+            COPY (
+                SELECT * FROM read_parquet('{small_tiles_path}')
+                UNION ALL
+                SELECT pk_and_model || '_v2', geometry, geometry_bbox
+                FROM read_parquet('{small_tiles_path}')
+            ) TO '{tiles_path}'
+        """)
+        aois_path = os.path.join(td, "aois.parquet")
+        con.execute(f"""
+            COPY (
+                SELECT * FROM read_parquet('{small_aois_path}')
+                UNION ALL
+                SELECT 'copy_' || pk_and_model, geometry, geometry_bbox
+                FROM read_parquet('{small_aois_path}')
+            ) TO '{aois_path}'
+        """)
+
+        single_out = os.path.join(td, "single.parquet")
+        tiles = f"read_parquet(['{small_tiles_path}'])"
+        single = write_compare(
+            con, small_aois_path.as_posix(), tiles, single_out
+        )
+        assert single["compare_tile_rows"] == single["compare_tile_geometries"]
+
+        out = os.path.join(td, "out.parquet")
+        counters = write_compare(
+            con, aois_path, f"read_parquet(['{tiles_path}'])", out
+        )
+        assert counters["compare_tile_rows"] == 2 * single["compare_tile_rows"]
+        assert counters["compare_aoi_rows"] == 2 * single["compare_aoi_rows"]
+        assert (
+            counters["compare_tile_geometries"]
+            == single["compare_tile_geometries"]
+        )
+        assert (
+            counters["compare_aoi_geometries"]
+            == single["compare_aoi_geometries"]
+        )
+        assert counters["compare_pairs"] == 4 * single["compare_pairs"]
+
+        expected = {}
+        for aoi, tiles in con.execute(
+            f"SELECT aois, tiles FROM read_parquet('{single_out}')"
+        ).fetchall():
+            doubled = sorted(tiles + [f"{t}_v2" for t in tiles])
+            expected[aoi] = doubled
+            expected[f"copy_{aoi}"] = doubled
+        assert read_intersects(con, out) == expected
+
+
+def test_keyed_output(small_tiles_path: Path, small_aois_path: Path):
+    """Test that output joined through integer key ids is the same as
+    output of the string keys in every layout, with repeated subscription
+    keys and subscriptions subdivided into pieces."""
+    con = duckdb.connect()
+    con.execute("LOAD spatial")
+    with TemporaryDirectory() as td:
+        # a few AOIs twice under the same key, a few others in two halves
+        aois_path = os.path.join(td, "aois.parquet")
+        con.execute(f"""
+            COPY (
+                WITH aois AS (
+                    SELECT *, row_number() OVER (ORDER BY pk_and_model) AS n
+                    FROM read_parquet('{small_aois_path}')
+                ),
+                halves AS (
+                    SELECT pk_and_model, ST_Intersection(
+                        geometry,
+                        ST_MakeEnvelope(
+                            xmin + side * width, ST_YMin(geometry),
+                            xmin + (side + 0.5) * width, ST_YMax(geometry)
+                        )
+                    ) AS geometry
+                    FROM (
+                        SELECT *, ST_XMin(geometry) AS xmin,
+                            ST_XMax(geometry) - ST_XMin(geometry) AS width
+                        FROM aois
+                        WHERE n > 5 AND n <= 15
+                    ), (VALUES (0.0), (0.5)) AS sides(side)
+                )
+                SELECT pk_and_model, geometry, geometry_bbox
+                FROM aois
+                WHERE n <= 5 OR n > 15
+                UNION ALL
+                SELECT pk_and_model, geometry, geometry_bbox
+                FROM aois
+                WHERE n <= 5
+                UNION ALL
+                SELECT pk_and_model, geometry,
+                    {{
+                        'xmin': ST_XMin(geometry), 'ymin': ST_YMin(geometry),
+                        'xmax': ST_XMax(geometry), 'ymax': ST_YMax(geometry)
+                    }} AS geometry_bbox
+                FROM halves
+                WHERE NOT ST_IsEmpty(geometry)
+            ) TO '{aois_path}'
+        """)
+        assert con.execute(f"""
+            SELECT count(*), count(DISTINCT pk_and_model)
+            FROM read_parquet('{aois_path}')
+        """).fetchone() == (65, 50)
+        tiles = f"read_parquet(['{small_tiles_path}'])"
+        pairs = f"""(
+            SELECT aois.pk_and_model AS aoi, tiles.pk_and_model AS tile
+            FROM read_parquet('{aois_path}') AS aois
+            JOIN {tiles} AS tiles
+            ON ST_Intersects(aois.geometry, tiles.geometry)
+        )"""
+        # the side of each layout that is a list of keys, sorted
+        rows = {
+            "aoi": "SELECT aois, list_sort(tiles)",
+            "tile": "SELECT tiles, list_sort(aois)",
+            "pairs": "SELECT aois, tiles",
+        }
+        for layout in OUTPUT_LAYOUTS:
+            expected_out = os.path.join(td, f"expected_{layout}.parquet")
+            con.execute(f"""
+                COPY ({intersects_lambda.output_sql(pairs, layout)})
+                TO '{expected_out}'
+            """)
+            out = os.path.join(td, f"{layout}.parquet")
+            write_compare(con, aois_path, tiles, out, layout=layout)
+            expected, keyed = (
+                sorted(con.execute(
+                    f"{rows[layout]} FROM read_parquet('{path}')"
+                ).fetchall())
+                for path in (expected_out, out)
+            )
+            assert keyed == expected
+            assert len(keyed) > 0
+
+
+def test_synthetic_data():
+    """Test that generated tiles and AOIs are deterministic, valid, have the
+    requested vertices and are crowded together by the skew."""
+    con = duckdb.connect()
+    con.execute("LOAD spatial")
+    with TemporaryDirectory() as td:
+        paths = [os.path.join(td, f"{n}.parquet") for n in range(3)]
+        write_synthetic(con, paths[0], 200, 1.0, 32, 0.5, seed=3)
+        write_synthetic(con, paths[1], 200, 1.0, 32, 0.5, seed=3)
+        write_synthetic(con, paths[2], 200, 1.0, 32, 0.9, seed=3)
+
+        def rows(path):
+            return con.execute(
+                f"SELECT pk_and_model, ST_AsWKB(geometry), geometry_bbox "
+                f"FROM read_parquet('{path}') ORDER BY pk_and_model"
+            ).fetchall()
+
+        assert rows(paths[0]) == rows(paths[1])
+        assert len(rows(paths[0])) == 200
+
+        valid, covered, vertices = con.execute(f"""
+            SELECT bool_and(ST_IsValid(geometry)),
+                bool_and(geometry_bbox.xmin <= ST_XMin(geometry)
+                    AND geometry_bbox.xmax >= ST_XMax(geometry)
+                    AND geometry_bbox.ymin <= ST_YMin(geometry)
+                    AND geometry_bbox.ymax >= ST_YMax(geometry)),
+                max(ST_NPoints(geometry))
+            FROM read_parquet('{paths[0]}')
+        """).fetchone()
+        assert valid and covered
+        # the ring repeats its first vertex
+        assert vertices == 33
+
+        xmin, ymin, xmax, ymax = SYNTHETIC_EXTENT
+        middle = f"""
+            SELECT count(*) FROM read_parquet('{{}}')
+            WHERE abs(ST_X(ST_Centroid(geometry)) - {(xmin + xmax) / 2}) < 2
+                AND abs(ST_Y(ST_Centroid(geometry)) - {(ymin + ymax) / 2}) < 2
+        """
+        half, most = (
+            con.execute(middle.format(p)).fetchone()[0] for p in paths[::2]
+        )
+        assert 60 < half < most
+
+
+def test_local_handler(
+    monkeypatch, small_tiles_path: Path, small_aois_path: Path
+):
+    """Test that the handler runs end to end against the local S3, SNS and
+    SQS stand-ins, with DuckDB reading and writing through the local S3
+    endpoint."""
+    region = "us-west-2"
+    bucket = "tns-fake-bucket"
+    queue_arn = f"arn:aws:sqs:{region}:000000000000:tns-fake-in"
+    with TemporaryDirectory() as td, LocalAWS(td) as aws:
+        subs_key = "fake/subs/subscriptions.parquet"
+        aws.s3.upload_file(small_aois_path.as_posix(), bucket, subs_key)
+        aws.s3.upload_file(
+            small_tiles_path.as_posix(), bucket, "tiles/a.parquet"
+        )
+        head = aws.s3.head_object(Bucket=bucket, Key="tiles/a.parquet")
+        body = s3_event_body(
+            bucket, "tiles/a.parquet", head["ContentLength"], head["ETag"]
+        )
+        queue_url = aws.sqs.get_queue_url(QueueName="tns-fake-in")["QueueUrl"]
+        aws.sqs.send_message_batch(
+            QueueUrl=queue_url, Entries=[{"Id": "0", "MessageBody": body}]
+        )
+        messages = aws.sqs.receive_message(QueueUrl=queue_url)["Messages"]
+
+        set_local_env(monkeypatch, aws, td, EMIT_METRICS="true")
+        intersects_lambda.CONFIG_CACHE.clear()
+        try:
+            res = intersects_lambda.handler(
+                sqs_event(messages, queue_arn, region), None
+            )
+        finally:
+            intersects_lambda.CONFIG_CACHE.clear()
+            intersects_lambda.METRICS.enabled = False
+
+        metrics = intersects_lambda.METRICS.last
+        assert metrics["DeployPrefix"] == "fake"
+        for stage in ("config", "extensions", "join", "count", "publish"):
+            assert metrics[f"{stage}_ms"] >= 0
+        assert metrics["invocation_ms"] >= metrics["join_ms"]
+        assert metrics["records"] == 1
+        assert metrics["tile_bytes"] == head["ContentLength"]
+        assert metrics["compare_pairs"] == 250
+        assert metrics["output_rows"] == 50
+        assert metrics["messages_published"] == 1
+        assert metrics["peak_rss_bytes"] > 0
+
+        assert aws.sns.messages == [{"TopicArn": "fake-sns-arn", **res[0]}]
+        assert aws.sqs.deleted == [(queue_url, messages[0]["ReceiptHandle"])]
+        outpath = res[0]["MessageAttributes"]["s3_output_path"]["StringValue"]
+        key = outpath.removeprefix(f"s3://{bucket}/")
+        pairs = duckdb.sql(f"""
+            SELECT count(*) FROM (
+                SELECT unnest(tiles)
+                FROM read_parquet('{aws.s3.path(bucket, key)}')
+            )
+        """).fetchone()[0]
+        assert pairs == 250
+        catalog = aws.s3.list_objects_v2(bucket, "fake/catalog/")
+        assert catalog["KeyCount"] == 1
+
+
+def test_init(monkeypatch, small_aois_path: Path):
+    """Test that init builds the handler's config with an open connection
+    and its extensions loaded for the first invocation to reuse, and that a
+    failing init leaves nothing cached."""
+    bucket = "tns-fake-bucket"
+    with TemporaryDirectory() as td, LocalAWS(td) as aws:
+        aws.s3.upload_file(
+            small_aois_path.as_posix(), bucket,
+            "fake/subs/subscriptions.parquet",
+        )
+        set_local_env(monkeypatch, aws, td)
+        intersects_lambda.CONFIG_CACHE.clear()
+        try:
+            intersects_lambda.init()
+            config = intersects_lambda.CONFIG_CACHE.config
+            assert config.con is not None
+            loaded = config.con.execute("""
+                SELECT list(extension_name ORDER BY extension_name)
+                FROM duckdb_extensions() WHERE loaded
+            """).fetchone()[0]
+            assert set(intersects_lambda.DUCKDB_EXTENSIONS) <= set(loaded)
+            rows = config.con.execute(
+                f"SELECT count(*) FROM read_parquet('{config.aois_path}')"
+            ).fetchone()[0]
+            assert rows == 50
+            assert intersects_lambda.get_config() == (config, True)
+
+            monkeypatch.setenv("MEMORY_LIMIT", "lots")
+            intersects_lambda.init()
+            assert intersects_lambda.CONFIG_CACHE.config is None
+        finally:
+            intersects_lambda.CONFIG_CACHE.clear()
+
+
+def test_worker(
+    monkeypatch, small_tiles_path: Path, small_aois_path: Path
+):
+    """Test that the worker coalesces queued records into concurrent
+    batches, holds those past a round's budget hidden for the next round,
+    announces and deletes those it compares and leaves a failing one on
+    the queue."""
+    region = "us-west-2"
+    bucket = "tns-fake-bucket"
+    queue_arn = f"arn:aws:sqs:{region}:000000000000:tns-fake-in"
+    with TemporaryDirectory() as td, LocalAWS(td) as aws:
+        aws.s3.upload_file(
+            small_aois_path.as_posix(), bucket,
+            "fake/subs/subscriptions.parquet",
+        )
+        bodies = []
+        for n in range(3):
+            key = f"tiles/{n}.parquet"
+            aws.s3.upload_file(small_tiles_path.as_posix(), bucket, key)
+            head = aws.s3.head_object(Bucket=bucket, Key=key)
+            bodies.append(
+                s3_event_body(bucket, key, head["ContentLength"], head["ETag"])
+            )
+        bodies.append("not an S3 event")
+        queue_url = aws.sqs.get_queue_url(QueueName="tns-fake-in")["QueueUrl"]
+        aws.sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(n), "MessageBody": body}
+                for n, body in enumerate(bodies)
+            ],
+        )
+        sent = list(aws.sqs.queues[queue_url])
+
+        set_local_env(monkeypatch, aws, td)
+        intersects_lambda.CONFIG_CACHE.clear()
+        try:
+            config, _ = intersects_lambda.get_config()
+            # one tile per batch, the third waits for the next round
+            worker = Worker(
+                config, queue_arn, workers=2, window=0, max_records=2,
+                max_bytes=head["ContentLength"], visibility=60,
+            )
+            assert worker.run(until_empty=True) == 4
+            assert worker.configs == []
+        finally:
+            intersects_lambda.CONFIG_CACHE.clear()
+
+        assert aws.sqs.visibility == [
+            (queue_url, sent[2]["ReceiptHandle"], 60)
+        ]
+        assert sorted(handle for _, handle in aws.sqs.deleted) == sorted(
+            m["ReceiptHandle"] for m in sent[:3]
+        )
+        # the failing record is still in flight, for SQS to redeliver
+        assert aws.sqs.queues[queue_url] == []
+        assert list(aws.sqs.in_flight) == [sent[3]["ReceiptHandle"]]
+        passed = [
+            m for m in aws.sns.messages
+            if m["MessageAttributes"]["status"]["StringValue"] == "succeeded"
+        ]
+        # one per tile, the failing record is batched with one of them
+        assert len(passed) == 3
+        failed = [m for m in aws.sns.messages if m not in passed]
+        assert len(failed) == 1
+        sources = []
+        for message in passed:
+            attributes = message["MessageAttributes"]
+            sources += json.loads(attributes["source_files"]["StringValue"])
+            outpath = attributes["s3_output_path"]["StringValue"]
+            key = outpath.removeprefix(f"s3://{bucket}/")
+            # the tile files are copies, with the same keys
+            pairs = duckdb.sql(f"""
+                SELECT count(*) FROM (
+                    SELECT unnest(tiles)
+                    FROM read_parquet('{aws.s3.path(bucket, key)}')
+                )
+            """).fetchone()[0]
+            assert pairs == 250
+        assert sorted(sources) == [
+            f"s3://{bucket}/tiles/{n}.parquet" for n in range(3)
+        ]
+
+
+def test_profiling(small_tiles_path: Path, small_aois_path: Path):
+    """Test that a profiled compare stores the query profiles of its
+    statements, with the time of the bbox join and the ST_Intersects filter,
+    and the Python samples, and that slow mode only stores the profiles of
+    invocations over the threshold."""
+    con = duckdb.connect()
+    con.execute("LOAD spatial")
+    aois = (
+        f"(SELECT *, {intersects_lambda.NO_INTERIOR} AS interior "
+        f"FROM read_parquet('{small_aois_path.as_posix()}'))"
+    )
+    tiles = f"read_parquet('{small_tiles_path.as_posix()}')"
+    with TemporaryDirectory() as td:
+        config = SimpleNamespace(
+            con=con,
+            s3=LocalS3(os.path.join(td, "s3")),
+            bucket="tns-fake-bucket",
+            prefix="fake",
+            profile="always",
+            profile_slow_ms=0,
+            profile_python=True,
+        )
+        outpath = os.path.join(td, "out.parquet")
+        with profiling(config, "run-1"):
+            write_intersects(con, aois, tiles, outpath)
+            # long enough for some Python samples
+            time.sleep(0.05)
+        run = config.s3.path(config.bucket, "fake/profiles/run-1")
+        with open(os.path.join(run, "duckdb.json")) as f:
+            queries = json.load(f)
+        stages = [q["stage"] for q in queries]
+        assert stages == ["dedup"] * 4 + ["join"]
+        (join,) = (q for q in queries if q["stage"] == "join")
+        assert join["latency"] > 0
+        assert any("JOIN" in name for name in join["operators"])
+        assert "FILTER" in join["operators"]
+        with open(os.path.join(run, "python.txt")) as f:
+            samples = f.read().splitlines()
+        assert any("test_profiling" in line for line in samples)
+        assert all(int(line.rsplit(" ", 1)[1]) > 0 for line in samples)
+        # profiling is off again after the invocation
+        con.execute("SELECT 1")
+        assert "children" not in json.loads(
+            con.get_profiling_information(format="json")
+        )
+
+        config.profile = "slow"
+        config.profile_slow_ms = 60_000
+        with profiling(config, "run-2"):
+            write_intersects(con, aois, tiles, outpath)
+        assert not os.path.exists(
+            config.s3.path(config.bucket, "fake/profiles/run-2")
+        )
+
+
+def test_metrics():
+    """Test that disabled metrics record nothing and that enabled ones are
+    emitted as one embedded metric format record per invocation."""
+    metrics = intersects_lambda.Metrics()
+
+    @metrics.timed("decorated")
+    def work():
+        return 1
+
+    with metrics.stage("skipped"):
+        pass
+    metrics.add({"rows": 3})
+    assert work() == 1
+    assert metrics.emit({"DeployPrefix": "fake"}) is None
+    assert metrics.stages == {} and metrics.counts == {}
+
+    metrics.enabled = True
+    with metrics.stage("stage"):
+        pass
+    work()
+    work()
+    metrics.add({"rows": 3, "tile_bytes": 10})
+    metrics.add({"rows": 2})
+    record = metrics.emit({"DeployPrefix": "fake"})
+    assert metrics.last == record
+    assert metrics.stages == {} and metrics.counts == {}
+
+    (directive,) = record["_aws"]["CloudWatchMetrics"]
+    assert directive["Namespace"] == "TNS"
+    assert directive["Dimensions"] == [["DeployPrefix"]]
+    units = {m["Name"]: m["Unit"] for m in directive["Metrics"]}
+    assert units == {
+        "stage_ms": "Milliseconds",
+        "decorated_ms": "Milliseconds",
+        "peak_rss_bytes": "Bytes",
+        "duckdb_memory_bytes": "Bytes",
+        "rows": "Count",
+        "tile_bytes": "Bytes",
+    }
+    assert record["DeployPrefix"] == "fake"
+    assert record["rows"] == 5
+    assert record["tile_bytes"] == 10
@@ -0,0 +1,314 @@
+"""
+Long-running SQS polling worker for the TNS compare, for deployments that
+run it as a persistent process, on EC2 or ECS, instead of as a Lambda.
+
+It takes the same environment as the compare Lambda, plus the input queue,
+keeps the config, the subscription copies and the DuckDB connection of
+`intersects_lambda` across batches, and stands in for the Lambda event
+source mapping: messages are long polled, coalesced into batches over a
+window and a size budget, compared concurrently with
+`intersects_lambda.process_records`, each worker on its own DuckDB
+connection, and deleted unless they failed.
+
+    python src/worker.py --queue-arn arn:aws:sqs:us-west-2:123:tns-in \
+        --workers 4 --window 10 --max-bytes 268435456
+"""
+
+import argparse
+import copy
+import json
+import os
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from tempfile import TemporaryDirectory
+
+from intersects_lambda import (
+    METRICS,
+    SQS_BATCH,
+    CloudConfig,
+    delete_sqs_messages,
+    get_config,
+    get_data_files,
+    get_data_paths,
+    get_env_vars,
+    get_fail_res,
+    process_records,
+    profiling,
+    sqs_records,
+)
+
+# longest SQS long poll, in seconds
+MAX_WAIT = 20
+# most records a batch holds, as for a Lambda event source mapping
+MAX_RECORDS = 100
+# seconds records held for the next round stay hidden on the queue for
+HOLD_VISIBILITY = 900
+
+
+def record_bytes(record: dict) -> int:
+    """Size of the tile objects of an SQS record, 0 for work units and
+    records that can't be parsed."""
+    try:
+        return sum(size for _, size in get_data_files(record))
+    except Exception:
+        return 0
+
+
+class Worker:
+    """Poll the input queue and compare its records on `config`.
+
+    Each round long polls for up to `window` seconds after the first
+    message arrives, packing the records into at most `workers` batches of
+    at most `max_records` records and `max_bytes` bytes of tile objects,
+    and then compares the batches concurrently, each worker thread on a
+    copy of the config with its own DuckDB connection, as settings and
+    attached databases are global to a connection. Records are deleted
+    once compared, failed ones are left for SQS to redeliver, so the
+    queue's visibility timeout should cover the window and a round's
+    compare. Records received past the round's budget are hidden for
+    `visibility` seconds while they wait for the next round, and made
+    visible again if the worker stops first. With metrics enabled, one
+    record is emitted per round."""
+
+    def __init__(
+        self,
+        config: CloudConfig,
+        queue_arn: str,
+        workers: int = 2,
+        window: float = 5.0,
+        max_records: int = MAX_RECORDS,
+        max_bytes: int = 2**28,
+        wait: int = MAX_WAIT,
+        visibility: int = HOLD_VISIBILITY,
+    ):
+        self.config = config
+        self.queue_arn = queue_arn
+        self.queue_url = config.get_queue_url(queue_arn)
+        self.workers = workers
+        self.window = window
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.wait = wait
+        self.visibility = visibility
+        # records received past the budget of a round, first in the next
+        self.pending = []
+        self.stop = threading.Event()
+        # config of each worker thread, see `batch_config`
+        self.local = threading.local()
+        self.configs = []
+
+    def receive(self) -> list[list[dict]]:
+        """Records of the next round, in batches. Empty if a long poll
+        found the queue empty, or the worker is stopping."""
+        batches = []
+        capacity = self.workers * self.max_records
+        deadline = None
+        records, self.pending = self.pending, []
+        while not self.stop.is_set():
+            for record in records:
+                size = record_bytes(record)
+                for batch in batches:
+                    if (
+                        len(batch[1]) < self.max_records
+                        and batch[0] + size <= self.max_bytes
+                    ):
+                        batch[0] += size
+                        batch[1].append(record)
+                        break
+                else:
+                    if len(batches) < self.workers:
+                        batches.append([size, [record]])
+                    else:
+                        self.pending.append(record)
+            received = sum(len(b[1]) for b in batches) + len(self.pending)
+            if self.pending or received >= capacity:
+                break
+
+            if batches and deadline is None:
+                deadline = time.monotonic() + self.window
+            wait = self.wait
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait = min(wait, ceil(remaining))
+            res = self.config.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=min(SQS_BATCH, capacity - received),
+                WaitTimeSeconds=wait,
+                AttributeNames=["All"],
+            )
+            records = sqs_records(
+                res.get("Messages", []), self.queue_arn, self.config.region
+            )
+            if not records and deadline is None:
+                break
+        return [batch for _, batch in batches]
+
+    def batch_config(self) -> CloudConfig:
+        """Copy of the config for the calling worker thread, made on first
+        use and kept across rounds, with a DuckDB connection and temporary
+        directory of its own and a share of the memory. Profiles are only
+        kept for one batch at a time."""
+        config = getattr(self.local, "config", None)
+        if config is not None:
+            return config
+        config = copy.copy(self.config)
+        config.con = None
+        config.keep_alive = True
+        config.tempdir = TemporaryDirectory(dir=self.config.tempdir.name)
+        config.mem_limit_bytes = self.config.mem_limit_bytes // self.workers
+        config.mem_limit = f"{config.mem_limit_bytes / 2**30}GB"
+        if self.workers > 1:
+            config.profile = "off"
+        self.local.config = config
+        self.configs.append(config)
+        return config
+
+    def set_visibility(self, records: list[dict], timeout: int):
+        """Hide received `records` on the queue for `timeout` seconds, or
+        make them visible again with 0."""
+        for start in range(0, len(records), SQS_BATCH):
+            batch = records[start : start + SQS_BATCH]
+            self.config.sqs.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {
+                        "Id": str(n),
+                        "ReceiptHandle": record["receiptHandle"],
+                        "VisibilityTimeout": timeout,
+                    }
+                    for n, record in enumerate(batch)
+                ],
+            )
+
+    def process(self, records: list[dict]) -> list[dict]:
+        """Compare a batch of records and delete those that didn't fail.
+        Returns the records left for redelivery."""
+        config = self.batch_config()
+        try:
+            with config, profiling(config, records[0]["messageId"]):
+                res = process_records(records, config, True)
+        except Exception:
+            data_paths = []
+            for record in records:
+                try:
+                    data_paths = data_paths + get_data_paths(record)
+                except Exception:
+                    continue
+            fail_msg = get_fail_res(data_paths, traceback.format_exc())
+            config.sns.publish(TopicArn=config.sns_out_arn, **fail_msg)
+            return records
+        failed = {f["itemIdentifier"] for f in res["batchItemFailures"]}
+        delete_sqs_messages(
+            [r for r in records if r["messageId"] not in failed], self.config
+        )
+        return [r for r in records if r["messageId"] in failed]
+
+    def run(self, until_empty: bool = False) -> int:
+        """Compare rounds of records until stopped, or, with `until_empty`,
+        until a long poll finds the queue empty. Returns the number of
+        records compared."""
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                count = self.run_rounds(pool, until_empty)
+        finally:
+            if self.pending:
+                self.set_visibility(self.pending, 0)
+                self.pending = []
+            for config in self.configs:
+                config.close()
+            self.configs = []
+        return count
+
+    def run_rounds(self, pool: ThreadPoolExecutor, until_empty: bool) -> int:
+        """Rounds of `run`, with the batches compared on `pool`."""
+        dimensions = {"DeployPrefix": self.config.prefix}
+        count = 0
+        while not self.stop.is_set():
+            batches = self.receive()
+            if self.pending:
+                # keep them from being redelivered while this round runs
+                self.set_visibility(self.pending, self.visibility)
+            if not batches:
+                if until_empty and not self.pending:
+                    break
+                continue
+            with METRICS.stage("round"):
+                failed = list(pool.map(self.process, batches))
+            records = sum(len(batch) for batch in batches)
+            print(json.dumps({
+                "worker_batches": len(batches),
+                "worker_records": records,
+                "worker_failed": sum(len(f) for f in failed),
+            }))
+            METRICS.emit(dimensions)
+            count += records
+        return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--queue-arn",
+        default=os.environ.get("SQS_IN_ARN"),
+        help="Input queue, SQS_IN_ARN by default.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="Batches compared at once."
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=5.0,
+        help="Seconds records are coalesced for after the first arrives.",
+    )
+    parser.add_argument("--max-records", type=int, default=MAX_RECORDS)
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=2**28,
+        help="Bytes of tile objects per batch.",
+    )
+    parser.add_argument(
+        "--visibility",
+        type=int,
+        default=HOLD_VISIBILITY,
+        help="Seconds records held for the next round stay hidden for.",
+    )
+    parser.add_argument(
+        "--until-empty",
+        action="store_true",
+        help="Exit once a long poll finds the queue empty.",
+    )
+    args = parser.parse_args(argv)
+    if not args.queue_arn:
+        parser.error("--queue-arn or SQS_IN_ARN is required")
+
+    METRICS.enabled = get_env_vars("EMIT_METRICS", "false").lower() == "true"
+    config, _ = get_config()
+    worker = Worker(
+        config,
+        args.queue_arn,
+        args.workers,
+        args.window,
+        args.max_records,
+        args.max_bytes,
+        visibility=args.visibility,
+    )
+    # ECS and systemd stop with SIGTERM, finish the round in progress
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop.set())
+    try:
+        worker.run(args.until_empty)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        config.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -34,8 +34,22 @@ module tns_lambdas {
     prefix = var.deploy_prefix
     sts_lambda_role_name = var.sts_lambda_role_name
     memory_size = var.lambda_memory_size
+    ephemeral_storage = var.lambda_ephemeral_storage
     s3_cert_path = var.s3_cert_path
     s3_endpoint = var.s3_endpoint
+    subs_index = var.subs_index
+    subs_layout = var.subs_layout
+    report_batch_failures = var.report_batch_failures
+    compare_chunk_rows = var.compare_chunk_rows
+    fanout_mode = var.fanout_mode
+    fanout_rows = var.fanout_rows
+    inline_messages = var.inline_messages
+    output_layout = var.output_layout
+    result_ledger = var.result_ledger
+    emit_metrics = var.emit_metrics
+    profile_mode = var.profile_mode
+    profile_slow_ms = var.profile_slow_ms
+    profile_python = var.profile_python
 
     image_uri = module.tns_base.image_uri
     bucket_name = module.tns_base.s3_bucket_name
@@ -86,6 +100,90 @@ variable lambda_memory_size {
     default = 10240
 }
 
+variable lambda_ephemeral_storage {
+    description="Ephemeral storage of the lambda function in MBs the compare may spill to when a file doesn't fit in memory. 0 disables spilling and leaves the lambda at the default 512MB."
+    type = number
+    default = 0
+}
+
+variable report_batch_failures {
+    description="Return the records that failed from the compare so the event source mapping only redelivers those, with ReportBatchItemFailures. Otherwise the compare deletes the records it processed itself."
+    type = bool
+    default = false
+}
+
+variable compare_chunk_rows {
+    description="Tile rows per chunk of the streaming compare, which writes an output part per chunk. 0 compares each batch at once."
+    type = number
+    default = 0
+}
+
+variable fanout_mode {
+    description="Fan out of tile files too big to compare: off, or sqs to split them into work units re-enqueued on the input queue."
+    type = string
+    default = "off"
+    validation {
+        condition = can(regex("^(off|sqs)$", var.fanout_mode))
+        error_message = "off or sqs are the only fan out modes."
+    }
+}
+
+variable fanout_rows {
+    description="Tile rows per work unit when a tile file too big to compare is split and re-enqueued."
+    type = number
+    default = 100000
+}
+
+variable inline_messages {
+    description="Most SNS messages a small result is split into instead of being written to S3. 0, the default, always writes to S3 and sets s3_output_path on every success message."
+    type = number
+    default = 0
+}
+
+variable output_layout {
+    description="Layout of the compare results: aoi, tile or pairs."
+    type = string
+    default = "aoi"
+    validation {
+        condition = can(regex("^(aoi|tile|pairs)$", var.output_layout))
+        error_message = "aoi, tile or pairs are the only output layouts."
+    }
+}
+
+variable result_ledger {
+    description="Record the SNS messages of announced results under ledger/ of the deploy prefix, and announce records that come back from the ledger without comparing them again."
+    type = bool
+    default = false
+}
+
+variable emit_metrics {
+    description="Log one CloudWatch embedded metric format record of stage timings, memory and counts per compare invocation."
+    type = bool
+    default = false
+}
+
+variable profile_mode {
+    description="Store DuckDB query profiles of compare invocations under profiles/ of the deploy prefix: off, slow for invocations over profile_slow_ms, or always."
+    type = string
+    default = "off"
+    validation {
+        condition = can(regex("^(off|slow|always)$", var.profile_mode))
+        error_message = "off, slow or always are the only profile modes."
+    }
+}
+
+variable profile_slow_ms {
+    description="Milliseconds from which a compare invocation is slow enough to store its profiles, with profile_mode slow."
+    type = number
+    default = 10000
+}
+
+variable profile_python {
+    description="Add a Python sampling profile to the stored query profiles."
+    type = bool
+    default = false
+}
+
 variable s3_bucket_name {
     description="Name of previously created S3 bucket."
     type = string
@@ -116,6 +214,26 @@ variable s3_endpoint {
     default = ""
 }
 
+variable subs_index {
+    description = "Where the compare gets its R-tree indexed subscriptions from: off, local or s3."
+    type = string
+    default = "off"
+    validation {
+        condition = can(regex("^(off|local|s3)$", var.subs_index))
+        error_message = "off, local or s3 are the only subs_index options."
+    }
+}
+
+variable subs_layout {
+    description = "Subscriptions layout read by the compare: flat, partitioned or delta."
+    type = string
+    default = "flat"
+    validation {
+        condition = can(regex("^(flat|partitioned|delta)$", var.subs_layout))
+        error_message = "flat, partitioned or delta are the only subs_layout options."
+    }
+}
+
 #####################################
 ##            Outputs              ##
 #####################################
@@ -1,4 +1,11 @@
 INSTALL aws;
 INSTALL httpfs;
 INSTALL spatial;
-INSTALL parquet;
\ No newline at end of file
+INSTALL parquet;
+-- the handler loads these without downloading, fail the build if one
+-- didn't install for the DuckDB it runs
+SET autoinstall_known_extensions = false;
+LOAD aws;
+LOAD httpfs;
+LOAD spatial;
+LOAD parquet;
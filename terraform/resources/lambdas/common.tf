@@ -53,7 +53,8 @@ resource aws_iam_role_policy lambda_policy {
                     "sqs:GetQueueAttributes",
                     "sqs:ReceiveMessage",
                     "sqs:ChangeMessageVisibility",
-                    "sqs:GetQueueUrl"
+                    "sqs:GetQueueUrl",
+                    "sqs:SendMessage"
                 ]
                 Resource = [ "${var.sqs_in_arn}" ]
 
@@ -76,9 +77,14 @@ resource aws_iam_role_policy lambda_policy {
                     "s3:ListBucket"
                 ],
                 Resource = [
+                    "arn:aws:s3:::${var.bucket_name}",
                     "arn:aws:s3:::${var.bucket_name}/${var.prefix}/compare/*.parquet",
                     "arn:aws:s3:::${var.bucket_name}/${var.prefix}/compare/*.parquet",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/intersects/*.parquet",
                     "arn:aws:s3:::${var.bucket_name}/${var.prefix}/subs/*.parquet",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/subs/*.duckdb",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/subs/*.json",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/ledger/*.json",
                     "arn:aws:s3:::${var.bucket_name}/${var.s3_cert_path}"
                 ]
             },
@@ -90,6 +96,11 @@ resource aws_iam_role_policy lambda_policy {
                 ],
                 Resource = [
                     "arn:aws:s3:::${var.bucket_name}/${var.prefix}/intersects/*.parquet",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/catalog/*.parquet",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/intersects/*/merged",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/intersects/*/failed",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/ledger/*.json",
+                    "arn:aws:s3:::${var.bucket_name}/${var.prefix}/profiles/*",
                 ]
             }
         ]
@@ -6,6 +6,9 @@ resource aws_lambda_function compare_function {
             data.aws_iam_role.sts_lambda_role[0].arn)
     timeout = 300
     memory_size = var.memory_size
+    ephemeral_storage {
+        size = max(512, var.ephemeral_storage)
+    }
 
     image_uri = var.image_uri
     package_type="Image"
@@ -20,8 +23,22 @@ resource aws_lambda_function compare_function {
             S3_BUCKET: var.bucket_name
             DEPLOY_PREFIX: var.prefix
             MEMORY_LIMIT: var.memory_size
+            EPHEMERAL_STORAGE: var.ephemeral_storage
             S3_CERT_PATH: var.s3_cert_path
             AWS_S3_ENDPOINT: var.s3_endpoint
+            SUBS_INDEX: var.subs_index
+            SUBS_LAYOUT: var.subs_layout
+            REPORT_BATCH_FAILURES: var.report_batch_failures ? "true" : "false"
+            COMPARE_CHUNK_ROWS: var.compare_chunk_rows
+            FANOUT_MODE: var.fanout_mode
+            FANOUT_ROWS: var.fanout_rows
+            INLINE_MESSAGES: var.inline_messages
+            OUTPUT_LAYOUT: var.output_layout
+            RESULT_LEDGER: var.result_ledger ? "true" : "false"
+            EMIT_METRICS: var.emit_metrics ? "true" : "false"
+            PROFILE_MODE: var.profile_mode
+            PROFILE_SLOW_MS: var.profile_slow_ms
+            PROFILE_PYTHON: var.profile_python ? "true" : "false"
         }
     }
 
@@ -36,4 +53,8 @@ resource aws_lambda_event_source_mapping compare_event_map {
     function_name    = aws_lambda_function.compare_function.arn
     batch_size = 100
     maximum_batching_window_in_seconds = 5
+    # with report_batch_failures the handler returns the records that
+    # failed, the rest are deleted
+    function_response_types = (var.report_batch_failures ?
+                               ["ReportBatchItemFailures"] : [])
 }
@@ -15,6 +15,10 @@ variable memory_size {
     default = 5120
     type = number
 }
+variable ephemeral_storage {
+    default = 0
+    type = number
+}
 variable s3_cert_path {
     type = string
 }
@@ -25,4 +29,69 @@ variable sts_lambda_role_name {
 
 variable s3_endpoint {
     type = string
-}
\ No newline at end of file
+}
+
+variable subs_index {
+    type = string
+    default = "off"
+}
+
+variable subs_layout {
+    type = string
+    default = "flat"
+}
+
+variable report_batch_failures {
+    type = bool
+    default = false
+}
+
+variable compare_chunk_rows {
+    type = number
+    default = 0
+}
+
+variable fanout_mode {
+    type = string
+    default = "off"
+}
+
+variable fanout_rows {
+    type = number
+    default = 100000
+}
+
+variable inline_messages {
+    type = number
+    default = 0
+}
+
+variable output_layout {
+    type = string
+    default = "aoi"
+}
+
+variable result_ledger {
+    type = bool
+    default = false
+}
+
+variable emit_metrics {
+    type = bool
+    default = false
+}
+
+variable profile_mode {
+    type = string
+    default = "off"
+}
+
+variable profile_slow_ms {
+    type = number
+    default = 10000
+}
+
+variable profile_python {
+    type = bool
+    default = false
+}